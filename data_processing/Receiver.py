@@ -3,10 +3,12 @@
 
 import abc
 from data_processing.Radio import Radio
-from data_processing.helper_functions import info, debug, warning, error, critical
+from data_processing.helper_functions import info, debug, warning, error, critical, iter_binary
+from data_processing.filter_data import NUMTAPS, design_lowpass, fir_filter
 from visualization.colors import color_array,color_bw_noise,color_bw_signal
 
 import sys
+import functools
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.signal
@@ -14,6 +16,128 @@ import numpy.fft as fft
 from matplotlib.ticker import ScalarFormatter
 
 
+@functools.lru_cache(maxsize=32)
+def spectrum_window(window, n_window):
+    """window with its sums s1 = sum(w), s2 = sum(w**2), computed once per (window, n_window)"""
+    w = scipy.signal.get_window(window, n_window)
+    w.setflags(write=False)  # shared between callers
+    return w, np.sum(w), np.sum(w**2)
+
+
+@functools.lru_cache(maxsize=32)
+def band_indices(n_fft, srate, bw_signal, bw_noise, noise_offsets):
+    """
+    bin indices of the signal band and of the two noise bands in a fftshifted spectrum
+    noise_offsets: (low, high) offsets of the noise bands from the carrier in Hz
+    returns: (idx_band, idx_noise_low, idx_noise_high)
+    """
+    mid = int(n_fft / 2)  # DC carrier
+    step = srate / n_fft
+    steps = bw_signal / step
+    indices = [np.array(np.arange(steps) + mid - steps / 2, dtype=int)]
+    steps = bw_noise / step
+    for offset in noise_offsets:
+        indices.append(np.array(np.arange(steps) + mid - steps / 2 + offset / step, dtype=int))
+    for idx in indices:
+        idx.setflags(write=False)
+    return tuple(indices)
+
+
+def power_spectra(data, n_fft, srate, window='hann'):
+    """
+    Spectra of every row of an (N, L) array in one FFT pass, see Receiver.calculate_spectrum.
+    Rows longer than n_fft are split into L / n_fft segments averaged in the power domain.
+    returns: (f, spectra) with spectra of shape (N, n_fft)
+    """
+    data = np.asarray(data)
+    num_rows, length = data.shape
+    if(n_fft <= length):
+        data = data.reshape(num_rows, -1, n_fft)
+        n_window = n_fft
+    else:
+        data = data[:, np.newaxis, :]
+        n_window = length
+
+    # window function
+    w, s1, _ = spectrum_window(window, n_window)
+
+    # calculate spectrum by fft, average in power domain
+    data_f = fft.fftshift(fft.fft(data * w, n=n_fft, axis=-1), axes=-1)
+    f = fft.fftshift(fft.fftfreq(n=n_fft, d=1 / srate))
+    spectra = np.average(abs(data_f)**2, axis=1)
+
+    # normalizations
+    spectra /= 2  # rms
+    spectra /= 50  # 50 Ohm
+    spectra /= 0.001  # 1 mW
+    spectra /= s1**2  # window
+    return (f, spectra)
+
+
+class SpectrumAccumulator(object):
+    """Streaming Welch estimate of the spectrum of a long capture.
+
+    Consecutive blocks of any size are passed to add(); a windowed n_fft segment
+    starts every n_fft - overlap samples and its power is added to a running sum.
+    Samples of an unfinished segment are carried over to the next block, so memory
+    is bounded by the block size plus n_fft, independent of the capture length.
+    With overlap=0, result() gives the spectrum of calculate_spectrum for a capture
+    of whole n_fft segments, with the same normalization (RMS, 50 Ohm, mW, window).
+    """
+
+    def __init__(self, n_fft, srate, window='hann', overlap=0, max_segments=64):
+        assert 0 <= overlap < n_fft, "overlap has to be smaller than n_fft"
+        self.n_fft = n_fft
+        self.srate = srate
+        self.window = window
+        self.step = n_fft - overlap
+        self.max_segments = max_segments  # segments per FFT call
+        self.reset()
+
+    def reset(self):
+        self.power = np.zeros(self.n_fft)
+        self.num_segments = 0
+        self._carry = None
+
+    def add(self, block):
+        block = np.asarray(block)
+        if(self._carry is not None):
+            block = np.concatenate([self._carry, block])
+        num = (block.size - self.n_fft) // self.step + 1 if block.size >= self.n_fft else 0
+
+        w, _, _ = spectrum_window(self.window, self.n_fft)
+        for first in range(0, num, self.max_segments):
+            count = min(self.max_segments, num - first)
+            start = first * self.step
+            segments = np.lib.stride_tricks.as_strided(
+                block[start:], shape=(count, self.n_fft),
+                strides=(self.step * block.strides[0], block.strides[0]), writeable=False)
+            self.power += np.sum(abs(fft.fft(segments * w, n=self.n_fft))**2, axis=0)
+        self.num_segments += num
+
+        # copy, so the caller's block (e.g. a memmap) is not kept alive
+        self._carry = np.array(block[num * self.step:])
+
+    def add_file(self, file_path, block_samples=2**22, num_samples=-1, offset=0):
+        """adds the samples of a binary IQ file, read block by block"""
+        for block in iter_binary(file_path, block_samples, num_samples, offset):
+            self.add(block)
+
+    def result(self):
+        """(f, spectrum) of all segments added so far"""
+        assert self.num_segments > 0, "Not enough samples for a single segment"
+        _, s1, _ = spectrum_window(self.window, self.n_fft)
+        f = fft.fftshift(fft.fftfreq(n=self.n_fft, d=1 / self.srate))
+        spectrum = fft.fftshift(self.power / self.num_segments)
+
+        # normalizations
+        spectrum /= 2  # rms
+        spectrum /= 50  # 50 Ohm
+        spectrum /= 0.001  # 1 mW
+        spectrum /= s1**2  # window
+        return (f, spectrum)
+
+
 class Receiver(Radio):
     """ Generic receiver class """
 
@@ -43,7 +167,8 @@ class Receiver(Radio):
     @abc.abstractmethod
     def receive_samples(self, n_samples, filename, verbose=True):
         """Receives a number of samples from the hardware
-        and saves them in self.data"""
+        and saves them in self.data
+        filename: file the capture is written to, None keeps it in self.data only"""
 
     def calculate_spectrum(self, n_fft=10000, window='hann', data=None):
         """Calculates the spectrum based on sampled IQ data. Spectra are
@@ -53,64 +178,57 @@ class Receiver(Radio):
 
         # check if data is valid
         if(data is None):
-            data = np.copy(self.data)
-        else:
-            data = np.copy(data)
-        # print(data)
-        # reshape samples for averaging
-        if(n_fft <= data.size):
-            data = np.reshape(data, (-1, n_fft))
-            n_window = n_fft
-        else:
-            n_window = data.size
-
-        # window function
-        w = scipy.signal.get_window(window, n_window)
-        s1 = np.sum(w)
-        s2 = np.sum(w**2)
-        enbw = self.srate * (s2 / s1**2)
-        data *= w
-
-        # calculate spectrum by fft
-        data_f = fft.fftshift(fft.fft(data, n=n_fft))
-        f = fft.fftshift(fft.fftfreq(n=n_fft, d=1 / self.srate))
-        spectrum = abs(data_f)**2
+            data = self.data
 
-        # average in power domain
-        if(n_fft <= data.size):
-            spectrum = np.average(spectrum, axis=0)
-
-        # normalizations
-        spectrum /= 2  # rms
-        spectrum /= 50  # 50 Ohm
-        spectrum /= 0.001  # 1 mW
-        spectrum /= s1**2  # window
+        # long captures are streamed instead of being windowed as a whole
+        if(np.size(data) > self.stream_segments * n_fft):
+            return self.welch_spectrum(data, n_fft=n_fft, window=window)
+        f, spectra = power_spectra(np.reshape(data, (1, -1)), n_fft, self.srate, window)
 
         # interpolate DC carrier
         # idx = np.argmin(spectrum)
         # spectrum[idx] = 0.5*(spectrum[idx-1]+spectrum[idx+2])
 
-        return (f, spectrum)
+        return (f, spectra[0])
+
+    # captures longer than this many n_fft segments go through welch_spectrum
+    stream_segments = 256
+
+    def welch_spectrum(self, source, n_fft=10000, window='hann', overlap=0, block_samples=2**22):
+        """
+        Spectrum of a long capture with bounded memory, see SpectrumAccumulator
+        source: binary IQ file name, or a 1-D array / np.memmap
+        overlap: samples shared by consecutive segments
+        """
+        acc = SpectrumAccumulator(n_fft, self.srate, window=window, overlap=overlap)
+        if(isinstance(source, str)):
+            acc.add_file(source, block_samples=block_samples)
+        else:
+            source = np.reshape(source, -1)
+            for start in range(0, source.size, block_samples):
+                acc.add(source[start:start + block_samples])
+        return acc.result()
+
+    def calculate_spectra(self, data, n_fft=10000, window='hann'):
+        """calculate_spectrum for every row of an (N, L) array in one FFT pass"""
+        return power_spectra(data, n_fft, self.srate, window)
 
     def receive_and_filter(self, n_samples):
 
         self.receive_samples(n_samples, "cache.bin", verbose=False)
         return self.filter_data()
 
-    def filter_data(self, data=None, plot=False):
-        """low-pass filters the data within the signal bandwidth"""
+    def filter_data(self, data=None, plot=False, dtype=None):
+        """low-pass filters the data within the signal bandwidth
+        data: 1-D recording or 2-D batch of recordings (filtered along the last axis)
+        dtype: e.g. np.complex64 to filter in single precision"""
 
         # check if data is valid
         if(data is None):
             data = self.data
 
-        # filter configuration
-        numtaps = 100
-        b = scipy.signal.firwin(numtaps=numtaps,
-                                cutoff=self.bw_signal / 2,
-                                pass_zero=True,
-                                fs=self.srate,
-                                )
+        # filter configuration, taps are designed once per configuration
+        b = design_lowpass(NUMTAPS, self.bw_signal / 2, self.srate)
         self.b = b
         # show frequency response of the filter
         if(plot):
@@ -179,7 +297,7 @@ class Receiver(Radio):
             plt.tight_layout()
             plt.show()
 
-        self.filtered_data = scipy.signal.convolve(data, b, mode='same')
+        self.filtered_data = fir_filter(data, b, dtype=dtype)
 
         return self.filtered_data
 
@@ -313,39 +431,43 @@ class Receiver(Radio):
         returns: (band_power [dBm], noise_power [dBm], noiseless_band_power [dBm])
         """
 
-        # return values
-        band_power = None
-        noise_power = None
-
         # check if data is valid
         assert self.data is not None, "Data not set"
         assert n_fft <= self.data.size, "Trying to fft more data than there is"
 
         _, per = self.calculate_spectrum(n_fft=n_fft, data=self.data, window=window)
+        band_power, noise_power, noiseless_band_power = (p[0] for p in self.band_powers(per[np.newaxis], n_fft))
+
+        debug(self.name, "band_power: %5.2f dB\tnoise_power: %5.2f dB\tsignal_power: %5.2f dB\t"
+            % (band_power, noise_power, noiseless_band_power))
+
+        return (band_power, noise_power, noiseless_band_power)
+
+    def band_powers(self, spectra, n_fft):
+        """
+        Band and noise power of every row of an (N, n_fft) array of spectra,
+        see measure_powers. Bin indices are cached per configuration.
+
+        returns: (band_power, noise_power, noiseless_band_power), each (N,) in dBm
+        """
+        idx_band, idx_noise_low, idx_noise_high = band_indices(
+            n_fft, self.srate, self.bw_signal, self.bw_noise,
+            tuple(float(f) - self.freq for f in self.freq_noise))
 
         # extract band power (bw_signal)
-        mid = int(len(per) / 2)  # DC carrier
-        step = self.srate / n_fft
-        steps = self.bw_signal / step
-        idx_band = np.array(np.arange(steps) + mid - steps / 2, dtype=int)
-        band_power = 10 * np.log10(np.sum(per[idx_band]))
+        band_power = 10 * np.log10(np.sum(spectra[:, idx_band], axis=1))
 
         # extract noise power
         # the noise power is measure in bw_noise Hertz at freq_noise Hz
         # and then multiplied by bw_signal/bw_noise to get the approximate
         # noise power in the signal bandwidth
-        step = self.srate / n_fft
-        steps = self.bw_noise / step
-        offset_steps_low = (self.freq_noise[0] - self.freq) / step
-        offset_steps_high = (self.freq_noise[1] - self.freq) / step
-        idx_noise_low = np.array(np.arange(steps) + mid - steps / 2 + offset_steps_low, dtype=int)
-        idx_noise_high = np.array(np.arange(steps) + mid - steps / 2 + offset_steps_high, dtype=int)
         bw_factor = self.bw_signal / (2*self.bw_noise)  # factor between signal and noise measurement BW
+        noise_power = 10 * np.log10(bw_factor * (np.sum(spectra[:, idx_noise_low], axis=1) +
+                                                 np.sum(spectra[:, idx_noise_high], axis=1)))
 
-        noise_power = 10 * np.log10(bw_factor * (np.sum(per[idx_noise_low]) + np.sum(per[idx_noise_high])))
-
-        if(band_power < noise_power):
-            error(self.name, "band_power: %5.2f dB\tnoise_power: %5.2f dB" % (band_power, noise_power))
+        if(np.any(band_power < noise_power)):
+            row = int(np.argmax(band_power < noise_power))
+            error(self.name, "band_power: %5.2f dB\tnoise_power: %5.2f dB" % (band_power[row], noise_power[row]))
             error("sys", "Illegal values in measure_powers()!")
             raise Exception("Illegal power values")
 
@@ -354,11 +476,37 @@ class Receiver(Radio):
         noiseless_band_power = 10 * np.log10(10**(band_power / 10) -
                                            10**(noise_power / 10))
 
-        debug(self.name, "band_power: %5.2f dB\tnoise_power: %5.2f dB\tsignal_power: %5.2f dB\t"
-            % (band_power, noise_power, noiseless_band_power))
-
         return (band_power, noise_power, noiseless_band_power)
 
+    def measure_batch(self, data, interference=None, n_fft=10000, window='hann'):
+        """
+        measure_SNR (and measure_SIR / measure_SINR) for every row of an (N, L)
+        batch of captures, all spectra computed in one FFT pass
+        interference: optional (N, L) captures of the interferer alone, i.e. what
+                      measure_SIR expects in self.data
+
+        returns: dict with f, spectra (N, n_fft) of data and snr (N,) [dB];
+                 sir and sinr (N,) [dB] as well if interference is given
+        """
+        data = np.asarray(data)
+        num_rows = len(data)
+        if(interference is not None):
+            data = np.concatenate([data, np.asarray(interference)])
+
+        f, spectra = self.calculate_spectra(data, n_fft=n_fft, window=window)
+        _, noise_power, noiseless_band_power = self.band_powers(spectra, n_fft)
+        signal_power = noiseless_band_power[:num_rows]
+        noise_power = noise_power[:num_rows]
+        result = {'f': f, 'spectra': spectra[:num_rows], 'snr': signal_power - noise_power}
+
+        if(interference is not None):
+            interference_power = noiseless_band_power[num_rows:]
+            interf_noise_power = 10 * np.log10(10**(interference_power / 10) +
+                                               10**(noise_power / 10))
+            result['sir'] = signal_power - interference_power
+            result['sinr'] = signal_power - interf_noise_power
+        return result
+
     def measure_SNR(self):
         """measures noise power, signal power and returns snr"""
 
@@ -400,7 +548,7 @@ class Receiver(Radio):
         debug(self.name, "SINR: %5.3f dB" % self.sinr)
         return self.sinr
 
-    def get_cfo(self, search_bw, plot=False):
+    def get_cfo(self, search_bw, plot=False, filename="cache.bin"):
         """
         Calculates the CFO between receiver and transmitter
         It is assumed that the transmitter is transmitting a single tone at freq_tx
@@ -411,8 +559,8 @@ class Receiver(Radio):
         try:
             self.backup_cfo = self.get_attributes()  # back up all attributes
             self.srate = search_bw
-            self.receive_samples(int(10 * search_bw), "cache.bin", verbose=False)
-            fp, per = self.calculate_spectrum(int(search_bw), window='boxcar')
+            self.receive_samples(int(10 * search_bw), filename, verbose=False)
+            fp, per = self.welch_spectrum(self.data, int(search_bw), window='boxcar')
             cfo = fp[np.argmax(per)]
         except Exception as err:
             raise err
@@ -0,0 +1,165 @@
+import numpy as np
+import scipy.stats
+import h5py as h5
+import pandas as pd
+
+from data_processing.iq_conversion import iq_to_complex
+from data_processing.cumulants import moments, cumulants
+from data_processing.Receiver import power_spectra
+
+# same parameters as the dummy receiver of featurize_data
+SRATE = 50000000.0
+BW_SIGNAL = 20000000.0
+A_T = 1     # threshold
+N_S = 1024  # window length FFT
+
+# column schema of featurize_data.featurize, in the same order
+FEATURE_COLUMNS = ["$N_c$ (1st)", "$N_c$ (2nd)", "$ZC$",
+                   "$\\gamma_{1,max}$", "$\\gamma_{2,max}$", "$\\gamma_{4,max}$",
+                   "$\\sigma_{aa}$", "$\\sigma_{a}$", "$\\sigma_{ap,CNL}$", "$\\sigma_{dp,CNL}$",
+                   "$\\sigma_{ap,C}$", "$\\sigma_{dp,C}$", "$\\sigma_{af}$",
+                   "$\\mu^A_{42}$", "$\\mu^f_{42}$",
+                   "$\\Psi_{max}$", "$\\sigma_{R}$", "$\\mu^R_{42}$", "$\\beta$", "$C$", "PAPR",
+                   "$\\hat{C}_{20}$", "$\\hat{C}_{21}$", "$\\nu_{42}$",
+                   "$|\\widetilde{C}_{40}|$", "$|\\widetilde{C}_{41}|$", "$\\widetilde{C}_{42}$",
+                   "$|\\widetilde{C}_{60}|$", "$|\\widetilde{C}_{61}|$", "$|\\widetilde{C}_{62}|$",
+                   "$\\widetilde{C}_{63}$"]
+
+
+def _masked_mean(v, mask):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(np.where(mask, v, 0), axis=1) / np.sum(mask, axis=1)
+
+
+def _masked_central_moment(v, mask, order, mean=None):
+    if mean is None:
+        mean = _masked_mean(v, mask)
+    d = np.where(mask, v - mean[:, np.newaxis], 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(d ** order, axis=1) / np.sum(mask, axis=1)
+
+
+def _masked_std(v, mask):
+    return np.sqrt(_masked_central_moment(v, mask, 2))
+
+
+def _masked_kurtosis(v, mask):
+    """scipy.stats.kurtosis(v[mask], fisher=False) per row"""
+    mean = _masked_mean(v, mask)
+    m2 = _masked_central_moment(v, mask, 2, mean)
+    m4 = _masked_central_moment(v, mask, 4, mean)
+    with np.errstate(all='ignore'):
+        zero = m2 <= (np.finfo(m2.dtype).resolution * mean) ** 2
+        return np.where(zero, np.nan, m4 / m2 ** 2.0)
+
+
+def featurize_batch(iq, srate=SRATE, bw_signal=BW_SIGNAL, n_s=N_S, a_t=A_T):
+    """
+    Expert features of featurize_data.featurize for a whole block of signals
+    :param iq: (N, L, 2) IQ block or (N, L) complex block
+    :return: (N, len(FEATURE_COLUMNS)) float32 matrix, columns in FEATURE_COLUMNS order
+    """
+    iq = np.asarray(iq)
+    r = iq_to_complex(iq, np.complex128) if not np.iscomplexobj(iq) else iq.astype(np.complex128)
+    T_s = 1 / srate
+    B, N = r.shape
+
+    # zero-crossings
+    sign_re, sign_im = np.sign(r.real), np.sign(r.imag)
+    zc = np.sum((sign_im * np.roll(sign_im, 1, axis=1)) < 0, axis=1) + \
+        np.sum((sign_re * np.roll(sign_re, 1, axis=1)) < 0, axis=1)
+
+    # Amplitude
+    A = np.abs(r)
+    A_N = A / np.mean(A, axis=1, keepdims=True)
+    nw = A_N > a_t   # non-weak samples
+    # non-weak samples of 2nd degree (previous sample also non-weak), never the first sample
+    nw2 = nw & np.roll(nw, 1, axis=1)
+    nw2[:, 0] = False
+    A_CN = A_N - 1
+
+    # PSD of Amplitude and spectrogram of the signal, one FFT pass over all four
+    fs, spectra = power_spectra(np.concatenate([A_CN, A_CN ** 2, A_CN ** 4, r]), n_s, srate)
+    F1_A_CN, F2_A_CN, F4_A_CN, per = np.split(spectra, 4)
+
+    # Phase
+    phi = np.angle(r)
+    phi_C = phi - _masked_mean(phi, nw)[:, np.newaxis]
+    phi_NL = np.unwrap(phi, axis=1)  # no detrending because cfo is corrected
+    phi_CNL = phi_NL - _masked_mean(phi_NL, nw)[:, np.newaxis]
+
+    # Frequency
+    f = (1 / 2 * np.pi) * (phi_NL - np.roll(phi_NL, 1, axis=1)) / T_s
+    f_CN = (f - _masked_mean(f, nw2)[:, np.newaxis]) / (1 / T_s)
+
+    # Spectrogram
+    R = per[:, abs(fs) <= bw_signal / 2] / n_s
+
+    # autocorrelation at lag 50, np.correlate(r, np.roll(r, 50), mode='valid')
+    Psi = np.sum(r * np.conj(np.roll(r, 50, axis=1)), axis=1) / np.var(r, axis=1) / N
+
+    # Moments and cumulants
+    M = moments(r)
+    C = cumulants(M)
+    abs_M21 = C['C21']
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        features = [
+            # Signal Features
+            np.sum(nw, axis=1), np.sum(nw2, axis=1), zc,
+            # Spectral Features
+            np.max(F1_A_CN, axis=1) ** 2 / n_s,
+            np.max(F2_A_CN, axis=1) ** 2 / n_s,
+            np.max(F4_A_CN, axis=1) ** 2 / n_s,
+            np.std(np.abs(A_CN), axis=1),
+            _masked_std(A_CN, nw),
+            _masked_std(np.abs(phi_CNL), nw),
+            _masked_std(phi_CNL, nw),
+            _masked_std(np.abs(phi_C), nw),
+            _masked_std(phi_C, nw),
+            _masked_std(np.abs(f_CN), nw2),
+            scipy.stats.kurtosis(A_CN, axis=1, fisher=False),
+            _masked_kurtosis(f_CN, nw2),
+            np.abs(Psi),
+            np.std(R, axis=1),
+            scipy.stats.kurtosis(R, axis=1, fisher=False),
+            np.sum(r.real ** 2, axis=1) / np.sum(r.imag ** 2, axis=1),
+            np.max(A, axis=1) / np.sqrt(abs_M21),
+            np.abs(np.max(M['r21'], axis=1)) / abs_M21,
+            # Statistical Features
+            C['C20'], C['C21'], C['mu_42'],
+            C['C40'], C['C41'], C['C42'],
+            C['C60'], C['C61'], C['C62'], C['C63'],
+        ]
+    return np.stack(features, axis=1).astype(np.float32)
+
+
+def features_frame(features, snrs, labels):
+    """DataFrame with the column schema of featurize_data: SNR, label, features"""
+    df = pd.DataFrame(features, columns=FEATURE_COLUMNS)
+    df.insert(0, 'label', np.asarray(labels).reshape(-1))
+    df.insert(0, 'SNR', np.asarray(snrs).reshape(-1))
+    return df
+
+
+def write_features(path, features, snrs, labels):
+    """
+    Writes a feature table to a columnar file
+    :param path: .parquet (pandas/pyarrow) or .h5/.hdf5 (features (N,F) float32, snrs, labels)
+    """
+    if path.endswith('.parquet'):
+        features_frame(features, snrs, labels).to_parquet(path, index=False)
+    else:
+        with h5.File(path, 'w') as hdf:
+            hdf.create_dataset('features', data=features, chunks=True, compression='gzip')
+            hdf.create_dataset('snrs', data=np.asarray(snrs).reshape(-1), compression='gzip')
+            hdf.create_dataset('labels', data=np.asarray(labels).reshape(-1), compression='gzip')
+            hdf['features'].attrs['columns'] = FEATURE_COLUMNS
+
+
+def read_features(path):
+    """feature table written by write_features as a DataFrame"""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    with h5.File(path, 'r') as hdf:
+        return features_frame(hdf['features'][()], hdf['snrs'][()], hdf['labels'][()])
@@ -0,0 +1,69 @@
+import numpy as np
+
+# order of the 10 features of intf_processing.featurize / the LightningCNN feature path
+CUMULANT_FEATURES = ['C20', 'mu_42', 'C21', 'C40', 'C41', 'C42', 'C60', 'C61', 'C62', 'C63']
+
+
+def moments(r, norm=None):
+    """
+    Mixed moments M20..M63 of every row of a complex batch
+    :param r: (N, L) complex signals
+    :param norm: normaliser of the sums (default L)
+    :return: dict of (N,) complex moments, plus r21 = |r - mean|^2 (N, L) for peak based features
+    """
+    r = np.atleast_2d(r)
+    n = r.shape[1] if norm is None else norm
+
+    # zero-mean
+    r10 = r - np.mean(r, axis=1, keepdims=True)
+    r11 = np.conj(r10)
+
+    # products shared between the orders
+    r20 = r10 * r10
+    r21 = r10 * r11
+    r22 = r11 * r11
+    r40 = r20 * r20
+
+    return {'M20': (1 / n) * np.sum(r20, axis=1),
+            'M21': (1 / n) * np.sum(r21, axis=1),
+            'M22': (1 / n) * np.sum(r22, axis=1),
+            'M40': (1 / n) * np.sum(r40, axis=1),
+            'M41': (1 / n) * np.sum(r20 * r21, axis=1),
+            'M42': (1 / n) * np.sum(r20 * r22, axis=1),
+            'M60': (1 / n) * np.sum(r40 * r20, axis=1),
+            'M61': (1 / n) * np.sum(r40 * r21, axis=1),
+            'M62': (1 / n) * np.sum(r40 * r22, axis=1),
+            'M63': (1 / n) * np.sum(r20 * r10 * r22 * r11, axis=1),
+            'r21': r21}
+
+
+def cumulants(M):
+    """magnitudes of the cumulants C20..C63, normalised by |M21|, from the output of moments()"""
+    M20, M21, M22, M40, M41, M42, M60, M61, M62, M63 = (M[k] for k in ('M20', 'M21', 'M22', 'M40', 'M41',
+                                                                       'M42', 'M60', 'M61', 'M62', 'M63'))
+    abs_M21 = np.abs(M21)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'C20': np.abs(M20),
+                'C21': abs_M21,
+                'mu_42': np.abs(M42 / abs_M21),
+                'C40': np.abs((-3 * M20 ** 2 + M40) / abs_M21 ** 2),
+                'C41': np.abs((-3 * M21 * M20 + M41) / abs_M21 ** 2),
+                'C42': np.abs((-2 * M21 ** 2 - M22 * M20 + M42) / abs_M21 ** 2),
+                'C60': np.abs((30 * M20 ** 3 - 15 * M20 * M40 + M60) / abs_M21 ** 3),
+                'C61': np.abs((30 * M20 ** 2 * M21 - 14 * M20 * M41 - M40 * M21 + M61) / abs_M21 ** 3),
+                'C62': np.abs((24 * M21 ** 2 * M20 + 6 * M22 * M20 ** 2 - 6 * M20 * M42 - 8 * M21 * M41
+                               - M22 * M40 + M62) / abs_M21 ** 3),
+                'C63': np.abs((12 * M21 ** 3 + 12 * M22 * M21 * M20 - 9 * M42 * M21 + M63) / abs_M21 ** 3)}
+
+
+def cumulant_features(r, norm=None):
+    """(N, 10) cumulant features of a complex batch in CUMULANT_FEATURES order"""
+    C = cumulants(moments(r, norm))
+    return np.stack([C[k] for k in CUMULANT_FEATURES], axis=1)
+
+
+def scale_rows(features):
+    """preprocessing.scale(row, with_mean=False) for every row: divide by the row std"""
+    std = np.std(features, axis=1, keepdims=True)
+    std[std == 0] = 1.0
+    return features / std
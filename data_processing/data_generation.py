@@ -1,21 +1,28 @@
 import os
 import glob
+import time
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
 
-from data_processing.helper_functions import read_binary
+from data_processing.helper_functions import read_binary, binary_num_samples
 from data_processing.Receiver import Receiver
+from data_processing.filter_data import NUMTAPS
 
+# samples needed on each side of the kept chunks so that the low-pass filter of
+# Receiver.filter_data gives the same output as filtering the whole recording
+FILTER_MARGIN = NUMTAPS // 2
 
-def generate_dataset():
+MOD_SCHEMES = ["SC_BPSK", "SC_QPSK", "SC_16QAM", "SC_64QAM",
+               "OFDM_BPSK", "OFDM_QPSK", "OFDM_16QAM", "OFDM_64QAM"]
 
-    root_folder = "/data/all_RFSignal_cdv/mixed_recordings/interference/ota"
-    param_folder = "/no_cfo/tx_usrp/rx_usrp/intf_vsg/i_SC_16QAM"
-    output_folder = "npz/"
-    # measured_snr = ["0db","5db","10db","15db","20db"]
-    mod_schemes = ["SC_BPSK", "SC_QPSK", "SC_16QAM", "SC_64QAM",
-                   "OFDM_BPSK", "OFDM_QPSK", "OFDM_16QAM", "OFDM_64QAM"] 
+_receiver = None   # one dummy receiver per worker process
 
-    dummyReceiver = Receiver(**{
+
+def _dummy_receiver():
+    global _receiver
+    if _receiver is None:
+        _receiver = Receiver(**{
                                 'freq': 5750000000.0,
                                 'srate': 50000000.0,
                                 'rx_dir': None,
@@ -28,64 +35,107 @@ def generate_dataset():
                                 'max_gain': 0,
                                 'freq_noise_offset': 20000000.0,
                                 'bw_signal': 20000000.0})
+        _receiver.name = "dummy"
+    return _receiver
 
-    dummyReceiver.name = "dummy"
 
-    for subdir, dirs, files in os.walk(root_folder+param_folder):
-        file_register = {}   # dict to store the folder name as keys and file names as values
-        total_files = 0
-        for directory in dirs:
+def output_file_of(subfolder, mod_scheme, output_folder="npz/"):
+    return subfolder[:-len("bin/")] + output_folder + mod_scheme + "_filtered.npz"
 
+
+def find_work_units(folder, mod_schemes=MOD_SCHEMES):
+    """(subfolder, mod_scheme, files) for every bin folder and modulation scheme with recordings"""
+    units = []
+    for subdir, dirs, files in os.walk(folder):
+        for directory in dirs:
             if directory == "bin":
-                files_in_directory = glob.glob(os.path.join(subdir, directory) + "/*.bin")
                 subfolder = os.path.join(subdir, directory) + "/"
-                file_register[subfolder] = files_in_directory
-                total_files += len(files_in_directory)
-
-        for iteration, subfolder in enumerate(file_register.keys()):
-            print(subfolder)
-
-            #snr = re.search(r"\d+(\.\d+)?", subfolder)
-            #print(snr.group(0))
-            for mod_scheme in mod_schemes:
-                files = [file for file in file_register[subfolder] if mod_scheme in file]
-                num_files = len(files)
-                # print(num_files)
-                if (num_files > 0):
-                    print("OS", "Analyzing samples from %s modulation" % mod_scheme)
-
-                    # find dimensionality of output
-                    num_samples = num_files * 8  # each file = 10 sample record, discard beginning and end
-                    num_iq = int(read_binary(files[0]).size / 10)
-                    print("OS", "%d samples with %d IQ samples each" % (num_samples, num_iq))
-
-                    # pre-allocate memory
-                    matrix = np.zeros((num_samples, num_iq), dtype=np.complex64)
-                    snrs = -1 * np.ones(num_samples, dtype=float)
-                    labels = -1 * np.ones(num_samples, dtype=int)
-
-                    # for every binary file
-                    for i, file in enumerate(files):
-                        # read data, load in dummy receiver
-                        data = read_binary(file)
-                        dummyReceiver.data = data
-
-                        # get SNR, label, and filter data
-                        snrs[i * 8:(i + 1) * 8] = dummyReceiver.measure_SNR()                  #int(snr.group(0))
-                        labels[i * 8:(i + 1) * 8] = mod_schemes.index(mod_scheme)
-                        filtered_data = dummyReceiver.filter_data()
-
-                        # for every chunk in a binary file (only use chunk 2-9)
-                        # one chunk is equal to one measurement, observation or sample in the ML sense
-                        # for this configuration every observation is t=0.001s (1ms) long
-                        matrix[i * 8:(i + 1) * 8, :] = np.stack(np.split(filtered_data, 10)[1:-1])
-
-                    # save data after all files have been read
-                    output_dir = subfolder[:-len("bin/")] + output_folder
-                    output_file = output_dir + mod_scheme + "_filtered.npz"
-
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
-
-                    np.savez(output_file, matrix=matrix, snrs=snrs, labels=labels)
-                    print("OS", "saved .npz data in %s" % output_file)
\ No newline at end of file
+                files_in_directory = glob.glob(subfolder + "*.bin")
+                for mod_scheme in mod_schemes:
+                    unit_files = [file for file in files_in_directory if mod_scheme in file]
+                    if len(unit_files) > 0:
+                        units.append((subfolder, mod_scheme, unit_files))
+    return units
+
+
+def process_unit(unit, mod_schemes=MOD_SCHEMES, batch_files=16):
+    """
+    Reads, measures and filters all recordings of one (subfolder, mod_scheme) and saves them as npz
+    :param unit: (subfolder, mod_scheme, files)
+    :param batch_files: recordings read, measured and filtered at a time; besides the output a
+                        worker holds only one batch of raw and filtered recordings in memory
+    :return: output file, number of files, seconds spent
+    """
+    start_time = time.time()
+    subfolder, mod_scheme, files = unit
+    dummyReceiver = _dummy_receiver()
+    num_files = len(files)
+    print("OS", "Analyzing samples from %s modulation in %s" % (mod_scheme, subfolder))
+
+    # find dimensionality of output
+    num_samples = num_files * 8  # each file = 10 sample record, discard beginning and end
+    num_iq = int(binary_num_samples(files[0]) / 10)
+
+    # one chunk is equal to one measurement, observation or sample in the ML sense
+    # for this configuration every observation is t=0.001s (1ms) long
+    matrix = np.empty((num_samples, num_iq), dtype=np.complex64)
+    snrs = np.empty(num_samples, dtype=float)
+    labels = np.full(num_samples, mod_schemes.index(mod_scheme), dtype=int)
+
+    n_fft = 10000
+    recordings = np.empty((min(batch_files, num_files), 8 * num_iq + 2 * FILTER_MARGIN), dtype=np.complex64)
+    for first in range(0, num_files, batch_files):
+        batch = files[first:first + batch_files]
+        # read only chunk 2-9 plus the filter margin of every binary file
+        for i, file in enumerate(batch):
+            recordings[i] = read_binary(file, 8 * num_iq + 2 * FILTER_MARGIN, offset=num_iq - FILTER_MARGIN)
+        raw = recordings[:len(batch)]
+
+        # get SNR (one FFT pass over the batch) and filter data
+        # the SNR is measured on the kept chunks only, the filter margins are left out; the spectrum
+        # averages whole n_fft segments, a kept part shorter than one segment is zero padded instead
+        kept = raw[:, FILTER_MARGIN:FILTER_MARGIN + 8 * num_iq]
+        measured = kept[:, :max(kept.shape[1] // n_fft, 1) * n_fft]
+        rows = slice(first * 8, (first + len(batch)) * 8)
+        snrs[rows] = np.repeat(dummyReceiver.measure_batch(measured, n_fft=n_fft)['snr'], 8)
+        filtered_data = dummyReceiver.filter_data(raw)[:, FILTER_MARGIN:FILTER_MARGIN + 8 * num_iq]
+        matrix[rows] = filtered_data.reshape(-1, num_iq)
+        del filtered_data
+    del recordings
+
+    # write to a temporary file first, a crashed run never leaves a truncated npz behind
+    output_file = output_file_of(subfolder, mod_scheme)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(f, matrix=matrix, snrs=snrs, labels=labels)
+    os.replace(tmp_file, output_file)
+    return output_file, num_files, time.time() - start_time
+
+
+def generate_dataset(root_folder="/data/all_RFSignal_cdv/mixed_recordings/interference/ota",
+                     param_folder="/no_cfo/tx_usrp/rx_usrp/intf_vsg/i_SC_16QAM",
+                     num_workers=None, resume=True, batch_files=16):
+    """
+    Converts all recordings below root_folder + param_folder into filtered npz files
+    :param num_workers: worker processes, None = all cores. Each worker holds the output of one
+                        unit plus batch_files raw and filtered recordings in memory.
+    :param resume: skip units whose npz output already exists
+    """
+    units = find_work_units(root_folder + param_folder)
+    if resume:
+        done = [unit for unit in units if os.path.exists(output_file_of(unit[0], unit[1]))]
+        units = [unit for unit in units if not os.path.exists(output_file_of(unit[0], unit[1]))]
+        print("OS", "%d units already converted, %d to go" % (len(done), len(units)))
+
+    start_time = time.time()
+    # maxtasksperchild releases the memory of a worker after every few units
+    with Pool(num_workers, maxtasksperchild=4) as pool:
+        for n, (output_file, num_files, seconds) in enumerate(pool.imap_unordered(partial(process_unit, batch_files=batch_files), units)):
+            print("OS", "saved .npz data in %s (%d files, %.1fs) [%d/%d]" % (output_file, num_files, seconds,
+                                                                            n + 1, len(units)))
+    print("OS", "converted %d units in %.1fs" % (len(units), time.time() - start_time))
+
+
+if __name__ == "__main__":
+    generate_dataset()
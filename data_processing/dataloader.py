@@ -2,12 +2,13 @@ import pandas as pd
 import ast
 import h5py as h5
 from sklearn import preprocessing
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, BatchSampler, SequentialSampler
 from torch.utils.data.sampler import SubsetRandomSampler
 from models.pytorch_lightning.py_lightning import *
 import math
-from tqdm import tqdm
+import time
 from multiprocessing import Pool
+from data_processing.stratify import stratified_split
 
 
 def label_idx(labels):
@@ -25,12 +26,94 @@ def parallelize_dataframe(df, func, n_cores=10):
     return df
 
 
-def load_batch(path,batch_size=512,mode="train"):
+class IndexedArray(Dataset):
+    """Rows of an in-memory array in the order given by indices, without copying the array"""
+
+    def __init__(self, array, indices):
+        self.array = array
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        return self.array[self.indices[item]]
+
+
+class AlignedArrays(Dataset):
+    """(iq, label, snr) of the rows given by indices; a list of positions returns a whole batch"""
+
+    def __init__(self, iq, labels, snrs, indices):
+        self.iq = iq
+        self.labels = labels
+        self.snrs = snrs
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        rows = self.indices[item]
+        return self.iq[rows], self.labels[rows], self.snrs[rows]
+
+
+class LoaderTimer(object):
+    """Wraps a loader and accumulates the time spent waiting for its batches, reset on every pass"""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.wait = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait = 0.0
+        batches = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.wait += time.perf_counter() - start
+            yield batch
+
+
+def _read_arrays(path, iq='iq', labels='labels', snrs='snrs'):
+    """reads a whole HDF5 dataset into contiguous float32 iq and label arrays, snrs keep their stored dtype"""
+    with h5.File(path, 'r') as file:
+        iq_arr = file[iq][()].astype(np.float32, copy=False)
+        label_arr = file[labels][()].astype(np.float32, copy=False)
+        snr_arr = file[snrs][()]
+    return iq_arr, label_arr, snr_arr
+
+
+def _aligned_loader(iq, labels, snrs, indices, training_params, pin_memory=False, prefetch_factor=2):
+    batches = BatchSampler(SequentialSampler(range(len(indices))), training_params['batch_size'], drop_last=False)
+    worker_params = {}
+    if training_params['num_workers'] > 0:
+        # workers are kept across epochs, each keeps prefetch_factor batches ready
+        worker_params = {'prefetch_factor': prefetch_factor, 'persistent_workers': True}
+    return DataLoader(AlignedArrays(iq, labels, snrs, indices), sampler=batches, batch_size=None,
+                      num_workers=training_params['num_workers'], pin_memory=pin_memory, **worker_params)
+
+
+def load_batch(path,batch_size=512,mode="train",aligned=False,num_workers=4,pin_memory=False,prefetch_factor=2):
+    """
+    Loads a dataset into memory and batches it
+    :param path: HDF5 file or npz with matrix/labels
+    :param mode: train, test or both
+    :param aligned: HDF5 only, return one (iq, label, snr) loader per split instead of
+                    separate X/Y loaders: (train, val), (test, y_test_raw) or (train, val, test, y_test_raw)
+    :param pin_memory: aligned only, batches come in page-locked memory for asynchronous copies to the gpu
+    :param prefetch_factor: aligned only, batches loaded in advance by every worker
+    """
     print("Loading Data...")
 
     training_params = {"batch_size": batch_size,
                        "shuffle": False,
-                       "num_workers": 4}
+                       "num_workers": num_workers}
 
     if path[-3:]=="npz":
 
@@ -55,48 +138,54 @@ def load_batch(path,batch_size=512,mode="train"):
 
     else:
 
-        iq,labels,snrs = reader.read_hdf5(path)
+        iq, labels, snrs = _read_arrays(path)
         print("=======Starting======")
 
-        # analyze data
-        df = pd.DataFrame()
-        df['iq'] = list(map(lambda x:np.array(x,dtype=np.float32),iq))
-        # df['normalized_iq'] = df.iq.apply(lambda x: preprocessing.scale(x, with_mean=False))
-        # df.drop('iq', axis=1, inplace=True)
-        df['labels'] = list(map(lambda x: np.array(x,dtype=np.float32), labels))
-        df['snr'] = list(map(lambda x: x, snrs))
-
-        df = df.sample(frac=1, random_state=4)
-        train_bound = int(0.75 * df.labels.shape[0])
-        val_bound = int(0.80 * df.labels.shape[0])
+        # same order as df.sample(frac=1, random_state=4), without copying the arrays
+        order = np.random.RandomState(4).permutation(labels.shape[0])
+        train_bound = int(0.75 * labels.shape[0])
+        val_bound = int(0.80 * labels.shape[0])
+        train_idx, val_idx, test_idx = order[:train_bound], order[train_bound:val_bound], order[val_bound:]
+        y_test_raw = labels[test_idx]
+
+        if aligned:
+            # one loader per split yielding (iq, label, snr) batches
+            loader_params = {'pin_memory': pin_memory, 'prefetch_factor': prefetch_factor}
+            train_gen = _aligned_loader(iq, labels, snrs, train_idx, training_params, **loader_params)
+            val_gen = _aligned_loader(iq, labels, snrs, val_idx, training_params, **loader_params)
+            if mode == 'train':
+                return train_gen, val_gen
+            test_gen = _aligned_loader(iq, labels, snrs, test_idx, training_params, **loader_params)
+            if mode == 'test':
+                return test_gen, y_test_raw
+            elif mode == 'both':
+                return train_gen, val_gen, test_gen, y_test_raw
+            return
 
-        # using dataframe values
         if mode == 'train':
-            x_train_gen = DataLoader(df.iq[:train_bound].values, **training_params)
-            y_train_gen = DataLoader(df.labels[:train_bound].values, **training_params)
-            x_val_gen = DataLoader(df.iq[train_bound:val_bound].values, **training_params)
-            y_val_gen = DataLoader(df.labels[train_bound:val_bound].values, **training_params)
+            x_train_gen = DataLoader(IndexedArray(iq, train_idx), **training_params)
+            y_train_gen = DataLoader(IndexedArray(labels, train_idx), **training_params)
+            x_val_gen = DataLoader(IndexedArray(iq, val_idx), **training_params)
+            y_val_gen = DataLoader(IndexedArray(labels, val_idx), **training_params)
 
             return x_train_gen, y_train_gen, x_val_gen, y_val_gen
 
         elif mode == 'test':
-            x_test_gen = DataLoader(df.normalized_iq[val_bound:].values, **training_params)
-            y_test_gen = DataLoader(df.labels[val_bound:].values, **training_params)
-            y_test_raw = df.labels[val_bound:].values
+            x_test_gen = DataLoader(IndexedArray(iq, test_idx), **training_params)
+            y_test_gen = DataLoader(IndexedArray(labels, test_idx), **training_params)
 
-            return x_test_gen, y_test_gen,y_test_raw
+            return x_test_gen, y_test_gen, y_test_raw
 
         elif mode == "both":
-            x_train_gen = DataLoader(df.iq[:train_bound].values, **training_params)
-            y_train_gen = DataLoader(df.labels[:train_bound].values, **training_params)
-            x_val_gen = DataLoader(df.iq[train_bound:val_bound].values, **training_params)
-            y_val_gen = DataLoader(df.labels[train_bound:val_bound].values, **training_params)
-            x_test_gen = DataLoader(df.iq[val_bound:].values, **training_params)
-            y_test_gen = DataLoader(df.labels[val_bound:].values, **training_params)
-            y_test_raw = df.labels[val_bound:].values
-            snr_test_gen = DataLoader(df.snr[val_bound:].values, **training_params)
-
-            return x_train_gen, y_train_gen, x_val_gen, y_val_gen,x_test_gen, y_test_gen,y_test_raw,snr_test_gen
+            x_train_gen = DataLoader(IndexedArray(iq, train_idx), **training_params)
+            y_train_gen = DataLoader(IndexedArray(labels, train_idx), **training_params)
+            x_val_gen = DataLoader(IndexedArray(iq, val_idx), **training_params)
+            y_val_gen = DataLoader(IndexedArray(labels, val_idx), **training_params)
+            x_test_gen = DataLoader(IndexedArray(iq, test_idx), **training_params)
+            y_test_gen = DataLoader(IndexedArray(labels, test_idx), **training_params)
+            snr_test_gen = DataLoader(IndexedArray(snrs, test_idx), **training_params)
+
+            return x_train_gen, y_train_gen, x_val_gen, y_val_gen, x_test_gen, y_test_gen, y_test_raw, snr_test_gen
         else:
             pass
 
@@ -162,47 +251,13 @@ def sequential_set():
     path = "/media/rachneet/arsenal/rf_dataset_inets/dataset_intf_ofdm_snr10_1024.h5"
     train_path = "/media/rachneet/arsenal/rf_dataset_inets/sequential_sets/train90_sequential_intf_ofdm.h5"
     test_path = "/media/rachneet/arsenal/rf_dataset_inets/sequential_sets/test10_sequential_intf_ofdm.h5"
-    data = h5.File(path, 'r')
-    iq, labels, sirs = data['iq'], data['labels'], data['sirs']
-    # print(labels.shape)
-    threshold1 = int(0.1*57600)
-    threshold2 = int(0.1*48000)
-    mods = [0,1,2,3,4,5,6,7]
-    for mod in mods:
-        count5, count10, count15, count20, count25 = 0, 0, 0, 0, 0
-        for i in tqdm(range(iq.shape[0])):
-            if label_idx(labels[i]) == mod:
-                if sirs[i] == 5:
-                    if count5 < threshold1:
-                        create_set(test_path, iq[i], labels[i], sirs[i])
-                        count5 += 1
-                    else:
-                        create_set(train_path, iq[i], labels[i], sirs[i])
-                elif sirs[i] == 10:
-                    if count10 < threshold1:
-                        create_set(test_path, iq[i], labels[i], sirs[i])
-                        count10 += 1
-                    else:
-                        create_set(train_path, iq[i], labels[i], sirs[i])
-                elif sirs[i] == 15:
-                    if count15 < threshold1:
-                        create_set(test_path, iq[i], labels[i], sirs[i])
-                        count15 += 1
-                    else:
-                        create_set(train_path, iq[i], labels[i], sirs[i])
-                elif sirs[i] == 20:
-                    if count20 < threshold1:
-                        create_set(test_path, iq[i], labels[i], sirs[i])
-                        count20 += 1
-                    else:
-                        create_set(train_path, iq[i], labels[i], sirs[i])
-                elif sirs[i] == 25:
-                    if count25 < threshold2:
-                        create_set(test_path, iq[i], labels[i], sirs[i])
-                        count25 += 1
-                    else:
-                        create_set(train_path, iq[i], labels[i], sirs[i])
-    print(count5, count10, count15, count20, count25)
+    # the first int(0.1*57600) rows of every (modulation, sir) group in file order, int(0.1*48000) at
+    # sir 25, go to the test set, the rest to train
+    threshold1, threshold2 = int(0.1 * 57600), int(0.1 * 48000)
+    counts = stratified_split(path, test_path, train_path, 1.0, snr_key='sirs', snr_values=[5, 10, 15, 20, 25],
+                              max_per_group={5: threshold1, 10: threshold1, 15: threshold1, 20: threshold1,
+                                             25: threshold2})
+    print(counts)
 
 
 if __name__=="__main__":
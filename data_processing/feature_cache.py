@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+
+from data_processing.hdf5_dataset import _featurize_rows
+from data_processing.cumulants import CUMULANT_FEATURES
+
+# bump whenever _featurize_rows changes its output, existing caches are then rebuilt
+FEATURIZER_VERSION = 1
+
+
+def _source_files(data_path):
+    # shard directories are fingerprinted file by file, without existing sidecars
+    if os.path.isdir(data_path):
+        return [os.path.join(data_path, name) for name in sorted(os.listdir(data_path))]
+    return [data_path]
+
+
+def source_fingerprint(data_path, num_blocks=16, block_bytes=65536, full=False):
+    """
+    sha1 over name, size, mtime, inode and evenly spaced sampled blocks of the source file(s)
+    Reads at most num_blocks * block_bytes per file, so large datasets are hashed in milliseconds.
+    An in-place edit outside the sampled blocks is still caught by mtime_ns and a rewritten file
+    by its new inode, but touching or copying an unchanged dataset also invalidates the cache.
+    full=True hashes the whole content instead (and ignores mtime and inode): exact and stable
+    across copies, but it reads the entire dataset on every open.
+    """
+    sha1 = hashlib.sha1()
+    for path in _source_files(data_path):
+        stat = os.stat(path)
+        header = [os.path.basename(path), stat.st_size] + ([] if full else [stat.st_mtime_ns, stat.st_ino])
+        sha1.update(":".join(map(str, header)).encode())
+        with open(path, 'rb') as f:
+            if full:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+                continue
+            for offset in np.linspace(0, max(stat.st_size - block_bytes, 0), num_blocks).astype(np.int64):
+                f.seek(int(offset))
+                sha1.update(f.read(block_bytes))
+    return sha1.hexdigest()
+
+
+class FeatureCache(object):
+    """Sidecar cache of the scaled cumulant features of every dataset row.
+
+    Lives next to the dataset as <data_path>.features.npy (N, 10) float32 with a fill mask
+    <data_path>.features.mask.npy and <data_path>.features.json holding the key: source
+    fingerprint, FEATURIZER_VERSION and shape. A cache whose key does not match is rebuilt.
+    full_hash fingerprints the whole source instead of sampled blocks, see source_fingerprint.
+    Rows are featurized on first access (lookup) or by warm_up; both memmaps are shared
+    with DataLoader workers, so rows filled by one worker are seen by all.
+    """
+
+    def __init__(self, data_path, num_rows, num_features=len(CUMULANT_FEATURES), full_hash=False):
+        base = data_path.rstrip('/')
+        self.path = base + '.features.npy'
+        self.mask_path = base + '.features.mask.npy'
+        self.meta_path = base + '.features.json'
+        self.num_rows = num_rows
+        self.num_features = num_features
+        self.key = {'source': source_fingerprint(data_path, full=full_hash), 'featurizer_version': FEATURIZER_VERSION,
+                    'rows': num_rows, 'features': num_features}
+        if not self._valid():
+            self._create()
+        self._table = None
+        self._mask = None
+        self._pid = None
+
+    def _valid(self):
+        if not (os.path.exists(self.meta_path) and os.path.exists(self.path) and os.path.exists(self.mask_path)):
+            return False
+        with open(self.meta_path) as f:
+            return json.load(f) == self.key
+
+    def _create(self):
+        # key is written last, an interrupted rebuild is rebuilt again
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        for path, shape, dtype in ((self.path, (self.num_rows, self.num_features), np.float32),
+                                   (self.mask_path, (self.num_rows,), np.uint8)):
+            arr = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+            arr.flush()
+            del arr
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.key, f)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_table'] = None
+        state['_mask'] = None
+        state['_pid'] = None
+        return state
+
+    def _maps(self):
+        if self._table is None or self._pid != os.getpid():
+            self._table = np.load(self.path, mmap_mode='r+')
+            self._mask = np.load(self.mask_path, mmap_mode='r+')
+            self._pid = os.getpid()
+        return self._table, self._mask
+
+    @property
+    def filled(self):
+        return int(np.count_nonzero(self._maps()[1]))
+
+    def lookup(self, indices, data):
+        """features of the given rows; rows not cached yet are featurized from data and stored"""
+        table, mask = self._maps()
+        indices = np.asarray(indices, dtype=np.int64)
+        missing = mask[indices] == 0
+        if missing.any():
+            table[indices[missing]] = _featurize_rows(np.asarray(data)[missing])
+            mask[indices[missing]] = 1
+        return np.asarray(table[indices], dtype=np.float32)
+
+    def warm_up(self, dataset, block_rows=10000):
+        """fills all missing rows, reading the dataset in contiguous blocks"""
+        start_time = time.time()
+        _, mask = self._maps()
+        computed = 0
+        for start in range(0, self.num_rows, block_rows):
+            rows = np.arange(start, min(start + block_rows, self.num_rows))
+            if mask[rows].all():
+                continue
+            self.lookup(rows, dataset.read_rows(rows)[0])
+            computed += rows.size
+        self._table.flush()
+        self._mask.flush()
+        if computed:
+            print("featurized {} rows into {} in {:.1f}s".format(computed, self.path, time.time() - start_time))
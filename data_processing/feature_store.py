@@ -0,0 +1,231 @@
+import os
+import json
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from data_processing.batch_featurize import FEATURE_COLUMNS
+
+MANIFEST = 'manifest.json'
+STORE_VERSION = 1
+
+
+def _manifest_path(path):
+    return path if os.path.basename(path) == MANIFEST else os.path.join(path, MANIFEST)
+
+
+def is_feature_store(path):
+    """True if path is a feature store directory (or its manifest)"""
+    return os.path.isfile(_manifest_path(path))
+
+
+def _snr_value(snr):
+    """SNR as stored in the manifest: int if it is integral, else the exact float"""
+    snr = float(snr)
+    return int(snr) if snr.is_integer() else snr
+
+
+def _partition_name(snr, label):
+    # repr of a float is exact; '-' and '.' are spelled out to keep file names plain
+    snr = str(_snr_value(snr)).replace('-', 'm').replace('.', 'p')
+    return "snr{}_label{}".format(snr, int(label))
+
+
+class FeatureStoreWriter(object):
+    """Writes feature rows into a store partitioned by (SNR, label).
+
+    Every partition holds its features as an (n, F) float32 .npy and the original row
+    numbers as int64 .npy, so the row order of the source can be restored. Rows are
+    appended to raw files while writing and converted to .npy on close(); column means
+    and standard deviations are accumulated on the way for scaling at load time.
+    """
+
+    def __init__(self, path, columns=FEATURE_COLUMNS):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.columns = list(columns)
+        self.num_rows = 0
+        self._rows = {}   # partition -> (snr, label, rows written)
+        self._sum = np.zeros(len(self.columns))
+        self._sum_sq = np.zeros(len(self.columns))
+        # raw files of a crashed writer would be appended to, and an old manifest would
+        # describe partitions this writer replaces
+        self._remove_raw()
+        if os.path.exists(_manifest_path(path)):
+            os.remove(_manifest_path(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._remove_raw()
+
+    def _remove_raw(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.raw'):
+                os.remove(os.path.join(self.path, name))
+
+    def _raw(self, name, kind):
+        return os.path.join(self.path, "{}_{}.raw".format(kind, name))
+
+    def append(self, features, snrs, labels, row_ids=None):
+        features = np.asarray(features, dtype=np.float32)
+        snrs = np.asarray(snrs).reshape(-1)
+        labels = np.asarray(labels).reshape(-1)
+        if row_ids is None:
+            row_ids = np.arange(self.num_rows, self.num_rows + len(features))
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+
+        keys = np.stack([snrs, labels], axis=1)
+        for snr, label in np.unique(keys, axis=0):
+            rows = (snrs == snr) & (labels == label)
+            name = _partition_name(snr, label)
+            with open(self._raw(name, 'features'), 'ab') as f:
+                features[rows].tofile(f)
+            with open(self._raw(name, 'rows'), 'ab') as f:
+                row_ids[rows].tofile(f)
+            snr_, label_, count = self._rows.get(name, (_snr_value(snr), int(label), 0))
+            self._rows[name] = (snr_, label_, count + int(np.sum(rows)))
+
+        with np.errstate(invalid='ignore'):
+            self._sum += np.nansum(features, axis=0, dtype=np.float64)
+            self._sum_sq += np.nansum(features.astype(np.float64) ** 2, axis=0)
+        self.num_rows += len(features)
+
+    def close(self, block_rows=1 << 20):
+        partitions = []
+        for name, (snr, label, rows) in sorted(self._rows.items(), key=lambda item: item[1]):
+            files = {'features': "features_{}.npy".format(name), 'rows': "rows_{}.npy".format(name)}
+            for kind, dtype, shape in (('features', np.float32, (rows, len(self.columns))),
+                                       ('rows', np.int64, (rows,))):
+                raw = np.memmap(self._raw(name, kind), dtype=dtype, mode='r', shape=shape)
+                out = np.lib.format.open_memmap(os.path.join(self.path, files[kind]), mode='w+',
+                                                dtype=dtype, shape=shape)
+                for start in range(0, rows, block_rows):
+                    out[start:start + block_rows] = raw[start:start + block_rows]
+                out.flush()
+                del raw, out
+                os.remove(self._raw(name, kind))
+            partitions.append(dict(snr=snr, label=label, rows=rows, **files))
+
+        mean = self._sum / max(self.num_rows, 1)
+        std = np.sqrt(np.maximum(self._sum_sq / max(self.num_rows, 1) - mean ** 2, 0))
+        std[std == 0] = 1.0   # as preprocessing.scale
+        manifest = {'version': STORE_VERSION, 'columns': self.columns, 'num_rows': self.num_rows,
+                    'mean': mean.tolist(), 'std': std.tolist(), 'partitions': partitions}
+        # manifest goes last so a half written store is never picked up
+        tmp = _manifest_path(self.path) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, _manifest_path(self.path))
+        return manifest
+
+
+class FeatureStore(object):
+    """Read access to a store written by FeatureStoreWriter; partitions are memory-mapped"""
+
+    def __init__(self, path):
+        self.path = os.path.dirname(_manifest_path(path))
+        with open(_manifest_path(path)) as f:
+            self.manifest = json.load(f)
+        self.columns = self.manifest['columns']
+        self.num_rows = self.manifest['num_rows']
+        self.mean = np.asarray(self.manifest['mean'], dtype=np.float32)
+        self.std = np.asarray(self.manifest['std'], dtype=np.float32)
+
+    @property
+    def snrs(self):
+        return sorted(set(p['snr'] for p in self.manifest['partitions']))
+
+    def partitions(self, snrs=None, labels=None):
+        """partitions with an SNR in snrs and a label in labels (None = all)"""
+        return [p for p in self.manifest['partitions']
+                if (snrs is None or p['snr'] in snrs) and (labels is None or p['label'] in labels)]
+
+    def _open(self, partition, kind):
+        return np.load(os.path.join(self.path, partition[kind]), mmap_mode='r')
+
+    def scale(self, features):
+        """preprocessing.scale with the column statistics of the whole store"""
+        return (features - self.mean) / self.std
+
+    def iter_blocks(self, snrs=None, labels=None, block_rows=1 << 18, scale=True):
+        """yields (features, snrs, labels, row_ids) blocks of at most block_rows rows, partition by partition"""
+        for partition in self.partitions(snrs, labels):
+            features, row_ids = self._open(partition, 'features'), self._open(partition, 'rows')
+            for start in range(0, partition['rows'], block_rows):
+                block = np.asarray(features[start:start + block_rows])
+                n = len(block)
+                yield (self.scale(block) if scale else block,
+                       np.full(n, partition['snr'], dtype=np.float32),
+                       np.full(n, partition['label'], dtype=np.int64),
+                       np.asarray(row_ids[start:start + n]))
+
+    def load(self, snrs=None, labels=None, scale=True):
+        """
+        Selected rows in the row order of the source
+        :return: features (N, F) float32, snrs (N,), labels (N,), row_ids (N,)
+        """
+        selected = self.partitions(snrs, labels)
+        total = sum(p['rows'] for p in selected)
+        features = np.empty((total, len(self.columns)), dtype=np.float32)
+        snr = np.empty(total, dtype=np.float32)
+        label = np.empty(total, dtype=np.int64)
+        row_ids = np.empty(total, dtype=np.int64)
+        position = 0
+        for block in self.iter_blocks(snrs, labels, scale=scale):
+            n = len(block[0])
+            for out, values in zip((features, snr, label, row_ids), block):
+                out[position:position + n] = values
+            position += n
+        order = np.argsort(row_ids, kind='stable')
+        return features[order], snr[order], label[order], row_ids[order]
+
+
+def convert_feature_table(source, store_path, chunk_rows=200000):
+    """
+    Converts a featurized table into a feature store
+    :param source: .csv (SNR, label, feature columns, as featurize_data writes them),
+                   .parquet or .h5 (batch_featurize.write_features layout)
+    """
+    start_time = time.time()
+    hdf = None
+    if source.endswith('.csv'):
+        import pandas as pd
+        header = list(pd.read_csv(source, nrows=0).columns)
+        columns = [c for c in header if c not in ('SNR', 'label')]
+        dtypes = dict({c: np.float32 for c in columns}, SNR=np.float32, label=np.int64)
+        chunks = ((df[columns].values, df['SNR'].values, df['label'].values)
+                  for df in pd.read_csv(source, chunksize=chunk_rows, dtype=dtypes))
+    elif source.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(source)
+        columns = [c for c in parquet.schema.names if c not in ('SNR', 'label')]
+        chunks = ((df[columns].values, df['SNR'].values, df['label'].values)
+                  for df in (batch.to_pandas() for batch in parquet.iter_batches(batch_size=chunk_rows)))
+    else:
+        import h5py as h5
+        hdf = h5.File(source, 'r')
+        columns = list(hdf['features'].attrs['columns'])
+        chunks = ((hdf['features'][s:s + chunk_rows], hdf['snrs'][s:s + chunk_rows], hdf['labels'][s:s + chunk_rows])
+                  for s in range(0, len(hdf['labels']), chunk_rows))
+
+    with FeatureStoreWriter(store_path, columns) as writer:
+        for features, snrs, labels in chunks:
+            writer.append(features, snrs, labels)
+    if hdf is not None:
+        hdf.close()
+    print("converted {} rows in {:.1f}s".format(writer.num_rows, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Convert a featurized table into a partitioned feature store')
+    parser.add_argument('--input', type=str, required=True, help='.csv, .parquet or .h5 feature table')
+    parser.add_argument('--output', type=str, required=True, help='store directory')
+    parser.add_argument('--chunk_rows', type=int, default=200000)
+    args = parser.parse_args()
+    convert_feature_table(args.input, args.output, args.chunk_rows)
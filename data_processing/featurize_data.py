@@ -1,13 +1,11 @@
-import h5py as h5
 import numpy as np
 import scipy
 import csv
-from tqdm import tqdm
 import pandas as pd
 
-from data_processing.dataloader import label_idx
-from visualization.visualize import iq_to_complex
 from data_processing.Receiver import Receiver
+from data_processing.cumulants import moments, cumulants
+from data_processing.featurize_job import run_job
 
 dummyReceiver = Receiver(**{'bin_dir': '/home/rachneet/rf_featurized/',
                             'freq': 5750000000.0,
@@ -40,15 +38,10 @@ def featurize(df, i, row):
                'AM-DSB-WC', 'OOK', '16QAM']
 
     r = np.array(row)
-    r_star = np.conj(r)
 
     N = r.size
     x = np.arange(N)
 
-    # zero-mean
-    r10 = r - np.mean(r)
-    r11 = r_star - np.mean(r_star)
-
     # zero-crossings
     zc_real = (np.sign(r.real) * np.roll(np.sign(r.real), 1)) < 0
     zc_imag = (np.sign(r.imag) * np.roll(np.sign(r.imag), 1)) < 0
@@ -67,13 +60,9 @@ def featurize(df, i, row):
     A_CN = A_N - 1  # centered normalized amplitude
     A_CN_nw = A_CN[x_nw]  # centered normalized amplitude of non-weak samples
 
-    # PSD of Amplitude
-    fs_A, F1_A_CN = dummyReceiver.calculate_spectrum(data=A_CN, n_fft=N_s)
-    F1_A_CN = np.abs(F1_A_CN)
-    fs_A, F2_A_CN = dummyReceiver.calculate_spectrum(data=A_CN ** 2, n_fft=N_s)
-    F2_A_CN = np.abs(F2_A_CN)
-    fs_A, F4_A_CN = dummyReceiver.calculate_spectrum(data=A_CN ** 4, n_fft=N_s)
-    F4_A_CN = np.abs(F4_A_CN)
+    # PSD of Amplitude and spectrogram of the signal, one FFT pass
+    fs, spectra = dummyReceiver.calculate_spectra(np.stack([A_CN, A_CN ** 2, A_CN ** 4, r]), n_fft=N_s)
+    F1_A_CN, F2_A_CN, F4_A_CN, per = np.abs(spectra)
 
     # Phase
     # my interpretation
@@ -91,7 +80,6 @@ def featurize(df, i, row):
     f_CN = (f - mu_f) / (1 / T_s)
 
     # Spectrogram
-    fs, per = dummyReceiver.calculate_spectrum(data=r, n_fft=N_s)
     R = per[abs(fs) <= dummyReceiver.bw_signal / 2] / N_s
     fs = fs[abs(fs) <= dummyReceiver.bw_signal / 2]
 
@@ -101,22 +89,11 @@ def featurize(df, i, row):
     # include noise in sigma!!!
 
     # Moments
-
-    r20 = r10 * r10
-    r21 = r10 * r11
-    r22 = r11 * r11
-    r40 = r20 * r20
-
-    M20 = (1 / N) * np.sum(r20)
-    M21 = (1 / N) * np.sum(r21)
-    M22 = (1 / N) * np.sum(r22)
-    M40 = (1 / N) * np.sum(r40)
-    M41 = (1 / N) * np.sum(r20 * r21)
-    M42 = (1 / N) * np.sum(r20 * r22)
-    M60 = (1 / N) * np.sum(r40 * r20)
-    M61 = (1 / N) * np.sum(r40 * r21)
-    M62 = (1 / N) * np.sum(r40 * r22)
-    M63 = (1 / N) * np.sum(r20 * r10 * r22 * r11)
+    M = moments(r[np.newaxis])
+    M = {k: v[0] for k, v in M.items()}
+    C = cumulants(M)
+    r21 = M['r21']
+    M21 = M['M21']
 
     ########################################################################################
     # Features
@@ -149,22 +126,19 @@ def featurize(df, i, row):
     df.loc[i, "PAPR"] = np.abs(np.max(r21)) / np.abs(M21)
 
     # Statistical Features
-    df.loc[i, "$\hat{C}_{20}$"] = np.abs(M20)
-    df.loc[i, "$\hat{C}_{21}$"] = np.abs(M21)
+    df.loc[i, "$\hat{C}_{20}$"] = C['C20']
+    df.loc[i, "$\hat{C}_{21}$"] = C['C21']
 
-    df.loc[i, "$\\nu_{42}$"] = np.abs(M42 / np.abs(M21))
+    df.loc[i, "$\\nu_{42}$"] = C['mu_42']
 
-    df.loc[i, "$|\widetilde{C}_{40}|$"] = np.abs((-3 * M20 ** 2 + M40) / np.abs(M21) ** 2)
-    df.loc[i, "$|\widetilde{C}_{41}|$"] = np.abs((-3 * M21 * M20 + M41) / np.abs(M21) ** 2)
-    df.loc[i, "$\widetilde{C}_{42}$"] = np.abs((-2 * M21 ** 2 - M22 * M20 + M42) / np.abs(M21) ** 2)
+    df.loc[i, "$|\widetilde{C}_{40}|$"] = C['C40']
+    df.loc[i, "$|\widetilde{C}_{41}|$"] = C['C41']
+    df.loc[i, "$\widetilde{C}_{42}$"] = C['C42']
 
-    df.loc[i, "$|\widetilde{C}_{60}|$"] = np.abs((30 * M20 ** 3 - 15 * M20 * M40 + M60) / np.abs(M21) ** 3)
-    df.loc[i, "$|\widetilde{C}_{61}|$"] = np.abs(
-        (30 * M20 ** 2 * M21 - 14 * M20 * M41 - M40 * M21 + M61) / np.abs(M21) ** 3)
-    df.loc[i, "$|\widetilde{C}_{62}|$"] = np.abs(
-        (24 * M21 ** 2 * M20 + 6 * M22 * M20 ** 2 - 6 * M20 * M42 - 8 * M21 * M41 - M22 * M40 + M62) / np.abs(M21) ** 3)
-    df.loc[i, "$\widetilde{C}_{63}$"] = np.abs(
-        (12 * M21 ** 3 + 12 * M22 * M21 * M20 - 9 * M42 * M21 + M63) / np.abs(M21) ** 3)
+    df.loc[i, "$|\widetilde{C}_{60}|$"] = C['C60']
+    df.loc[i, "$|\widetilde{C}_{61}|$"] = C['C61']
+    df.loc[i, "$|\widetilde{C}_{62}|$"] = C['C62']
+    df.loc[i, "$\widetilde{C}_{63}$"] = C['C63']
 
 
 def filter_from_csv(path):
@@ -175,40 +149,11 @@ def filter_from_csv(path):
     print(df.head())
 
 
-def main():
-    dataset = "/home/rachneet/datasets/dataset_deepsig_vier_new.hdf5"
-    h5fr = h5.File(dataset, 'r')
-    dset1 = list(h5fr.keys())[0]
-    dset2 = list(h5fr.keys())[1]
-    dset3 = list(h5fr.keys())[2]
-
-    data_len = len(h5fr[dset2][:])
-    chunk_size = 10000
-    num_chunks = int(data_len/chunk_size)
-    remaining_samples = data_len - (num_chunks * chunk_size)
-    print(num_chunks, remaining_samples)
-    final_df = pd.DataFrame()
-    remaining_data = data_len
-    for chunk in tqdm(range(num_chunks+1)):
-        df = pd.DataFrame()
-        if remaining_data >= chunk_size:
-            iq = h5fr[dset1][chunk_size*chunk: chunk_size*(chunk+1)]
-            label = h5fr[dset2][chunk_size*chunk: chunk_size*(chunk+1)]
-            snr = h5fr[dset3][chunk_size*chunk: chunk_size*(chunk+1)]
-        else:
-            iq = h5fr[dset1][-remaining_data:]
-            label = h5fr[dset2][-remaining_data:]
-            snr = h5fr[dset3][-remaining_data:]
-
-        df['SNR'] = [val for val in snr]
-        df['label'] = [label_idx(sublist) for sublist in label]
-        for i,row in enumerate(tqdm(iq)):
-            featurize(df, i, iq_to_complex(row))
-        final_df = final_df.append(df, ignore_index=True)
-        remaining_data -= chunk_size
-
-    final_df.to_csv("/home/rachneet/featurized_data/dataset_deepsig_digital_featurized.csv",
-                    encoding='utf-8', index=False)
+def main(dataset="/home/rachneet/datasets/dataset_deepsig_vier_new.hdf5",
+         output_path="/home/rachneet/featurized_data/dataset_deepsig_digital_featurized.parquet",
+         chunk_size=10000, num_workers=None):
+    """featurizes a dataset in parallel, resumable chunks and writes a columnar table"""
+    run_job(dataset, output_path, chunk_size=chunk_size, num_workers=num_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+import os
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from multiprocessing import Pool
+
+import h5py as h5
+import numpy as np
+
+from data_processing.batch_featurize import FEATURE_COLUMNS, featurize_batch, features_frame
+from data_processing.feature_store import FeatureStoreWriter
+
+_h5_file = None   # input file handle of a worker process
+
+
+def _dataset_keys(h5fr):
+    # iq, labels, snrs in file order, as featurize_data.main reads them
+    keys = list(h5fr.keys())
+    return keys[0], keys[1], keys[2]
+
+
+def part_path(work_dir, start, stop):
+    # both bounds in the name: a rerun with another chunk_size never picks up parts of this one
+    return os.path.join(work_dir, "part_{:012d}_{:012d}.npz".format(start, stop))
+
+
+def _done_marker(work_dir, start, stop):
+    return part_path(work_dir, start, stop) + ".done"
+
+
+def _featurize_chunk(task):
+    """featurizes rows [start, stop) and writes them to their own part file"""
+    global _h5_file
+    dataset, start, stop, work_dir = task
+    start_time = time.time()
+    if _h5_file is None or _h5_file.filename != dataset:
+        _h5_file = h5.File(dataset, 'r')
+    dset1, dset2, dset3 = _dataset_keys(_h5_file)
+
+    features = featurize_batch(_h5_file[dset1][start:stop])
+    labels = np.argmax(_h5_file[dset2][start:stop], axis=1)
+    snrs = np.asarray(_h5_file[dset3][start:stop]).reshape(-1)
+
+    path = part_path(work_dir, start, stop)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, features=features, labels=labels, snrs=snrs)
+    os.replace(path + ".tmp", path)
+    open(_done_marker(work_dir, start, stop), "w").close()
+    return start, stop - start, time.time() - start_time, os.getpid()
+
+
+def merge_parts(parts, output_path):
+    """
+    Merges part files in the given order into one feature table
+    :param output_path: .parquet or .h5/.hdf5, same layout as batch_featurize.write_features,
+                        or a directory (no extension) for a feature_store.FeatureStore
+    """
+    if os.path.splitext(output_path.rstrip('/'))[1] == '':
+        with FeatureStoreWriter(output_path, FEATURE_COLUMNS) as writer:
+            for path in parts:
+                with np.load(path) as part:
+                    writer.append(part['features'], part['snrs'], part['labels'])
+        return
+
+    if output_path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        for path in parts:
+            with np.load(path) as part:
+                table = pa.Table.from_pandas(features_frame(part['features'], part['snrs'], part['labels']),
+                                             preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+        return
+
+    rows = []
+    for path in parts:
+        with np.load(path) as part:
+            rows.append(len(part['labels']))
+    with h5.File(output_path, 'w') as hdf:
+        position = 0
+        for path, n in zip(parts, rows):
+            with np.load(path) as part:
+                if position == 0:
+                    for key in ('features', 'snrs', 'labels'):
+                        hdf.create_dataset(key, shape=(sum(rows),) + part[key].shape[1:], dtype=part[key].dtype,
+                                           chunks=True, compression='gzip')
+                    hdf['features'].attrs['columns'] = FEATURE_COLUMNS
+                for key in ('features', 'snrs', 'labels'):
+                    hdf[key][position:position + n] = part[key]
+            position += n
+
+
+def run_job(dataset, output_path, work_dir=None, chunk_size=10000, num_workers=None):
+    """
+    Featurizes an HDF5 dataset with a process pool, one part file per chunk of rows
+    :param work_dir: directory for part files and completion markers (default: output_path + '.parts')
+    :param num_workers: worker processes, None = all cores
+    Chunks with a completion marker are skipped, so an interrupted job continues where it stopped.
+    """
+    work_dir = work_dir or output_path.rstrip("/") + ".parts"
+    os.makedirs(work_dir, exist_ok=True)
+    with h5.File(dataset, 'r') as h5fr:
+        data_len = len(h5fr[_dataset_keys(h5fr)[1]])
+
+    chunks = [(start, min(start + chunk_size, data_len)) for start in range(0, data_len, chunk_size)]
+    pending = [(dataset, start, stop, work_dir) for start, stop in chunks
+               if not os.path.exists(_done_marker(work_dir, start, stop))]
+    print("{} of {} chunks already featurized".format(len(chunks) - len(pending), len(chunks)))
+
+    worker_rows, worker_time = defaultdict(int), defaultdict(float)
+    start_time = time.time()
+    with Pool(num_workers) as pool:
+        for n, (start, rows, seconds, pid) in enumerate(pool.imap_unordered(_featurize_chunk, pending)):
+            worker_rows[pid] += rows
+            worker_time[pid] += seconds
+            print("chunk {} done: {} rows in {:.1f}s ({:.0f} rows/s) [{}/{}]".format(
+                start, rows, seconds, rows / seconds, n + 1, len(pending)))
+
+    for pid in sorted(worker_rows):
+        print("worker {}: {} rows, {:.0f} rows/s".format(pid, worker_rows[pid], worker_rows[pid] / worker_time[pid]))
+    if pending:
+        elapsed = time.time() - start_time
+        print("featurized {} rows in {:.1f}s ({:.0f} rows/s)".format(sum(worker_rows.values()), elapsed,
+                                                                     sum(worker_rows.values()) / elapsed))
+
+    merge_parts([part_path(work_dir, start, stop) for start, stop in chunks], output_path)
+    print("feature table written to {}".format(output_path))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Parallel, resumable featurization of an HDF5 dataset')
+    parser.add_argument('--input', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True, help='.parquet or .h5 feature table, or a feature store directory')
+    parser.add_argument('--work_dir', type=str, default=None)
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+    run_job(args.input, args.output, args.work_dir, args.chunk_size, args.num_workers)
@@ -1,20 +1,108 @@
+import functools
 import scipy.signal
 import numpy as np
 
+# low-pass used for all recordings
+NUMTAPS = 100
+SRATE = 50000000
+BW_SIGNAL = 20000000
 
-def filter_samples(data):
-    # filter config
-    numtaps = 100
-    srate = 50000000
-    bw_signal = 20000000
 
-    # using a low pass filter
+@functools.lru_cache(maxsize=32)
+def design_lowpass(numtaps, cutoff, srate):
+    """firwin low-pass taps, designed once per (numtaps, cutoff, srate)"""
     b = scipy.signal.firwin(numtaps=numtaps,
-                                cutoff=bw_signal / 2,
-                                pass_zero=True,
-                                fs=srate
-                                )
+                            cutoff=cutoff,
+                            pass_zero=True,
+                            fs=srate
+                            )
+    b.setflags(write=False)   # shared between callers
+    return b
+
+
+def _taps_for(b, data):
+    # float32 taps for single precision data so oaconvolve stays in single precision
+    if data.dtype in (np.float32, np.complex64):
+        return b.astype(np.float32)
+    return b
+
+
+def fir_filter(data, b, axis=-1, dtype=None):
+    """
+    FIR filtering with the output of scipy.signal.convolve(data, b, mode='same')
+    :param data: 1-D recording or a batch of recordings (filtered along axis)
+    :param b: filter taps
+    :param dtype: optional dtype to filter in, e.g. np.complex64 for the faster single precision path
+    :return: filtered data, same shape as data
+    """
+    data = np.asarray(data)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    taps = _taps_for(np.asarray(b), data)
+    if data.ndim > 1:
+        shape = [1] * data.ndim
+        shape[axis] = taps.size
+        taps = taps.reshape(shape)
+    return scipy.signal.oaconvolve(data, taps, mode='same', axes=axis)
+
+
+def filter_samples(data, dtype=None, axis=-1):
+    # using a low pass filter
+    b = design_lowpass(NUMTAPS, BW_SIGNAL / 2, SRATE)
+    return fir_filter(data, b, axis=axis, dtype=dtype)
+
+
+def filter_recordings(recordings, dtype=None):
+    """filters a list of recordings; recordings of equal length are filtered as one batch"""
+    recordings = [np.asarray(r) for r in recordings]
+    out = [None] * len(recordings)
+    by_length = {}
+    for i, r in enumerate(recordings):
+        by_length.setdefault(r.shape, []).append(i)
+    for idx in by_length.values():
+        batch = filter_samples(np.stack([recordings[i] for i in idx]), dtype=dtype)
+        for row, i in enumerate(idx):
+            out[i] = batch[row]
+    return out
+
+
+class StreamingFIR(object):
+    """Overlap-add FIR filter for blocks of a long capture.
+
+    Concatenating the outputs of process() for consecutive blocks and of flush() at the end
+    gives the same samples as convolve(whole_capture, b, mode='same'), without holding the
+    capture in memory.
+    """
+
+    def __init__(self, b, dtype=None):
+        self.b = np.asarray(b)
+        self.dtype = dtype
+        self.delay = (self.b.size - 1) // 2   # start of the 'same' window inside the full output
+        self.reset()
+
+    def reset(self):
+        self._tail = None
+        self._skip = self.delay
+
+    def process(self, block):
+        block = np.asarray(block)
+        if self.dtype is not None:
+            block = block.astype(self.dtype, copy=False)
+        full = scipy.signal.oaconvolve(block, _taps_for(self.b, block), mode='full')
+        if self._tail is not None:
+            full[:self._tail.size] += self._tail
+        out, self._tail = full[:block.size], full[block.size:]
 
-    filtered_data = scipy.signal.convolve(data,b,mode='same')
+        if self._skip:
+            skipped = min(self._skip, out.size)
+            out = out[skipped:]
+            self._skip -= skipped
+        return out
 
-    return filtered_data
+    def flush(self):
+        """last samples of the 'same' output; resets the filter"""
+        if self._tail is None:
+            return np.array([])
+        out = self._tail[self._skip:self.delay]
+        self.reset()
+        return out
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py as h5
+import numpy as np
+
+CHUNK_BYTES = 1 << 20   # ~1MB gzip chunks, whole rows each
+
+
+def row_chunk_rows(row_shape, dtype, total_rows, target_bytes=CHUNK_BYTES):
+    """rows per chunk so that a chunk holds whole rows and about target_bytes"""
+    row_bytes = int(np.prod(row_shape)) * np.dtype(dtype).itemsize
+    return int(max(1, min(total_rows, target_bytes // max(row_bytes, 1))))
+
+
+class PreallocatedWriter(object):
+    """Writes row blocks into HDF5 datasets preallocated to their final length.
+
+    Datasets are created on the first write from the dtype and row shape of the arrays,
+    with row-aligned chunks of about chunk_bytes. Every dataset buffers its incoming rows
+    and flushes them on its own chunk boundaries, in blocks of up to block_chunks chunks,
+    so no gzip chunk is written twice and each buffer stays below block_chunks * chunk_bytes.
+    """
+
+    def __init__(self, path, total_rows, chunk_bytes=CHUNK_BYTES, block_chunks=16, compression='gzip'):
+        self.path = path
+        self.total_rows = total_rows
+        self.chunk_bytes = chunk_bytes
+        self.block_chunks = block_chunks
+        self.compression = compression
+        self.rows = 0           # rows received
+        self.block_rows = None  # {dataset: rows flushed at once}
+        self._position = {}
+        self._buffer = {}
+        self._buffered = {}
+        self._file = h5.File(path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _create(self, arrays):
+        self.block_rows = {}
+        for key, arr in arrays.items():
+            rows = row_chunk_rows(arr.shape[1:], arr.dtype, self.total_rows, self.chunk_bytes)
+            self._file.create_dataset(key, shape=(self.total_rows,) + arr.shape[1:], dtype=arr.dtype,
+                                      chunks=(rows,) + arr.shape[1:], maxshape=(None,) + arr.shape[1:],
+                                      compression=self.compression)
+            self.block_rows[key] = rows * self.block_chunks
+            self._position[key] = 0
+            self._buffer[key] = []
+            self._buffered[key] = 0
+
+    def write(self, **arrays):
+        """appends rows; all arrays must have the same number of rows"""
+        if self.block_rows is None:
+            self._create(arrays)
+        rows = len(next(iter(arrays.values())))
+        if self.rows + rows > self.total_rows:
+            raise ValueError("{} rows exceed the preallocated {}".format(self.rows + rows, self.total_rows))
+        self.rows += rows
+        for key, arr in arrays.items():
+            self._buffer[key].append(arr)
+            self._buffered[key] += len(arr)
+            if self._buffered[key] >= self.block_rows[key]:
+                chunk_rows = self._file[key].chunks[0]
+                self._flush(key, self._buffered[key] - self._buffered[key] % chunk_rows)
+
+    def _flush(self, key, rows):
+        if rows == 0:
+            return
+        parts = self._buffer[key]
+        block = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        position = self._position[key]
+        self._file[key][position:position + rows] = block[:rows]
+        self._buffer[key] = [block[rows:]] if rows < len(block) else []
+        self._buffered[key] -= rows
+        self._position[key] = position + rows
+
+    def close(self):
+        if self._file is None:
+            return
+        for key in self._buffer:
+            self._flush(key, self._buffered[key])
+        if self.block_rows is not None and self.rows != self.total_rows:
+            print("Warning: wrote {} of {} preallocated rows".format(self.rows, self.total_rows))
+            for key in self._file:
+                self._file[key].resize(self.rows, axis=0)
+        self._file.close()
+        self._file = None
+
+
+def prefetch(items, load_fn):
+    """yields load_fn(item) for every item while the next item is loaded in a background thread"""
+    items = list(items)
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load_fn, items[0])
+        for nxt in items[1:]:
+            result = future.result()
+            future = executor.submit(load_fn, nxt)
+            yield result
+        yield future.result()
+
+
+def npz_rows(path, key='labels'):
+    """number of rows of an npz file without loading its iq matrix"""
+    with np.load(path) as data:
+        return len(data[key])
+
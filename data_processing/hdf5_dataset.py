@@ -0,0 +1,380 @@
+import os
+import time
+import math
+from argparse import ArgumentParser
+
+import h5py as h5
+import numpy as np
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.sampler import SubsetRandomSampler
+
+from data_processing.iq_conversion import iq_to_complex
+from data_processing.cumulants import cumulant_features, scale_rows
+
+
+def _featurize_rows(data):
+    """cumulant features of every row, scaled per sample like the original pipeline"""
+    r = iq_to_complex(data, np.complex128)
+    # normalised by the number of I and Q values, as intf_processing.featurize does
+    return scale_rows(cumulant_features(r, norm=2 * r.shape[1])).astype(np.float32)
+
+
+def _batch_features(dataset, indices, data):
+    """features of a batch: from the dataset's feature cache or feature file if it has one, else computed"""
+    if dataset.feature_cache is not None:
+        return dataset.feature_cache.lookup(indices, data)
+    if dataset.feature_path is None:
+        return _featurize_rows(data)
+    if dataset._feature_table is None or dataset._feature_pid != os.getpid():
+        dataset._feature_table = np.load(dataset.feature_path, mmap_mode='r')
+        dataset._feature_pid = os.getpid()
+    return np.asarray(dataset._feature_table[np.asarray(indices, dtype=np.int64)], dtype=np.float32)
+
+
+def write_feature_file(dataset, feature_path, block_rows=10000):
+    """
+    Precomputes the scaled cumulant features of every row into an (N, 10) float32 .npy file
+    :param dataset: BatchedDatasetFromHDF5 or ShardDataset
+    """
+    table = None
+    for start in range(0, len(dataset), block_rows):
+        rows = np.arange(start, min(start + block_rows, len(dataset)))
+        features = _featurize_rows(dataset.read_rows(rows)[0])
+        if table is None:
+            table = np.lib.format.open_memmap(feature_path + '.tmp.npy', mode='w+', dtype=np.float32,
+                                              shape=(len(dataset), features.shape[1]))
+        table[rows] = features
+    table.flush()
+    del table
+    os.replace(feature_path + '.tmp.npy', feature_path)
+
+
+class DatasetFromHDF5(Dataset):
+    """Per-sample HDF5 dataset; opens the file on every access"""
+
+    def __init__(self, filename, iq, labels, snrs, feature_flag=False):
+        self.filename = filename
+        self.iq = iq
+        self.labels = labels
+        self.snrs = snrs
+        self.features = np.array([])
+        self.feature_flag = feature_flag
+
+    def __len__(self):
+        with h5.File(self.filename, 'r') as file:
+            lens = len(file[self.labels])
+        return lens
+
+    def __getitem__(self, item):
+        with h5.File(self.filename, 'r') as file:
+            data = file[self.iq][item]
+            label = file[self.labels][item]
+            snr = file[self.snrs][item]
+            features = self.features
+
+        # --------------------- Featurize data ------------------------
+        if self.feature_flag:
+            features = _featurize_rows(data[np.newaxis])[0]
+        # -------------------------------------------------------------
+        data = data.astype(np.float32)
+        label = label.astype(np.float32)
+        snr = snr.astype(np.int8)
+
+        if self.feature_flag:
+            return data, label, snr, features
+        else:
+            return data, label, snr
+
+
+class BatchedDatasetFromHDF5(Dataset):
+    """HDF5 dataset that keeps one file handle open per process and serves whole batches.
+
+    Indexing with a single integer behaves like DatasetFromHDF5. Indexing with a sorted
+    list/array of row indices returns the complete batch, fetched with one selection
+    per HDF5 dataset. Combine with SortedBatchSampler and DataLoader(batch_size=None)
+    so every worker reads one batch per call instead of one row.
+    """
+
+    def __init__(self, filename, iq, labels, snrs, feature_flag=False, rdcc_nbytes=None, feature_path=None):
+        self.filename = filename
+        self.iq = iq
+        self.labels = labels
+        self.snrs = snrs
+        self.feature_flag = feature_flag
+        self.feature_path = feature_path   # precomputed features (write_feature_file), None = compute
+        self.feature_cache = None   # feature_cache.FeatureCache, filled on first access
+        self.rdcc_nbytes = rdcc_nbytes   # HDF5 chunk cache per dataset, None = library default
+        self._file = None
+        self._pid = None
+        self._feature_table = None
+        self._feature_pid = None
+        with h5.File(filename, 'r') as file:
+            self.length = len(file[labels])
+            dset = file[iq]
+            self.chunk_rows = dset.chunks[0] if dset.chunks else 1   # rows per HDF5 chunk of iq
+            self.row_nbytes = int(np.prod(dset.shape[1:])) * dset.dtype.itemsize
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        # workers get a copy without the handle and reopen it lazily
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        state['_feature_table'] = None
+        state['_feature_pid'] = None
+        return state
+
+    @property
+    def file(self):
+        # h5py handles must not be shared across fork, reopen once per process
+        if self._file is None or self._pid != os.getpid():
+            kwargs = {}
+            if self.rdcc_nbytes is not None:
+                kwargs = {'rdcc_nbytes': int(self.rdcc_nbytes), 'rdcc_nslots': 1000003, 'rdcc_w0': 0.0}
+            self._file = h5.File(self.filename, 'r', **kwargs)
+            self._pid = os.getpid()
+        return self._file
+
+    def close(self):
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._pid = None
+
+    def read_rows(self, indices):
+        """reads the given rows of iq, labels and snrs; returns them in the requested order"""
+        indices = np.asarray(indices, dtype=np.int64)
+        rows, inverse = np.unique(indices, return_inverse=True)   # h5py wants increasing indices
+
+        if rows[-1] - rows[0] + 1 == rows.size:
+            selection = slice(int(rows[0]), int(rows[-1]) + 1)
+        else:
+            selection = rows
+
+        file = self.file
+        data = file[self.iq][selection]
+        label = file[self.labels][selection]
+        snr = file[self.snrs][selection]
+
+        if rows.size != indices.size or not np.array_equal(rows, indices):
+            data, label, snr = data[inverse], label[inverse], snr[inverse]
+        return data, label, snr
+
+    def __getitem__(self, item):
+        if np.ndim(item) == 0:
+            batch = self._convert([item], *self.read_rows([item]))
+            return tuple(value[0] for value in batch)
+        return self._convert(item, *self.read_rows(item))
+
+    def _convert(self, indices, data, label, snr):
+        data = data.astype(np.float32, copy=False)
+        label = label.astype(np.float32, copy=False)
+        snr = snr.astype(np.int8, copy=False)
+        if self.feature_flag:
+            return data, label, snr, _batch_features(self, indices, data)
+        return data, label, snr
+
+
+class SortedBatchSampler(Sampler):
+    """Yields batches of row indices, each sorted ascending for a single HDF5 read.
+
+    The subset is reshuffled every epoch (seed + epoch) when shuffle is set; use with
+    DataLoader(dataset, sampler=SortedBatchSampler(...), batch_size=None).
+    """
+
+    def __init__(self, indices, batch_size, shuffle=True, drop_last=False, seed=4):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            indices = indices[rng.permutation(indices.size)]
+            self.epoch += 1
+        for start in range(0, indices.size, self.batch_size):
+            batch = indices[start:start + self.batch_size]
+            if self.drop_last and batch.size < self.batch_size:
+                break
+            yield np.sort(batch)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.indices.size // self.batch_size
+        return int(math.ceil(self.indices.size / self.batch_size))
+
+
+def batched_loader(dataset, sampler, num_workers=0, pin_memory=False):
+    """DataLoader that hands whole batches from a batch sampler to the dataset"""
+    return DataLoader(dataset, sampler=sampler, batch_size=None,
+                      num_workers=num_workers, pin_memory=pin_memory)
+
+
+class ChunkShuffleSampler(Sampler):
+    """Batch sampler for gzip-chunked HDF5 files that decodes every chunk about once per epoch.
+
+    Rows of ``indices`` are grouped by the HDF5 chunk (``chunk_rows`` rows) they are stored
+    in. Each epoch the chunk order is shuffled, then windows of ``buffer_chunks`` chunks are
+    shuffled row-wise and cut into sorted batches. The dataset's chunk cache has to hold
+    a window (see chunk_cache_bytes). With num_workers > 0 the chunks are dealt to one
+    stream per worker and the streams are interleaved in the round-robin order in which
+    the DataLoader dispatches batches, so every worker keeps reading its own chunks.
+    Rows left over at the end of the streams are emitted last.
+    """
+
+    def __init__(self, indices, chunk_rows, batch_size, buffer_chunks=8, shuffle=True,
+                 drop_last=False, num_workers=0, seed=4):
+        self.indices = np.sort(np.asarray(indices, dtype=np.int64))
+        self.chunk_rows = max(1, int(chunk_rows))
+        self.batch_size = batch_size
+        self.buffer_chunks = buffer_chunks
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_streams = max(1, num_workers)
+        self.seed = seed
+        self.epoch = 0
+
+        # rows of the subset grouped by chunk
+        _, starts = np.unique(self.indices // self.chunk_rows, return_index=True)
+        self.groups = np.split(self.indices, starts[1:]) if self.indices.size else []
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _stream(self, chunks, rng, leftovers):
+        """full batches from one stream of chunks; the remainder is appended to leftovers"""
+        carry = np.array([], dtype=np.int64)
+        for start in range(0, len(chunks), self.buffer_chunks):
+            window = [carry] + [self.groups[c] for c in chunks[start:start + self.buffer_chunks]]
+            window = np.concatenate(window)
+            if self.shuffle:
+                window = window[rng.permutation(window.size)]
+            n_full = window.size - window.size % self.batch_size
+            for b in range(0, n_full, self.batch_size):
+                yield np.sort(window[b:b + self.batch_size])
+            carry = window[n_full:]
+        leftovers.append(carry)
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            self.epoch += 1
+        order = rng.permutation(len(self.groups)) if self.shuffle else np.arange(len(self.groups))
+
+        leftovers = []
+        streams = [self._stream(order[w::self.num_streams], rng, leftovers) for w in range(self.num_streams)]
+        while streams:
+            for stream in list(streams):
+                batch = next(stream, None)
+                if batch is None:
+                    streams.remove(stream)
+                else:
+                    yield batch
+
+        rest = np.concatenate(leftovers) if leftovers else np.array([], dtype=np.int64)
+        for b in range(0, rest.size, self.batch_size):
+            batch = rest[b:b + self.batch_size]
+            if self.drop_last and batch.size < self.batch_size:
+                break
+            yield np.sort(batch)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.indices.size // self.batch_size
+        return int(math.ceil(self.indices.size / self.batch_size))
+
+
+def chunk_cache_bytes(dataset, buffer_chunks):
+    """HDF5 chunk cache size that keeps a ChunkShuffleSampler window (plus carry) decoded"""
+    return 2 * buffer_chunks * dataset.chunk_rows * dataset.row_nbytes
+
+
+def split_loaders(dataset, batch_size, num_workers=0, valid_fraction=0.05, test_fraction=0.2,
+                  buffer_chunks=8, seed=4):
+    """
+    Seeded train/val/test split of a batched dataset with chunk-aware sampling
+    :param dataset: BatchedDatasetFromHDF5 or ShardDataset (anything with chunk_rows/row_nbytes)
+    :param buffer_chunks: number of decoded chunks shuffled together
+    :return: train, val and test DataLoaders
+    """
+    num_train = len(dataset)
+    indices = np.arange(num_train)
+    val_split = int(math.floor(valid_fraction * num_train))
+    test_split = val_split + int(math.floor(test_fraction * num_train))
+    np.random.RandomState(seed).shuffle(indices)   # same permutation as np.random.seed(4); shuffle(list)
+    train_idx, valid_idx, test_idx = indices[test_split:], indices[:val_split], indices[val_split:test_split]
+
+    if dataset.chunk_rows <= 1:
+        # nothing to decompress (contiguous HDF5 or memmap shards): plain sorted random batches
+        train_sampler = SortedBatchSampler(train_idx, batch_size, shuffle=True, seed=seed)
+        valid_sampler = SortedBatchSampler(valid_idx, batch_size, shuffle=False)
+        test_sampler = SortedBatchSampler(test_idx, batch_size, shuffle=False)
+    else:
+        if getattr(dataset, 'rdcc_nbytes', False) is None:
+            dataset.rdcc_nbytes = chunk_cache_bytes(dataset, buffer_chunks)
+            dataset.close()
+        train_sampler = ChunkShuffleSampler(train_idx, dataset.chunk_rows, batch_size, buffer_chunks,
+                                            shuffle=True, num_workers=num_workers, seed=seed)
+        valid_sampler = ChunkShuffleSampler(valid_idx, dataset.chunk_rows, batch_size, buffer_chunks,
+                                            shuffle=False, num_workers=num_workers, seed=seed)
+        test_sampler = ChunkShuffleSampler(test_idx, dataset.chunk_rows, batch_size, buffer_chunks,
+                                           shuffle=False, num_workers=num_workers, seed=seed)
+    return (batched_loader(dataset, train_sampler, num_workers=num_workers),
+            batched_loader(dataset, valid_sampler, num_workers=num_workers),
+            batched_loader(dataset, test_sampler, num_workers=num_workers))
+
+
+# ----------------------------------------------- Benchmark ---------------------------------------------------------
+
+def _time_loader(loader, num_batches):
+    samples = 0
+    iterator = iter(loader)
+    next(iterator)   # exclude worker start-up
+    start = time.perf_counter()
+    for i, batch in enumerate(iterator):
+        samples += len(batch[0])
+        if i + 1 >= num_batches:
+            break
+    return samples / (time.perf_counter() - start)
+
+
+def compare_throughput(filename, batch_size=512, num_batches=50, num_workers=0):
+    """
+    Measures samples/sec of DatasetFromHDF5 + SubsetRandomSampler against
+    BatchedDatasetFromHDF5 + SortedBatchSampler on the same shuffled indices
+    :return: dict with samples/sec of both loaders and the speed-up
+    """
+    old_dataset = DatasetFromHDF5(filename, 'iq', 'labels', 'snrs')
+    new_dataset = BatchedDatasetFromHDF5(filename, 'iq', 'labels', 'snrs')
+    indices = np.random.RandomState(4).permutation(len(new_dataset))[:batch_size * (num_batches + 1)]
+
+    old_loader = DataLoader(old_dataset, batch_size=batch_size, num_workers=num_workers,
+                            sampler=SubsetRandomSampler(indices))
+    new_loader = batched_loader(new_dataset, SortedBatchSampler(indices, batch_size),
+                                num_workers=num_workers)
+
+    result = {'DatasetFromHDF5': _time_loader(old_loader, num_batches),
+              'BatchedDatasetFromHDF5': _time_loader(new_loader, num_batches)}
+    result['speedup'] = result['BatchedDatasetFromHDF5'] / result['DatasetFromHDF5']
+    for name, value in result.items():
+        print("{}: {:.1f}".format(name, value) + ("x" if name == 'speedup' else " samples/sec"))
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--data_path', default="/home/rachneet/rf_dataset_inets/mixed_all_impairments.h5")
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--num_workers', type=int, default=10)
+    args = parser.parse_args()
+    compare_throughput(args.data_path, args.batch_size, args.num_batches, args.num_workers)
@@ -1,17 +1,24 @@
 import os
 import sys
-import struct
+import time
 import numpy as np
 import logging
 import warnings
 import copy
 
 
-def read_binary(file_path, num_samples=-1):
+def binary_num_samples(file_path):
+    """number of IQ samples in a binary file of interleaved 32 bit floats"""
+    return int(os.stat(file_path).st_size / 8)  # each samples = 4 byte float (I) + 4 byte float (Q)
+
+
+def read_binary(file_path, num_samples=-1, offset=0, mmap=False):
     """
     reads a number of IQ samples from a binary file.
-    Assumed format of binary file: 32 bit floats.
-    If num_samples == -1 all samples from the files are read.
+    Assumed format of binary file: interleaved 32 bit floats (I, Q).
+    If num_samples == -1 all samples from offset to the end of the file are read.
+    offset: index of the first IQ sample to read
+    mmap: return a read-only np.memmap of the window instead of reading it into memory
     returns: np.array(size=num_samples, dtype=complex64)
     """
 
@@ -19,53 +26,96 @@ def read_binary(file_path, num_samples=-1):
         critical('sys', "File %s does not exist." % file_path)
         sys.exit()
 
-    statinfo = os.stat(file_path)
-    size = statinfo.st_size
-    total_samples = int(size / 8)  # each samples = 4 byte float (I) + 4 byte float (Q)
+    total_samples = binary_num_samples(file_path)
     if(num_samples == -1):
-        num_samples = total_samples
+        num_samples = total_samples - offset
 
-    #debug("OS", "Found %s with %r bytes" % (file_path, size))
+    assert (offset + num_samples <= total_samples),\
+        "trying to read %d samples at offset %d but file contains only %d samples" % (num_samples, offset,
+                                                                                       total_samples)
 
-    # some checks
-    assert (num_samples % 10) == 0,\
-        "make num_samples a multiple of 10"
-    assert (num_samples <= total_samples),\
-        "trying to read %d samples but file contains only %d samples" % (num_samples, total_samples)
+    # interleaved float32 I/Q has exactly the memory layout of complex64
+    if mmap:
+        return np.memmap(file_path, dtype=np.complex64, mode='r', offset=8 * offset, shape=(num_samples,))
 
-    batch_size = int(num_samples / 10)  # load files in 10% blocks
+    with open(file_path, "rb") as binary_file:
+        binary_file.seek(8 * offset)
+        data = np.fromfile(binary_file, dtype=np.complex64, count=num_samples)
 
-    # pre-allocate memory
-    data = np.array([0 + 0 * 1j] * num_samples, dtype=np.complex64)
+    return data
 
-    with open(file_path, "rb") as binary_file:
 
-        for i in np.arange(0, num_samples, batch_size):
-            binary_data = binary_file.read(8 * batch_size)
-            unpacked_data = np.array(struct.unpack('f' * batch_size * 2, binary_data))
-            data[i:i + batch_size].real = unpacked_data[::2]
-            data[i:i + batch_size].imag = unpacked_data[1::2]
+def iter_binary(file_path, chunk_samples, num_samples=-1, offset=0):
+    """
+    iterates over a binary IQ file in chunks of chunk_samples complex64 samples,
+    for files bigger than memory. The last chunk may be shorter.
+    """
+    total_samples = binary_num_samples(file_path)
+    if(num_samples == -1):
+        num_samples = total_samples - offset
+    stop = offset + num_samples
+    assert stop <= total_samples, \
+        "trying to read up to sample %d but file contains only %d samples" % (stop, total_samples)
 
-    return data
+    with open(file_path, "rb") as binary_file:
+        binary_file.seek(8 * offset)
+        for start in range(offset, stop, chunk_samples):
+            yield np.fromfile(binary_file, dtype=np.complex64, count=min(chunk_samples, stop - start))
 
 
 # Scripts
-def SINR_calibration(transmitter, receiver, interferer, target_SNR, target_SIR, tolerance=0.1, iters=10, t=0.1):
-    """Calibrates for a given SNR, SIR. Assumes transmitter data to be loaded"""
-
-    isdebug = (logging.getLogger('toplevel').streamlevel == logging.DEBUG)
-    debug("sys", "Calibrating SNR to %5.2f dB" % target_SNR)
-    delta_SNR = 0
+def _calibrate_gain(name, device, receiver, measure, target, slope, tolerance, iters, t, filename, verbose,
+                    secant=True):
+    """
+    Changes the gain of device until measure() is within tolerance of target
+    slope: expected change of the measured value per dB of gain, e.g. 1 for SNR over the
+           transmitter gain, -1 for SIR over the interferer gain. With secant=True it is
+           re-estimated from the last two iterations, so later steps land closer to the target.
+    returns: (target - measured, iterations run, seconds per iteration, slope estimate)
+    """
+    step = 0
+    off_target = 0
+    history = []  # (gain, measured value)
+    times = []
     for i in range(iters):
-        unclipped = transmitter.change_gain(delta_SNR)
-        transmitter.transmit_samples_from_memory()
-        receiver.receive_samples(t * receiver.srate, 'cache.bin', verbose=isdebug)
-        if isdebug:
+        start = time.time()
+        unclipped = device.change_gain(step)
+        device.transmit_samples_from_memory()
+        receiver.receive_samples(t * receiver.srate, filename, verbose=verbose)
+        if verbose:
             receiver.visualize_samples('unfiltered')
-        delta_SNR = target_SNR - receiver.measure_SNR()
-        debug(receiver.name, "Delta_SNR: %f dB" % delta_SNR)
-        if (not unclipped or abs(delta_SNR) <= tolerance):
+        measured = measure()
+        off_target = target - measured
+        history.append((device.gain, measured))
+
+        if (secant and len(history) >= 2):
+            (gain_0, measured_0), (gain_1, measured_1) = history[-2:]
+            if (abs(gain_1 - gain_0) > 1e-6):
+                estimate = (measured_1 - measured_0) / (gain_1 - gain_0)
+                if (estimate * slope > 0):  # ignore estimates with the wrong sign (noise, clipping)
+                    slope = np.sign(slope) * np.clip(abs(estimate), 0.1, 10)
+        step = off_target / slope
+
+        times.append(time.time() - start)
+        debug(receiver.name, "Delta_%s: %f dB (%.3fs)" % (name, off_target, times[-1]))
+        if (not unclipped or abs(off_target) <= tolerance):
             break
+    return off_target, i, times, slope
+
+
+def SINR_calibration(transmitter, receiver, interferer, target_SNR, target_SIR, tolerance=0.1, iters=10, t=0.1,
+                     filename='cache.bin', secant=True):
+    """Calibrates for a given SNR, SIR. Assumes transmitter data to be loaded
+    filename: capture file of the receiver, None keeps the captures in memory only
+    secant: estimate the gain step from the slope of earlier iterations instead of
+            assuming 1 dB per dB. The last slope of each device is kept as warm start
+            for its next calibration."""
+
+    isdebug = (logging.getLogger('toplevel').streamlevel == logging.DEBUG)
+    debug("sys", "Calibrating SNR to %5.2f dB" % target_SNR)
+    delta_SNR, i, times, transmitter.calibration_slope = _calibrate_gain(
+        "SNR", transmitter, receiver, receiver.measure_SNR, target_SNR,
+        getattr(transmitter, 'calibration_slope', 1.0), tolerance, iters, t, filename, isdebug, secant)
 
     transmitter.stop()
 
@@ -73,47 +123,48 @@ def SINR_calibration(transmitter, receiver, interferer, target_SNR, target_SIR,
         error("sys", "Target SNR not met after %d iterations! SNR: %5.3fdB" % (i + 1, target_SNR - delta_SNR))
 
     if ((interferer is None) or (target_SIR is None)):
-        info("SINR", "SNR: %5.3f, TX gain: %5.3f after %d of %d iterations"
-            % (target_SNR - delta_SNR, transmitter.gain, i+1, iters))
+        info("SINR", "SNR: %5.3f, TX gain: %5.3f after %d of %d iterations (%.3fs per iteration)"
+            % (target_SNR - delta_SNR, transmitter.gain, i+1, iters, np.mean(times)))
         return delta_SNR
     else:
 
         debug("sys", "Calibrating SIR to %5.2f dB" % target_SIR)
-        delta_SIR = 0
-        for k in range(iters):
-            unclipped = interferer.change_gain(delta_SIR)
-            interferer.transmit_samples_from_memory()  # transmit samples
-            receiver.receive_samples(t * receiver.srate, 'cache.bin', verbose=False)
-            delta_SIR = -(target_SIR - receiver.measure_SIR())
-            debug(receiver.name, "Delta_SIR: %f dB" % delta_SIR)
-            if (not unclipped or abs(delta_SIR) <= tolerance):
-                break
+        off_target, k, times_SIR, interferer.calibration_slope = _calibrate_gain(
+            "SIR", interferer, receiver, receiver.measure_SIR, target_SIR,
+            getattr(interferer, 'calibration_slope', -1.0), tolerance, iters, t, filename, False, secant)
+        delta_SIR = -off_target
 
         interferer.stop()
         if (k == iters - 1):
             error("sys", "Target SIR not met after %d iterations! SIR: %5.3fdB" % (k + 1, target_SIR + delta_SIR))
 
-        info("SINR", "SNR: %5.3f, TX gain: %5.3f after %d of %d iterations"
-            % (target_SNR - delta_SNR, transmitter.gain, i + 1, iters))
-        info("SINR", "SIR: %5.3f, TX gain: %5.3f after %d of %d iterations"
-            % (target_SIR + delta_SIR, interferer.gain, k + 1, iters))
+        info("SINR", "SNR: %5.3f, TX gain: %5.3f after %d of %d iterations (%.3fs per iteration)"
+            % (target_SNR - delta_SNR, transmitter.gain, i + 1, iters, np.mean(times)))
+        info("SINR", "SIR: %5.3f, TX gain: %5.3f after %d of %d iterations (%.3fs per iteration)"
+            % (target_SIR + delta_SIR, interferer.gain, k + 1, iters, np.mean(times_SIR)))
         return delta_SNR, delta_SIR
 
 
-def cfo_correction(transmitter, receiver, offset=0, iters=5, tolerance=0, t=0.01):
+def cfo_correction(transmitter, receiver, offset=0, iters=5, tolerance=0, t=0.01, filename='cache.bin'):
+    """filename: capture file of the receiver, None keeps the captures in memory only"""
 
     debug('CFO', "Correct CFO between %s and %s" % (transmitter.name, receiver.name))
     isdebug = (logging.getLogger('toplevel').streamlevel == logging.DEBUG)
 
+    times = []
     for i in range(iters):
+        start = time.time()
         transmitter.cfo_measurement(offset)
-        cfo = receiver.get_cfo(120e3, plot=isdebug)
+        cfo = receiver.get_cfo(120e3, plot=isdebug, filename=filename)
         transmitter.correct_cfo(cfo)
+        times.append(time.time() - start)
+        debug('CFO', "CFO: %d Hz (%.3fs)" % (cfo - offset, times[-1]))
 
         if(abs(cfo - offset) <= tolerance):
             break
 
-    info(transmitter.name, "Residual CFO: %d Hz after %d of %d iterations" % (cfo - offset, i + 1, iters))
+    info(transmitter.name, "Residual CFO: %d Hz after %d of %d iterations (%.3fs per iteration)"
+         % (cfo - offset, i + 1, iters, np.mean(times)))
     transmitter.stop()
 
     if(isdebug):
@@ -0,0 +1,39 @@
+import numpy as np
+
+# complex dtype -> float dtype of its real/imag parts
+_FLOAT_OF = {np.dtype(np.complex64): np.dtype(np.float32), np.dtype(np.complex128): np.dtype(np.float64)}
+_COMPLEX_OF = {v: k for k, v in _FLOAT_OF.items()}
+
+
+def complex_to_iq(signal, dtype=None):
+    """
+    Complex samples (..., L) as IQ pairs (..., L, 2)
+    :param signal: complex64/complex128 array (other input is cast to complex64)
+    :param dtype: complex dtype to convert to first (None keeps the input precision)
+    :return: float32/float64 view of the same memory, copied only if signal is not contiguous
+    """
+    signal = np.asarray(signal)
+    if dtype is not None:
+        signal = signal.astype(dtype, copy=False)
+    elif signal.dtype not in _FLOAT_OF:
+        signal = signal.astype(np.complex64)
+    signal = np.ascontiguousarray(signal)
+    return signal.view(_FLOAT_OF[signal.dtype]).reshape(signal.shape + (2,))
+
+
+def iq_to_complex(iq, dtype=None):
+    """
+    IQ pairs (..., L, 2) as complex samples (..., L)
+    :param iq: float32/float64 array with I and Q in the last axis (other input is cast to float32)
+    :param dtype: complex dtype of the result (None keeps the input precision)
+    :return: complex64/complex128 view of the same memory, copied only if a cast or reorder is needed
+    """
+    iq = np.asarray(iq)
+    if iq.shape[-1] != 2:
+        raise ValueError("expected IQ pairs in the last axis, got shape {}".format(iq.shape))
+    if dtype is not None:
+        iq = iq.astype(_FLOAT_OF[np.dtype(dtype)], copy=False)
+    elif iq.dtype not in _COMPLEX_OF:
+        iq = iq.astype(np.float32)
+    iq = np.ascontiguousarray(iq)
+    return iq.view(_COMPLEX_OF[iq.dtype])[..., 0]
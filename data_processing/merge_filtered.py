@@ -2,7 +2,9 @@ import numpy as np
 import os
 import glob
 import h5py as h5
-from data_processing.read_filtered import sort_matrix_entries, encode_labels
+from data_processing.read_filtered import encode_labels
+from data_processing.iq_conversion import complex_to_iq
+from data_processing.h5_writer import PreallocatedWriter, prefetch, npz_rows
 from sklearn import preprocessing
 import data_processing.dataloader as dl
 import pandas as pd
@@ -24,44 +26,24 @@ def merge_files():
 
     print("Total number of files: ",len(file_paths))
 
-    num_samples = []
-    num_iq = 50000
-    total_samples = 0
-    for path in file_paths:
-        data = np.load(path)
-        label = data['labels']
-        num_samples.append(len(label))
+    num_samples = [npz_rows(path) for path in file_paths]
     total_samples = sum(num_samples)
     print("Samples accounted for: {}".format(total_samples))
     print("Starting merge...")
 
-    for i,path in enumerate(file_paths):
-        data = np.load(path)
-        iq = data['matrix']
-        labels = data['labels']
-        snrs = data['snrs']
+    # the next npz is loaded and converted while the current one is written
+    with PreallocatedWriter(output_path, total_samples) as writer:
+        for i, (iq, labels, snrs) in enumerate(prefetch(file_paths, _load_npz)):
+            writer.write(iq=iq, labels=labels, snrs=snrs)
+            print("Files merged:", i+1)
 
-        processed_iq = np.apply_along_axis(sort_matrix_entries, axis=1, arr=iq)
-        processed_labels = encode_labels(8,labels)
 
-        if not os.path.exists(output_path):
-            with h5.File(output_path,'w') as hdf:
-                hdf.create_dataset('iq',data=processed_iq,chunks=True,maxshape=(None,num_iq,2),compression='gzip')
-                hdf.create_dataset('labels', data=processed_labels, chunks=True, maxshape=(None,8), compression='gzip')
-                hdf.create_dataset('snrs', data=snrs, chunks=True, maxshape=(None,), compression='gzip')
-                print(hdf['iq'].shape)
-
-        else:
-            with h5.File(output_path, 'a') as hf:
-                hf["iq"].resize((hf["iq"].shape[0] + iq.shape[0]), axis=0)
-                hf["iq"][-iq.shape[0]:] = processed_iq
-                hf["labels"].resize((hf["labels"].shape[0] + labels.shape[0]), axis=0)
-                hf["labels"][-labels.shape[0]:] = processed_labels
-                hf["snrs"].resize((hf["snrs"].shape[0] + snrs.shape[0]), axis=0)
-                hf["snrs"][-snrs.shape[0]:] = snrs
-                print(hf['iq'].shape)
-
-        print("Files merged:", i+1)
+def _load_npz(path):
+    data = np.load(path)
+    iq = data['matrix']
+    processed_iq = complex_to_iq(iq)   # (rows, L, 2) view, no copy
+    processed_labels = encode_labels(8, data['labels'])
+    return processed_iq, processed_labels, data['snrs']
 
 
 def merge_hdfset():
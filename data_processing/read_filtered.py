@@ -1,4 +1,5 @@
 import numpy as np
+from data_processing.iq_conversion import complex_to_iq
 
 
 def read_filtered(file_dir):
@@ -10,8 +11,8 @@ def read_filtered(file_dir):
 
 
 def sort_matrix_entries(matrix):
-    sorted = [[matrix[i].real,matrix[i].imag] for i in range(matrix.shape[0])]
-    return sorted
+    # [real, imag] pairs of every sample, works on whole matrices as well
+    return complex_to_iq(matrix)
 
 # one hot encoding the labels
 def encode_labels(num_categories,labels):
@@ -1,13 +1,11 @@
-import pandas as pd
 import numpy as np
-import h5py as h5
 import os
 import glob
-from tqdm import tqdm
 
-import data_processing.read_h5 as reader
-from data_processing.read_filtered import sort_matrix_entries, encode_labels
-from data_processing.dataloader import label_idx, create_set
+from data_processing.read_filtered import encode_labels
+from data_processing.iq_conversion import complex_to_iq
+from data_processing.h5_writer import PreallocatedWriter, prefetch, npz_rows
+from data_processing.stratify import stratified_subset
 
 
 def exrapolate_data():
@@ -34,43 +32,22 @@ def exrapolate_data():
     samples_per_segment = int(num_iq / batch)
     cut_off = samples_per_segment * batch
 
-    for i, path in enumerate(file_paths):
+    total_samples = sum(npz_rows(path) for path in file_paths) * samples_per_segment
+    print("Samples accounted for: {}".format(total_samples))
 
+    def load_segments(path):
+        # every row is cut into samples_per_segment samples of batch iq each
         data = np.load(path)
-        iq = data['matrix'][:, :cut_off]
-        labels = data['labels']
-        snrs = data['snrs']
-        total_samples = labels.shape[0] * int(num_iq / batch)  # samples after batching iq to 128
-        # batch_iq = np.array([np.array(np.split(iq[row],samples_per_segment)) for row in range(len(iq))])
-        batch_labels = np.zeros(samples_per_segment, dtype=np.int8)
-        batch_snrs = np.zeros(samples_per_segment, dtype=np.int8)
+        iq = data['matrix'][:, :cut_off].reshape(-1, batch)
+        labels = np.repeat(np.asarray(data['labels'], dtype=np.int8), samples_per_segment)
+        snrs = np.repeat(np.asarray(data['snrs'], dtype=np.int8), samples_per_segment)
+        processed_iq = complex_to_iq(iq)   # (rows, L, 2) view, no copy
+        return processed_iq, encode_labels(8, labels), snrs
 
-        for row in range(len(iq)):
-            batch_iq = np.array(np.split(iq[row], samples_per_segment))
-            batch_labels[:] = np.array(labels[row])
-            batch_snrs[:] = np.array(snrs[row])
-
-            processed_iq = np.apply_along_axis(sort_matrix_entries, axis=1, arr=batch_iq)
-            processed_labels = encode_labels(8, batch_labels)
-
-            if not os.path.exists(output_path):
-                with h5.File(output_path, 'w') as hdf:
-                    hdf.create_dataset('iq', data=processed_iq, chunks=True, maxshape=(None, batch, 2),
-                                       compression='gzip')
-                    hdf.create_dataset('labels', data=processed_labels, chunks=True, maxshape=(None, 8),
-                                       compression='gzip')
-                    hdf.create_dataset('snrs', data=batch_snrs, chunks=True, maxshape=(None,), compression='gzip')
-                    print(hdf['iq'].shape)
-
-            else:
-                with h5.File(output_path, 'a') as hf:
-                    hf["iq"].resize((hf["iq"].shape[0] + batch_iq.shape[0]), axis=0)
-                    hf["iq"][-batch_iq.shape[0]:] = processed_iq
-                    hf["labels"].resize((hf["labels"].shape[0] + batch_labels.shape[0]), axis=0)
-                    hf["labels"][-batch_labels.shape[0]:] = processed_labels
-                    hf["snrs"].resize((hf["snrs"].shape[0] + batch_snrs.shape[0]), axis=0)
-                    hf["snrs"][-batch_snrs.shape[0]:] = batch_snrs
-                    print(hf['iq'].shape)
+    with PreallocatedWriter(output_path, total_samples) as writer:
+        for i, (processed_iq, processed_labels, batch_snrs) in enumerate(prefetch(file_paths, load_segments)):
+            writer.write(iq=processed_iq, labels=processed_labels, snrs=batch_snrs)
+            print("Files written:", i + 1)
 
 
 def sample_signals_from_dataset(data_path, out_path):
@@ -80,44 +57,9 @@ def sample_signals_from_dataset(data_path, out_path):
     :param out_path: [str] save path for the sampled set
     :return: None
     """
-    iq, labels, snrs = reader.read_hdf5(data_path)
-    # print(len(labels))
-    # count = 0
-    # for l in labels:
-    #     if label_idx(l) == 0:
-    #         count += 1
-    # print(count)
-    threshold = int(0.2 * 153600)
-    mods = [0, 1, 2, 3, 4, 5, 6, 7]
-    for mod in mods:
-        count0, count5, count10, count15, count20 = 0, 0, 0, 0, 0
-        for i in tqdm(range(iq.shape[0])):
-            if label_idx(labels[i]) == mod:
-                if snrs[i] == 0:
-                    if count0 < threshold:
-                        create_set(out_path, iq[i], labels[i], snrs[i])
-                        count0 += 1
-
-                elif snrs[i] == 5:
-                    if count5 < threshold:
-                        create_set(out_path, iq[i], labels[i], snrs[i])
-                        count5 += 1
-
-                elif snrs[i] == 10:
-                    if count10 < threshold:
-                        create_set(out_path, iq[i], labels[i], snrs[i])
-                        count10 += 1
-
-                elif snrs[i] == 15:
-                    if count15 < threshold:
-                        create_set(out_path, iq[i], labels[i], snrs[i])
-                        count15 += 1
-
-                elif snrs[i] == 20:
-                    if count20 < threshold:
-                        create_set(out_path, iq[i], labels[i], snrs[i])
-                        count20 += 1
-        print(count0, count5, count10, count15, count20)
+    # first int(0.2 * 153600) rows of every (modulation, snr) group in file order
+    stratified_subset(data_path, out_path, 1.0, snr_key='snrs', snr_values=[0, 5, 10, 15, 20],
+                      max_per_group=int(0.2 * 153600))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,270 @@
+import os
+import json
+import time
+from argparse import ArgumentParser
+
+import h5py as h5
+import numpy as np
+from torch.utils.data import Dataset
+
+from data_processing.hdf5_dataset import BatchedDatasetFromHDF5, _batch_features
+from data_processing.feature_cache import FeatureCache
+
+MANIFEST = 'manifest.json'
+SHARD_VERSION = 1
+
+
+def _manifest_path(path):
+    return path if os.path.basename(path) == MANIFEST else os.path.join(path, MANIFEST)
+
+
+def is_shard_dir(path):
+    """True if path is a shard directory (or its manifest)"""
+    return os.path.isfile(_manifest_path(path))
+
+
+def convert_to_shards(h5_path, out_dir, shard_rows=1000000, iq='iq', labels='labels', snrs='snrs',
+                      block_rows=65536):
+    """
+    Converts a gzip HDF5 dataset into uncompressed .npy shards plus a JSON manifest
+    :param h5_path: source HDF5 file with iq (N,1024,2), one-hot labels (N,C) and snrs (N,)
+    :param out_dir: output directory, created if missing
+    :param shard_rows: maximum rows per shard
+    :param snrs: name of the snr (or sir) dataset, stored as snrs in the shards
+    :param block_rows: rows decoded from the HDF5 file per read
+    :return: manifest dict
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    start_time = time.time()
+    shards = []
+    with h5.File(h5_path, 'r') as file:
+        iq_dset, label_dset, snr_dset = file[iq], file[labels], file[snrs]
+        num_rows = len(label_dset)
+        num_classes = label_dset.shape[1]
+        sample_shape = iq_dset.shape[1:]
+        if iq_dset.chunks:   # read whole chunks only
+            block_rows = max(iq_dset.chunks[0], block_rows - block_rows % iq_dset.chunks[0])
+
+        for shard_idx, shard_start in enumerate(range(0, num_rows, shard_rows)):
+            rows = min(shard_rows, num_rows - shard_start)
+            names = {key: '{}_{:05d}.npy'.format(key, shard_idx) for key in ('iq', 'labels', 'snrs')}
+            iq_out = np.lib.format.open_memmap(os.path.join(out_dir, names['iq']), mode='w+',
+                                               dtype=np.float32, shape=(rows,) + sample_shape)
+            label_out = np.lib.format.open_memmap(os.path.join(out_dir, names['labels']), mode='w+',
+                                                  dtype=np.int8, shape=(rows,))
+            snr_out = np.lib.format.open_memmap(os.path.join(out_dir, names['snrs']), mode='w+',
+                                                dtype=np.int8, shape=(rows,))
+
+            for offset in range(0, rows, block_rows):
+                stop = min(offset + block_rows, rows)
+                src = slice(shard_start + offset, shard_start + stop)
+                iq_out[offset:stop] = iq_dset[src]
+                label_out[offset:stop] = np.argmax(label_dset[src], axis=1)
+                snr_out[offset:stop] = snr_dset[src]
+
+            for out in (iq_out, label_out, snr_out):
+                out.flush()
+            del iq_out, label_out, snr_out
+            shards.append(dict(rows=rows, **names))
+            print("shard {} written: {} rows".format(shard_idx, rows))
+
+    manifest = {'version': SHARD_VERSION, 'source': os.path.abspath(h5_path), 'num_rows': num_rows,
+                'num_classes': int(num_classes), 'sample_shape': list(sample_shape),
+                'snr_key': snrs, 'shards': shards}
+    _write_manifest(out_dir, manifest)
+    print("converted {} rows in {:.1f}s".format(num_rows, time.time() - start_time))
+    return manifest
+
+
+def _write_manifest(out_dir, manifest):
+    # manifest goes last so a half written directory is never picked up
+    tmp = _manifest_path(out_dir) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, _manifest_path(out_dir))
+
+
+class ShardWriter(object):
+    """Writes row blocks straight into .npy shards of a dataset of known length.
+
+    write(iq, labels, snrs) takes float32 IQ rows, class ids and int8 snrs (or sirs) and
+    fills preallocated shard memmaps of up to shard_rows rows; close() writes the manifest.
+    """
+
+    def __init__(self, out_dir, total_rows, num_classes, sample_shape, shard_rows=1000000, source=None,
+                 snr_key='snrs'):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.total_rows = total_rows
+        self.shard_rows = shard_rows
+        self.manifest = {'version': SHARD_VERSION, 'source': source, 'num_rows': total_rows,
+                         'num_classes': int(num_classes), 'sample_shape': list(sample_shape),
+                         'snr_key': snr_key, 'shards': []}
+        self.position = 0
+        self._open = None   # (shard start, rows, memmaps)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _next_shard(self):
+        shard_idx = len(self.manifest['shards'])
+        rows = min(self.shard_rows, self.total_rows - self.position)
+        names = {key: '{}_{:05d}.npy'.format(key, shard_idx) for key in ('iq', 'labels', 'snrs')}
+        shape = tuple(self.manifest['sample_shape'])
+        arrays = (np.lib.format.open_memmap(os.path.join(self.out_dir, names['iq']), mode='w+',
+                                            dtype=np.float32, shape=(rows,) + shape),
+                  np.lib.format.open_memmap(os.path.join(self.out_dir, names['labels']), mode='w+',
+                                            dtype=np.int8, shape=(rows,)),
+                  np.lib.format.open_memmap(os.path.join(self.out_dir, names['snrs']), mode='w+',
+                                            dtype=np.int8, shape=(rows,)))
+        self.manifest['shards'].append(dict(rows=rows, **names))
+        self._open = (self.position, rows, arrays)
+
+    def _close_shard(self):
+        for out in self._open[2]:
+            out.flush()
+        self._open = None
+
+    def write(self, iq, labels, snrs):
+        assert self.position + len(iq) <= self.total_rows, "more rows than the writer was created for"
+        done = 0
+        while done < len(iq):
+            if self._open is None:
+                self._next_shard()
+            start, rows, arrays = self._open
+            offset = self.position - start
+            n = min(len(iq) - done, rows - offset)
+            for out, values in zip(arrays, (iq, labels, snrs)):
+                out[offset:offset + n] = values[done:done + n]
+            done += n
+            self.position += n
+            if self.position - start == rows:
+                self._close_shard()
+
+    def close(self):
+        assert self.position == self.total_rows, \
+            "{} of {} rows written".format(self.position, self.total_rows)
+        if self._open is not None:
+            self._close_shard()
+        _write_manifest(self.out_dir, self.manifest)
+        return self.manifest
+
+
+class ShardDataset(Dataset):
+    """Memory-mapped shard dataset, drop-in for BatchedDatasetFromHDF5.
+
+    Shards are opened with np.load(mmap_mode='r') once per process. A contiguous range
+    inside one shard is served as a zero-copy memmap slice; other batches use one fancy
+    index per shard. Labels are stored as class ids and expanded to float32 one-hot rows
+    unless one_hot is False.
+    """
+
+    def __init__(self, path, feature_flag=False, one_hot=True, feature_path=None):
+        self.path = os.path.dirname(_manifest_path(path))
+        with open(_manifest_path(path)) as f:
+            self.manifest = json.load(f)
+        self.feature_flag = feature_flag
+        self.feature_path = feature_path
+        self.feature_cache = None
+        self._feature_table = None
+        self._feature_pid = None
+        self.one_hot = one_hot
+        self.num_classes = self.manifest['num_classes']
+        rows = [shard['rows'] for shard in self.manifest['shards']]
+        self.offsets = np.concatenate([[0], np.cumsum(rows)]).astype(np.int64)
+        self.length = int(self.offsets[-1])
+        # no decompression, rows can be read in any order
+        self.chunk_rows = 1
+        self.row_nbytes = int(np.prod(self.manifest['sample_shape'])) * np.dtype(np.float32).itemsize
+        self._shards = None
+        self._pid = None
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        # never pickle the memmaps into worker processes
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        state['_pid'] = None
+        state['_feature_table'] = None
+        state['_feature_pid'] = None
+        return state
+
+    @property
+    def shards(self):
+        if self._shards is None or self._pid != os.getpid():
+            self._shards = [tuple(np.load(os.path.join(self.path, shard[key]), mmap_mode='r')
+                                  for key in ('iq', 'labels', 'snrs'))
+                            for shard in self.manifest['shards']]
+            self._pid = os.getpid()
+        return self._shards
+
+    def close(self):
+        self._shards = None
+        self._pid = None
+
+    def read_rows(self, indices):
+        """reads the given rows of iq, labels and snrs; returns them in the requested order"""
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        first, last = shard_ids[0], shard_ids[-1]
+
+        if first == last and np.all(np.diff(indices) == 1):
+            local = slice(int(indices[0] - self.offsets[first]), int(indices[-1] - self.offsets[first]) + 1)
+            return tuple(arr[local] for arr in self.shards[first])
+
+        shard = self.shards[0]
+        data = np.empty((indices.size,) + shard[0].shape[1:], dtype=np.float32)
+        label = np.empty(indices.size, dtype=np.int8)
+        snr = np.empty(indices.size, dtype=np.int8)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            local = indices[mask] - self.offsets[shard_id]
+            iq_arr, label_arr, snr_arr = self.shards[shard_id]
+            data[mask], label[mask], snr[mask] = iq_arr[local], label_arr[local], snr_arr[local]
+        return data, label, snr
+
+    def __getitem__(self, item):
+        if np.ndim(item) == 0:
+            batch = self._convert([item], *self.read_rows([item]))
+            return tuple(value[0] for value in batch)
+        return self._convert(item, *self.read_rows(item))
+
+    def _convert(self, indices, data, label, snr):
+        if self.one_hot:
+            label = np.eye(self.num_classes, dtype=np.float32)[label]
+        if self.feature_flag:
+            return data, label, snr, _batch_features(self, indices, data)
+        return data, label, snr
+
+
+def open_dataset(data_path, iq='iq', labels='labels', snrs='snrs', feature_flag=False, feature_path=None,
+                 cache_features=False):
+    """
+    ShardDataset for a shard directory/manifest, BatchedDatasetFromHDF5 for an HDF5 file
+    :param cache_features: with feature_flag, keep the features in a FeatureCache next to the dataset
+    """
+    if is_shard_dir(data_path):
+        dataset = ShardDataset(data_path, feature_flag, feature_path=feature_path)
+        source = dataset.path
+    else:
+        dataset = BatchedDatasetFromHDF5(data_path, iq, labels, snrs, feature_flag, feature_path=feature_path)
+        source = data_path
+    if feature_flag and cache_features and feature_path is None:
+        dataset.feature_cache = FeatureCache(source, len(dataset))
+    return dataset
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Convert a gzip HDF5 dataset into memory-mapped shards')
+    parser.add_argument('--input', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--shard_rows', type=int, default=1000000)
+    parser.add_argument('--snrs', type=str, default='snrs', help='snr dataset name, e.g. sirs')
+    args = parser.parse_args()
+    convert_to_shards(args.input, args.output, args.shard_rows, snrs=args.snrs)
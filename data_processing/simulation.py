@@ -0,0 +1,294 @@
+import time
+import functools
+from argparse import ArgumentParser
+
+import numpy as np
+
+from data_processing.Radio import Radio
+from data_processing.Receiver import Receiver
+from data_processing.filter_data import NUMTAPS, SRATE, BW_SIGNAL, design_lowpass, fir_filter, filter_samples
+from data_processing.data_generation import MOD_SCHEMES
+from data_processing.iq_conversion import complex_to_iq
+from data_processing.shards import ShardWriter
+
+# single carrier: samples per symbol and root raised cosine pulse shape
+SPS = 4
+ROLLOFF = 0.35
+RRC_SPAN = 8   # symbols
+
+# OFDM: subcarriers, cyclic prefix and used subcarriers (about BW_SIGNAL at SRATE)
+OFDM_FFT = 128
+OFDM_CP = 32
+OFDM_USED = 52
+
+_ORDERS = {'BPSK': 2, 'QPSK': 4, '16QAM': 16, '64QAM': 64}
+
+
+def dbm_to_amplitude(power_dbm):
+    """rms amplitude of complex samples with the given power, 50 Ohm as in Receiver.calculate_spectrum"""
+    return np.sqrt(2 * 50 * 0.001 * 10 ** (np.asarray(power_dbm) / 10))
+
+
+def _complex_normal(rng, shape):
+    # unit power complex Gaussian samples, drawn as float32 pairs
+    return (rng.standard_normal(shape + (2,)) / np.sqrt(2)).astype(np.float32).view(np.complex64)[..., 0]
+
+
+@functools.lru_cache(maxsize=8)
+def constellation(order):
+    """unit average power BPSK (order 2) or square QAM constellation"""
+    if order == 2:
+        points = np.array([-1, 1], dtype=np.complex128)
+    else:
+        levels = np.arange(-np.sqrt(order) + 1, np.sqrt(order), 2)
+        points = (levels[:, np.newaxis] + 1j * levels[np.newaxis, :]).ravel()
+    points = (points / np.sqrt(np.mean(np.abs(points) ** 2))).astype(np.complex64)
+    points.setflags(write=False)
+    return points
+
+
+@functools.lru_cache(maxsize=8)
+def rrc_taps(sps, rolloff, span):
+    """unit energy root raised cosine pulse over span symbols"""
+    t = np.arange(-span * sps // 2, span * sps // 2 + 1) / sps
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = (np.sin(np.pi * t * (1 - rolloff)) + 4 * rolloff * t * np.cos(np.pi * t * (1 + rolloff))) / \
+            (np.pi * t * (1 - (4 * rolloff * t) ** 2))
+    h[t == 0] = 1 - rolloff + 4 * rolloff / np.pi
+    edge = np.isclose(np.abs(t), 1 / (4 * rolloff))
+    h[edge] = rolloff / np.sqrt(2) * ((1 + 2 / np.pi) * np.sin(np.pi / (4 * rolloff)) +
+                                      (1 - 2 / np.pi) * np.cos(np.pi / (4 * rolloff)))
+    h /= np.sqrt(np.sum(h ** 2))
+    h.setflags(write=False)
+    return h
+
+
+def modulate(mod_scheme, num_rows, length, rng):
+    """
+    num_rows unit power bursts of one modulation scheme
+    :param mod_scheme: one of MOD_SCHEMES, e.g. 'SC_16QAM' or 'OFDM_QPSK'
+    :return: (num_rows, length) complex64, each row starting at a random symbol phase
+    """
+    kind, name = mod_scheme.split('_')
+    points = constellation(_ORDERS[name])
+    if kind == 'SC':
+        num_symbols = length // SPS + RRC_SPAN + 1
+        upsampled = np.zeros((num_rows, num_symbols * SPS), dtype=np.complex64)
+        upsampled[:, ::SPS] = points[rng.randint(points.size, size=(num_rows, num_symbols))]
+        signal = fir_filter(upsampled, rrc_taps(SPS, ROLLOFF, RRC_SPAN), axis=-1)
+        start = RRC_SPAN // 2 * SPS + rng.randint(SPS)
+    elif kind == 'OFDM':
+        num_ofdm = length // (OFDM_FFT + OFDM_CP) + 2
+        used = np.r_[1:OFDM_USED // 2 + 1, OFDM_FFT - OFDM_USED // 2:OFDM_FFT]   # no DC subcarrier
+        grid = np.zeros((num_rows, num_ofdm, OFDM_FFT), dtype=np.complex64)
+        grid[..., used] = points[rng.randint(points.size, size=(num_rows, num_ofdm, used.size))]
+        symbols = np.fft.ifft(grid, axis=-1)
+        signal = np.concatenate([symbols[..., -OFDM_CP:], symbols], axis=-1).reshape(num_rows, -1)
+        start = rng.randint(OFDM_FFT + OFDM_CP)
+    else:
+        raise ValueError("unknown modulation scheme {}".format(mod_scheme))
+
+    signal = signal[:, start:start + length]
+    signal = signal / np.sqrt(np.mean(np.abs(signal) ** 2, axis=1, keepdims=True))
+    return signal.astype(np.complex64)
+
+
+def _apply_cfo(signal, max_cfo, rng):
+    # one CFO per row, uniform in [-max_cfo, max_cfo] times the sample rate
+    cfo = rng.uniform(-max_cfo, max_cfo, size=(len(signal), 1))
+    return signal * np.exp(2j * np.pi * cfo * np.arange(signal.shape[1])).astype(np.complex64)
+
+
+def synthesize(labels, snrs, length, rng, mod_schemes=MOD_SCHEMES, sirs=None, interferer_scheme=None,
+               max_cfo=0.0, filtered=True):
+    """
+    Batch of received signals: modulated bursts plus CFO, interferer and AWGN
+    :param labels: (N,) indices into mod_schemes
+    :param snrs: (N,) SNR in the signal band [dB], as Receiver.measure_SNR reports it
+    :param sirs: optional (N,) SIR [dB] of an interferer with interferer_scheme (default: random scheme per row)
+    :param max_cfo: largest CFO as a fraction of the sample rate, drawn per row
+    :param filtered: low-pass filter the batch like the recorded datasets (filter_data.filter_samples)
+    :return: (N, length) complex64
+    """
+    labels = np.asarray(labels)
+    num_rows = labels.size
+    signal = np.empty((num_rows, length), dtype=np.complex64)
+    for label in np.unique(labels):
+        rows = labels == label
+        signal[rows] = modulate(mod_schemes[label], int(np.sum(rows)), length, rng)
+    if max_cfo:
+        signal = _apply_cfo(signal, max_cfo, rng)
+
+    if sirs is not None:
+        if interferer_scheme is None:
+            intf_labels = rng.randint(len(mod_schemes), size=num_rows)
+        else:
+            intf_labels = np.full(num_rows, mod_schemes.index(interferer_scheme))
+        interference = synthesize(intf_labels, np.full(num_rows, np.inf), length, rng, mod_schemes,
+                                  max_cfo=max_cfo, filtered=False)
+        signal += interference * (10 ** (-np.asarray(sirs, dtype=np.float64) / 20))[:, np.newaxis]
+
+    # white noise over the whole band with the requested power inside the signal band
+    noise_power = 10 ** (-np.asarray(snrs, dtype=np.float64) / 10) / (BW_SIGNAL / SRATE)
+    if np.any(np.isfinite(snrs)):
+        signal += _complex_normal(rng, (num_rows, length)) * np.sqrt(noise_power)[:, np.newaxis].astype(np.float32)
+    if filtered:
+        signal = filter_samples(signal, dtype=np.complex64, axis=-1)
+    return signal.astype(np.complex64, copy=False)
+
+
+def generate_shards(out_dir, num_rows, length=1024, snr_range=(-10, 30), sir_range=None, max_cfo=0.0,
+                    mod_schemes=MOD_SCHEMES, batch_rows=16384, shard_rows=1000000, seed=4):
+    """
+    Writes a synthetic dataset in the shard format of data_processing.shards
+    :param snr_range: inclusive range of integer SNRs [dB], drawn uniformly per row
+    :param sir_range: inclusive SIR range [dB]; with an interferer the SIRs are stored (snr_key 'sirs')
+    :return: manifest dict
+    """
+    rng = np.random.RandomState(seed)
+    start_time = time.time()
+    snr_key = 'snrs' if sir_range is None else 'sirs'
+    with ShardWriter(out_dir, num_rows, len(mod_schemes), (length, 2), shard_rows=shard_rows,
+                     source='simulation', snr_key=snr_key) as writer:
+        for start in range(0, num_rows, batch_rows):
+            n = min(batch_rows, num_rows - start)
+            labels = rng.randint(len(mod_schemes), size=n)
+            snrs = rng.randint(snr_range[0], snr_range[1] + 1, size=n)
+            sirs = None if sir_range is None else rng.randint(sir_range[0], sir_range[1] + 1, size=n)
+            signal = synthesize(labels, snrs, length, rng, mod_schemes, sirs=sirs, max_cfo=max_cfo)
+            writer.write(complex_to_iq(signal), labels.astype(np.int8),
+                         (snrs if sirs is None else sirs).astype(np.int8))
+    manifest = writer.manifest
+    elapsed = time.time() - start_time
+    print("generated {} rows in {:.1f}s ({:.0f} rows/min)".format(num_rows, elapsed, num_rows / elapsed * 60))
+    return manifest
+
+
+class SimulatedChannel(object):
+    """Shared medium of simulated radios: the sum of all active transmitters plus AWGN"""
+
+    def __init__(self, noise_power=-70.0, seed=None):
+        self.noise_power = noise_power  # dBm over the whole receiver bandwidth
+        self.transmitters = []
+        self.rng = np.random.RandomState(seed)
+
+    def awgn(self, n_samples, power_dbm):
+        scale = dbm_to_amplitude(power_dbm) / np.sqrt(2)
+        noise = np.empty(n_samples, dtype=np.complex64)
+        noise.real = self.rng.standard_normal(n_samples) * scale
+        noise.imag = self.rng.standard_normal(n_samples) * scale
+        return noise
+
+    def capture(self, n_samples, receiver):
+        data = self.awgn(n_samples, self.noise_power)
+        for transmitter in self.transmitters:
+            if transmitter.active:
+                data += transmitter.emission(n_samples, receiver)
+        return data
+
+
+class SimulatedTransmitter(Radio):
+    """Software transmitter: bursts of mod_scheme (default: band-limited complex Gaussian
+    signal) at the current gain.
+
+    The received power is gain + path_gain dBm. change_gain follows the hardware
+    convention of returning False when the requested gain had to be clipped.
+    """
+
+    def __init__(self, channel, name="sim_tx", path_gain=-40.0, min_gain=-30, mod_scheme=None, **kwargs):
+        Radio.__init__(self, **kwargs)
+        self.channel = channel
+        self.mod_scheme = mod_scheme
+        self.name = name
+        self.path_gain = path_gain
+        self.min_gain = min_gain
+        self.active = False
+        self.cfo = 0.0  # residual carrier frequency offset in Hz
+        self.tone = None  # frequency of the single tone of cfo_measurement
+        channel.transmitters.append(self)
+
+    def change_gain(self, delta):
+        gain = self.gain + delta
+        self.gain = float(np.clip(gain, self.min_gain, self.max_gain))
+        return self.gain == gain
+
+    def transmit_samples_from_memory(self, *args):
+        self.tone = None
+        self.active = True
+
+    def cfo_measurement(self, offset):
+        self.tone = offset
+        self.active = True
+
+    def correct_cfo(self, cfo):
+        self.cfo -= cfo - self.tone
+
+    def stop(self):
+        self.active = False
+
+    def emission(self, n_samples, receiver):
+        """n_samples of the transmitted signal as seen by the receiver"""
+        t = np.arange(n_samples) / receiver.srate
+        shift = self.freq - receiver.freq + self.cfo
+        if self.tone is not None:
+            signal = np.exp(2j * np.pi * (self.tone + shift) * t)
+        elif self.mod_scheme is not None:
+            signal = modulate(self.mod_scheme, 1, n_samples, self.channel.rng)[0]
+            signal *= np.exp(2j * np.pi * shift * t)
+        else:
+            b = design_lowpass(NUMTAPS, self.bw_signal / 2, receiver.srate)
+            signal = fir_filter(self.channel.awgn(n_samples, 0.0), b)
+            signal /= np.sqrt(np.mean(np.abs(signal) ** 2))
+            signal *= np.exp(2j * np.pi * shift * t)
+        return (signal * dbm_to_amplitude(self.gain + self.path_gain)).astype(np.complex64)
+
+
+class SimulatedReceiver(Receiver):
+    """Software receiver capturing from a SimulatedChannel"""
+
+    def __init__(self, channel, name="sim_rx", **kwargs):
+        Receiver.__init__(self, **kwargs)
+        self.channel = channel
+        self.name = name
+
+    def receive_samples(self, n_samples, filename=None, verbose=True):
+        self.data = self.channel.capture(int(n_samples), self)
+        if filename is not None:
+            self.data.tofile(filename)
+        return self.data
+
+
+def calibration_demo(target_SNR=20, target_SIR=5):
+    """SNR/SIR calibration of a simulated transmitter/interferer pair, captures kept in memory"""
+    import logging
+    from data_processing.helper_functions import SINR_calibration
+
+    logging.getLogger('toplevel').streamlevel = logging.INFO  # set by the lab scripts otherwise
+    channel = SimulatedChannel(seed=4)
+    receiver = SimulatedReceiver(channel, freq=5750000000.0, srate=SRATE, rx_dir=None, bw_noise=5000000.0,
+                                 init_gain=0, max_gain=0, freq_noise=np.array([5.73e9, 5.77e9]),
+                                 bw_signal=BW_SIGNAL)
+    transmitter = SimulatedTransmitter(channel, freq=5750000000.0, bw_signal=BW_SIGNAL, init_gain=0, max_gain=30,
+                                       mod_scheme="SC_QPSK")
+    interferer = SimulatedTransmitter(channel, name="sim_intf", freq=5750000000.0, bw_signal=BW_SIGNAL,
+                                      init_gain=0, max_gain=30, mod_scheme="OFDM_16QAM")
+    start_time = time.time()
+    result = SINR_calibration(transmitter, receiver, interferer, target_SNR, target_SIR, filename=None)
+    print("calibration took {:.2f}s".format(time.time() - start_time))
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Synthetic datasets and calibration without lab hardware')
+    parser.add_argument('--out_dir', type=str, default=None, help='write a shard dataset here')
+    parser.add_argument('--num_rows', type=int, default=1000000)
+    parser.add_argument('--length', type=int, default=1024)
+    parser.add_argument('--sir_range', type=int, nargs=2, default=None)
+    parser.add_argument('--max_cfo', type=float, default=0.0)
+    parser.add_argument('--calibrate', action='store_true', help='run the SINR calibration demo')
+    args = parser.parse_args()
+
+    if args.calibrate:
+        print(calibration_demo())
+    if args.out_dir is not None:
+        generate_shards(args.out_dir, args.num_rows, args.length, sir_range=args.sir_range, max_cfo=args.max_cfo)
@@ -0,0 +1,161 @@
+import time
+from argparse import ArgumentParser
+
+import h5py as h5
+import numpy as np
+
+
+def _read_strata(file, labels, snr_key, block_rows):
+    """class ids (argmax of one-hot labels) and snrs of every row, read in large blocks"""
+    label_dset = file[labels]
+    num_rows = len(label_dset)
+    class_ids = np.empty(num_rows, dtype=np.int64)
+    for start in range(0, num_rows, block_rows):
+        class_ids[start:start + block_rows] = np.argmax(label_dset[start:start + block_rows], axis=1)
+    return class_ids, file[snr_key][()]
+
+
+def stratified_mask(class_ids, snrs, fraction, snr_values=None, classes=None, max_per_group=None,
+                    order='first', seed=4):
+    """
+    Selects floor(fraction * group size) rows of every (class, snr) group
+    :param class_ids: class id per row
+    :param snrs: snr (or sir) per row
+    :param snr_values: snrs to consider, rows with other snrs are never selected (None = all)
+    :param classes: class ids to consider (None = all)
+    :param max_per_group: optional upper bound of rows per group, or {snr: bound} (snrs not in it are unbounded)
+    :param order: 'first' takes the first rows of a group in file order, 'random' a seeded random choice
+    :return: boolean mask of selected rows, boolean mask of eligible rows
+    """
+    eligible = np.ones(class_ids.shape[0], dtype=bool)
+    if snr_values is not None:
+        eligible &= np.isin(snrs, snr_values)
+    if classes is not None:
+        eligible &= np.isin(class_ids, classes)
+
+    rows = np.flatnonzero(eligible)
+    if order == 'random':
+        rows = rows[np.random.RandomState(seed).permutation(rows.size)]
+    elif order != 'first':
+        raise ValueError("order must be 'first' or 'random', got {}".format(order))
+
+    snr_levels, snr_code = np.unique(snrs[rows], return_inverse=True)
+    snr_code = snr_code.reshape(-1)
+    keys = class_ids[rows] * (snr_code.max(initial=0) + 1) + snr_code
+    _, first, group, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    group = group.reshape(-1)
+    quota = np.floor(fraction * counts).astype(np.int64)
+    if isinstance(max_per_group, dict):
+        group_snrs = snr_levels[snr_code[first]]
+        quota = np.minimum(quota, [max_per_group.get(snr, count) for snr, count in zip(group_snrs.tolist(), counts)])
+    elif max_per_group is not None:
+        quota = np.minimum(quota, max_per_group)
+
+    # rank of each row inside its group, keeping the (file or random) order
+    by_group = np.argsort(group, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.empty(rows.size, dtype=np.int64)
+    rank[by_group] = np.arange(rows.size) - starts[group[by_group]]
+
+    selected = np.zeros(class_ids.shape[0], dtype=bool)
+    selected[rows[rank < quota[group]]] = True
+    return selected, eligible
+
+
+def _create_like(out, src, keys, num_rows):
+    """preallocated gzip datasets with the dtypes and row shapes of the source"""
+    for key in keys:
+        out.create_dataset(key, shape=(num_rows,) + src[key].shape[1:], dtype=src[key].dtype, chunks=True,
+                           maxshape=(None,) + src[key].shape[1:], compression='gzip')
+
+
+def copy_rows(src, outputs, keys, block_rows=65536):
+    """
+    Copies rows of src into several preallocated outputs with sorted contiguous block reads
+    :param src: open source h5py File
+    :param outputs: list of (open h5py File, boolean row mask)
+    :param keys: dataset names to copy
+    """
+    num_rows = len(src[keys[0]])
+    positions = [0] * len(outputs)
+    for start in range(0, num_rows, block_rows):
+        stop = min(start + block_rows, num_rows)
+        masks = [mask[start:stop] for _, mask in outputs]
+        if not any(m.any() for m in masks):
+            continue
+        block = {key: src[key][start:stop] for key in keys}
+        for i, ((out, _), mask) in enumerate(zip(outputs, masks)):
+            n = int(mask.sum())
+            if n == 0:
+                continue
+            for key in keys:
+                out[key][positions[i]:positions[i] + n] = block[key][mask]
+            positions[i] += n
+
+
+def stratified_subset(in_path, out_path, fraction, snr_key='snrs', snr_values=None, classes=None,
+                      max_per_group=None, order='first', seed=4, block_rows=65536):
+    """
+    Writes a class/snr stratified subset of an HDF5 dataset
+    :param in_path: source file with iq, labels and snr_key
+    :param out_path: output file, rows keep the source order
+    :param fraction: fraction of every (class, snr) group to keep
+    :return: number of rows written
+    """
+    return stratified_split(in_path, out_path, None, fraction, snr_key, snr_values, classes,
+                            max_per_group, order, seed, block_rows)[0]
+
+
+def stratified_split(in_path, selected_path, rest_path, fraction, snr_key='snrs', snr_values=None, classes=None,
+                     max_per_group=None, order='first', seed=4, block_rows=65536):
+    """
+    Splits an HDF5 dataset into a stratified selection and the remaining eligible rows
+    :param selected_path: output of the selected fraction of every (class, snr) group (e.g. test set)
+    :param rest_path: output of the other eligible rows (e.g. train set), None to skip
+    :return: number of rows in the selected and rest outputs
+    """
+    start_time = time.time()
+    keys = ['iq', 'labels', snr_key]
+    with h5.File(in_path, 'r') as src:
+        class_ids, snrs = _read_strata(src, 'labels', snr_key, block_rows)
+        selected, eligible = stratified_mask(class_ids, snrs, fraction, snr_values, classes,
+                                             max_per_group, order, seed)
+        targets = [(selected_path, selected)]
+        if rest_path is not None:
+            targets.append((rest_path, eligible & ~selected))
+
+        outputs = []
+        try:
+            for path, mask in targets:
+                out = h5.File(path, 'w')
+                outputs.append((out, mask))
+                _create_like(out, src, keys, int(mask.sum()))
+            copy_rows(src, outputs, keys, block_rows)
+        finally:
+            for out, _ in outputs:
+                out.close()
+
+    counts = tuple(int(mask.sum()) for _, mask in targets)
+    print("wrote {} rows in {:.1f}s".format(counts, time.time() - start_time))
+    return counts
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Class/SNR stratified subsets and splits of HDF5 datasets')
+    parser.add_argument('mode', choices=['subset', 'split'])
+    parser.add_argument('--input', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True, help='subset, or selected part of a split')
+    parser.add_argument('--rest', type=str, default=None, help='remaining rows of a split')
+    parser.add_argument('--fraction', type=float, required=True)
+    parser.add_argument('--snr_key', type=str, default='snrs')
+    parser.add_argument('--snrs', type=int, nargs='*', default=None)
+    parser.add_argument('--classes', type=int, nargs='*', default=None)
+    parser.add_argument('--max_per_group', type=int, default=None)
+    parser.add_argument('--order', choices=['first', 'random'], default='first')
+    parser.add_argument('--seed', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.mode == 'split' and args.rest is None:
+        parser.error('split needs --rest')
+    stratified_split(args.input, args.output, args.rest if args.mode == 'split' else None, args.fraction,
+                     args.snr_key, args.snrs, args.classes, args.max_per_group, args.order, args.seed)
@@ -11,6 +11,7 @@ import statistics
 from tqdm import tqdm
 import pandas as pd
 from data_processing.dataloader import label_idx
+from model_inference.batch_inference import load_model
 import csv
 import matplotlib.pyplot as plt
 from scipy import stats
@@ -323,9 +324,7 @@ def recalibrate_scores(weibull_model ,labellist , pred,
 
 
 def main(path):
-    model = torch.load("trained_cnn_intf_free_vsg20")
-    model.cuda()
-    model.eval()
+    model = load_model("trained_cnn_intf_free_vsg20", 'cnn', 'cuda:0')
     path_h5 = "/media/backup/Arsenal/rf_dataset_inets/dataset_intf_free_no_cfo_vsg_snr20_1024.h5"
     iq, labels, snrs = reader.read_hdf5(path_h5)
     print("=======Starting======")
@@ -6,9 +6,10 @@ import torch
 import numpy as np
 from sklearn import metrics
 from torch.autograd import Variable
+from models.pytorch.metrics import StreamingMetrics
 
 
-def train(data_path,num_epochs):
+def train(data_path,num_epochs,log_interval=100):
 
     train_set, test_set = image_dataloader(data_path,44)  #GOLD_XYZ_OSC.0001_1024.hdf5
     print("Data loaded and batched...")
@@ -31,50 +32,48 @@ def train(data_path,num_epochs):
 
     best_accuracy = 0
     # reg_lambda = 0.1
+    # accumulated on the gpu, read back every log_interval iterations and once per epoch
+    train_metrics = StreamingMetrics(8)
+    val_metrics = StreamingMetrics(8)
 
     output_file = open("rf_resnet101_spectrogram_16k.txt", "w")
     # print(zip(x_train_gen, y_train_gen))
 
     model.train()
     for epoch in range(num_epochs):
-        running_loss = 0
-        average_loss = 0
+        train_metrics.reset()
 
         for iter, batch in enumerate(train_set):
 
-            _, n_mod = batch
-
             batch = [Variable(record).cuda() for record in batch]
             optimizer.zero_grad()
             t_iq, t_mod = batch
             prediction = model(t_iq)
-            n_prob_label = prediction.cpu().data.numpy()
 
             loss = criterion(prediction, t_mod)   # + l2_reg*reg_lambda
-            running_loss += loss.item()
             loss.backward()
             optimizer.step()
-
-            training_metrics = get_evaluation(n_mod.cpu().data.numpy(), n_prob_label, list_metrics=["accuracy", "loss"])
-
-            print("Training: Iteration: {}/{} Epoch: {}/{} Loss: {} Accuracy: {}".format(iter + 1,
-                                                                                         num_iter_per_epoch,
-                                                                                         epoch + 1, num_epochs,
-                                                                                         training_metrics["loss"],
-                                                                                         training_metrics[
-                                                                                             "accuracy"]))
-        average_loss = running_loss/num_iter_per_epoch
+            train_metrics.update(loss, prediction, t_mod)
+
+            if train_metrics.should_log(iter, log_interval):
+                training_metrics = train_metrics.compute()
+                print("Training: Iteration: {}/{} Epoch: {}/{} Loss: {} Accuracy: {}".format(iter + 1,
+                                                                                             num_iter_per_epoch,
+                                                                                             epoch + 1, num_epochs,
+                                                                                             training_metrics["loss"],
+                                                                                             training_metrics[
+                                                                                                 "accuracy"]))
+        training_metrics = train_metrics.compute()
+        average_loss = training_metrics["loss"]
         print("Average loss: {}".format(average_loss))
 
         # evaluation of validation data
         model.eval()
         with torch.no_grad():
 
-            validation_true = []
-            validation_prob = []
+            val_metrics.reset()
 
             for batch in test_set:
-                _, n_mod = batch
 
                 # setting volatile to true because we are in inference mode
                 # we will not be backpropagating here
@@ -84,20 +83,14 @@ def train(data_path,num_epochs):
                 # i = Variable(i).cuda()
                 # j = Variable(j).cuda()
                 # get inputs
-                t_iq, _ = batch
+                t_iq, t_mod = batch
                 # forward pass
                 t_predicted_label = model(t_iq)
                 # using sigmoid to predict the label
                 # t_predicted_label = F.sigmoid(t_predicted_label)
 
-                validation_prob.append(t_predicted_label)
-                validation_true.extend(n_mod.cpu().data.numpy())
-
-                # print(validation_true, validation_prob)
-
+                val_metrics.update(criterion(t_predicted_label, t_mod), t_predicted_label, t_mod)
 
-            validation_prob = torch.cat(validation_prob, 0)
-            validation_prob = validation_prob.cpu().data.numpy()
             # y_pred = np.argmax(validation_prob, -1)
             # print("val predicted:{}".format(validation_prob[0]))
             # print("val cleaned:{}".format(y_pred))
@@ -105,8 +98,8 @@ def train(data_path,num_epochs):
             # back to default:train
         model.train()
 
-        test_metrics = get_evaluation(validation_true, validation_prob,
-                                      list_metrics=["accuracy", "loss", "confusion_matrix"])
+        test_metrics = val_metrics.compute()
+        test_metrics["confusion_matrix"] = str(test_metrics["confusion_matrix"].numpy())
 
         output_file.write(
                 "Epoch: {}/{} \nTraining loss: {} Training accuracy: {} \nTest loss: {} Test accuracy: {} \nAverage Loss: {}  \nTest confusion matrix: \n{}\n\n".format(
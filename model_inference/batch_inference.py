@@ -0,0 +1,264 @@
+import os
+import csv
+import time
+import queue
+import threading
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from models.pytorch.cnn_model import CNN
+from models.pytorch.resnet import resnet18, resnet50, resnet101
+from models.pytorch.conv1d_models import CNN1d, resnet18_1d, resnet50_1d
+from models.pytorch.metrics import StreamingMetrics
+
+MODEL_FACTORIES = {
+    'cnn': lambda n_classes: CNN(n_classes=n_classes),
+    'cnn1d': lambda n_classes: CNN1d(n_classes=n_classes),
+    'resnet18': lambda n_classes: resnet18(2, n_classes),
+    'resnet50': lambda n_classes: resnet50(2, n_classes),
+    'resnet101': lambda n_classes: resnet101(2, n_classes),
+    'resnet18_1d': lambda n_classes: resnet18_1d(2, n_classes),
+    'resnet50_1d': lambda n_classes: resnet50_1d(2, n_classes),
+}
+
+# LightningResnet names the Resnet encoder/decoder res_enc/res_dec
+_KEY_PREFIXES = {'res_enc.': 'encoder.', 'res_dec.': 'decoder.'}
+
+STAGES = ('wait', 'transfer', 'forward', 'collect')
+
+
+def _rename_keys(state_dict):
+    renamed = {}
+    for key, value in state_dict.items():
+        for old, new in _KEY_PREFIXES.items():
+            if key.startswith(old):
+                key = new + key[len(old):]
+                break
+        renamed[key] = value
+    return renamed
+
+
+def load_model(path, factory=None, device='cpu', n_classes=8):
+    """
+    Model for inference, in eval mode on device
+    :param path: state dict (torch.save(model.state_dict(), ...)), Lightning checkpoint or, without
+                 a factory, a whole model stored with torch.save(model, ...)
+    :param factory: name in MODEL_FACTORIES or a callable n_classes -> model the weights are loaded into
+    """
+    # whole models and Lightning checkpoints are pickles, which torch>=2.6 refuses by default
+    stored = torch.load(path, map_location='cpu', weights_only=False)
+    if isinstance(stored, nn.Module):
+        model = stored
+    else:
+        if factory is None:
+            raise ValueError("{} stores weights only, pass the model factory".format(path))
+        state_dict = stored.get('state_dict', stored)
+        model = (MODEL_FACTORIES[factory] if isinstance(factory, str) else factory)(n_classes)
+        model.load_state_dict(_rename_keys(state_dict))
+    return model.to(device).eval()
+
+
+class _Raised(object):
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(batches, depth=2, pin_memory=False):
+    """
+    Iterates batches in a background thread, keeping up to depth of them ready, so reading
+    (and pinning) the next batch overlaps the forward pass of the current one
+    """
+    ready = queue.Queue(depth)
+    done = object()
+
+    def produce():
+        try:
+            for batch in batches:
+                if pin_memory:
+                    batch = [record.pin_memory() for record in batch]
+                ready.put(batch)
+        except BaseException as error:
+            ready.put(_Raised(error))
+        finally:
+            ready.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        batch = ready.get()
+        if batch is done:
+            return
+        if isinstance(batch, _Raised):
+            raise batch.error
+        yield batch
+
+
+class BatchInference(object):
+    """Runs a classifier over (iq, label, snr) batches for throughput.
+
+    Batches are prefetched on a background thread and evaluated under torch.inference_mode;
+    labels, predictions, SNRs and (optionally) class probabilities go straight into
+    preallocated numpy arrays, and loss, accuracy and confusion matrix are accumulated on
+    the device. Every stage is timed: waiting for the next batch, host to device copy,
+    forward pass and copying the results back.
+    """
+
+    def __init__(self, model, device='cpu', n_classes=8, keep_probs=False, prefetch_depth=2):
+        self.model = model
+        self.device = torch.device(device)
+        self.n_classes = n_classes
+        self.keep_probs = keep_probs
+        self.prefetch_depth = prefetch_depth
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def _allocate(self, num_rows):
+        arrays = {'true': np.empty(num_rows, dtype=np.int64), 'pred': np.empty(num_rows, dtype=np.int64),
+                  'snr': np.empty(num_rows, dtype=np.float32)}
+        if self.keep_probs:
+            arrays['prob'] = np.empty((num_rows, self.n_classes), dtype=np.float32)
+        return arrays
+
+    @staticmethod
+    def _grow(arrays, num_rows):
+        for name, array in arrays.items():
+            grown = np.empty((num_rows,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            arrays[name] = grown
+
+    def run(self, loader, num_rows=None):
+        """
+        :param loader: iterable of (iq, labels, snrs) batches, labels as class ids or one-hot rows
+        :param num_rows: rows the loader yields, default len(loader.dataset); the arrays grow if it is short
+        :return: dict of arrays (true, pred, snr[, prob]), metrics (StreamingMetrics.compute()) and
+                 stats (mean ms per batch of every stage, samples/sec)
+        """
+        if num_rows is None:
+            dataset = getattr(loader, 'dataset', None)
+            num_rows = len(dataset) if dataset is not None else 1024
+        arrays = self._allocate(num_rows)
+        metrics = StreamingMetrics(self.n_classes)
+        criterion = nn.CrossEntropyLoss()
+        seconds = dict.fromkeys(STAGES, 0.0)
+        non_blocking = self.device.type == 'cuda'
+
+        pos = 0
+        num_batches = 0
+        start_time = time.perf_counter()
+        batches = iter(prefetch(loader, self.prefetch_depth, pin_memory=non_blocking))
+        with torch.inference_mode():
+            while True:
+                stage_time = time.perf_counter()
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                iq, labels, snrs = batch
+                n = len(iq)
+                if pos + n > len(arrays['true']):
+                    self._grow(arrays, max(2 * len(arrays['true']), pos + n))
+                now = time.perf_counter()
+                seconds['wait'] += now - stage_time
+                stage_time = now
+
+                iq = iq.to(self.device, non_blocking=non_blocking)
+                labels = labels.to(self.device, non_blocking=non_blocking)
+                if labels.dim() > 1:
+                    labels = labels.argmax(dim=1)
+                self._sync()
+                now = time.perf_counter()
+                seconds['transfer'] += now - stage_time
+                stage_time = now
+
+                logits = self.model(iq).float()
+                preds = logits.argmax(dim=1)
+                metrics.update(criterion(logits, labels), preds, labels)
+                self._sync()
+                now = time.perf_counter()
+                seconds['forward'] += now - stage_time
+                stage_time = now
+
+                arrays['true'][pos:pos + n] = labels.cpu().numpy()
+                arrays['pred'][pos:pos + n] = preds.cpu().numpy()
+                arrays['snr'][pos:pos + n] = snrs.reshape(n, -1)[:, 0].numpy()
+                if self.keep_probs:
+                    arrays['prob'][pos:pos + n] = torch.softmax(logits, dim=1).cpu().numpy()
+                seconds['collect'] += time.perf_counter() - stage_time
+                pos += n
+                num_batches += 1
+
+        total = time.perf_counter() - start_time
+        stats = {'{}_ms'.format(stage): 1000 * seconds[stage] / max(num_batches, 1) for stage in STAGES}
+        stats.update(batches=num_batches, samples=pos, seconds=total, samples_per_sec=pos / max(total, 1e-12))
+        return {'arrays': {name: array[:pos] for name, array in arrays.items()},
+                'metrics': metrics.compute(), 'stats': stats}
+
+
+def write_results(arrays, save_path, formats=('csv', 'npz')):
+    """
+    Writes the result arrays in one go: output.csv (True_label, Predicted_label, SNR, as
+    compute_results reads it), output.npz with every array and/or output.parquet
+    """
+    os.makedirs(save_path, exist_ok=True)
+    if 'npz' in formats:
+        np.savez(os.path.join(save_path, 'output.npz'), **arrays)
+    if 'csv' in formats or 'parquet' in formats:
+        df = pd.DataFrame({'True_label': arrays['true'], 'Predicted_label': arrays['pred'], 'SNR': arrays['snr']})
+        if 'csv' in formats:
+            df.to_csv(os.path.join(save_path, 'output.csv'), index=False, quoting=csv.QUOTE_NONNUMERIC)
+        if 'parquet' in formats:
+            df.to_parquet(os.path.join(save_path, 'output.parquet'), index=False)
+
+
+def format_stats(stats):
+    return ("{samples} samples in {batches} batches, {seconds:.2f}s, {samples_per_sec:.1f} samples/sec\n"
+            "per batch: wait {wait_ms:.2f} ms, transfer {transfer_ms:.2f} ms, forward {forward_ms:.2f} ms, "
+            "collect {collect_ms:.2f} ms".format(**stats))
+
+
+def run_inference(model_path, test_set, save_path, factory=None, device=None, n_classes=8,
+                  formats=('csv', 'npz'), keep_probs=False):
+    """loads the model, runs it over test_set and writes output.* and test_logs.txt to save_path"""
+    device = device or ('cuda:0' if torch.cuda.is_available() else 'cpu')
+    load_time = time.perf_counter()
+    model = load_model(model_path, factory, device, n_classes)
+    load_time = time.perf_counter() - load_time
+
+    result = BatchInference(model, device, n_classes, keep_probs).run(test_set)
+    write_results(result['arrays'], save_path, formats)
+
+    metrics = result['metrics']
+    report = "Test loss: {} Test accuracy: {}  \nTest confusion matrix: \n{}\n\n".format(
+        metrics['loss'], metrics['accuracy'], metrics['confusion_matrix'].numpy())
+    timing = "model load {:.2f}s\n{}\n".format(load_time, format_stats(result['stats']))
+    with open(os.path.join(save_path, 'test_logs.txt'), 'w') as output_file:
+        output_file.write(report + timing)
+    print("Prediction:\n" + report + timing)
+    return result
+
+
+if __name__ == "__main__":
+    from data_processing.dataloader import load_batch
+
+    parser = ArgumentParser(description='Batch inference of a trained classifier on the test split of an HDF5 dataset')
+    parser.add_argument('--data_path', required=True, help='HDF5 dataset')
+    parser.add_argument('--model_path', required=True, help='state dict, Lightning checkpoint or torch.save\'d model')
+    parser.add_argument('--model', default=None, choices=sorted(MODEL_FACTORIES),
+                        help='factory the weights are loaded into, not needed for a whole model')
+    parser.add_argument('--save_path', required=True)
+    parser.add_argument('--n_classes', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--formats', nargs='+', default=['csv', 'npz'], choices=['csv', 'npz', 'parquet'])
+    parser.add_argument('--keep_probs', action='store_true', help='also store the class probabilities in the npz')
+    args = parser.parse_args()
+
+    test_set, _ = load_batch(args.data_path, args.batch_size, mode='test', aligned=True,
+                             num_workers=args.num_workers)
+    run_inference(args.model_path, test_set, args.save_path, args.model, args.device, args.n_classes,
+                  tuple(args.formats), args.keep_probs)
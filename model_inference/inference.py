@@ -1,9 +1,6 @@
 # inference module for cnn
-from torch.autograd import Variable
 # from train import *
 import pandas as pd
-from copy import deepcopy
-from tqdm import tqdm
 # torch.cuda.set_device(0)
 
 
@@ -16,7 +13,10 @@ import plotly.figure_factory as ff
 # plotly.io.orca.config.save()
 # pio.renderers.default = 'svg'
 
+import numpy as np
+from sklearn import metrics
 from models.pytorch_lightning.lightning_resnet import *
+from model_inference.batch_inference import run_inference
 
 def get_evaluation(y_true, y_prob, list_metrics):
 
@@ -79,87 +79,16 @@ def compute_results(csv_path, snrs):
 # datapath,x_test_gen,y_test_gen,y_test_raw,snr_gen,model_name
 
 
-def inference(datapath, test_set, model_name, save_path):
-
-    # x_test,y_test,labels_raw = load_batch(datapath+"vsg_no_intf_sc_normed.h5",batch_size=512,mode='test')
-    # iq, labels, snrs = reader.read_hdf5(path)
-    # test_bound = int(0.80 * labels.shape[0])
-    # training_params = {"batch_size": batch_size,
-    #                    "shuffle": False,
-    #                    "num_workers": 4}
-    # x_test_gen = DataLoader(iq[test_bound:].values, **training_params)
-    # y_test_gen = DataLoader(labels[test_bound:].values, **training_params)
-    # snr_gen = DataLoader(snrs[test_bound:].values, **training_params)
-    # y_test_raw = labels[test_bound:].values
-    # print("Data Loaded...")
-
-
-    # _labels =[]
-    # for _, l in enumerate(y_test_raw):
-    #     # print(x)
-    #     _labels.append(label_idx(l))
-    #
-    # unique, counts = np.unique(_labels, return_counts=True)
-    # print(np.asarray((unique, counts)).T)
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    output_file = open(save_path+"test_logs.txt", "w")
-    # torch.nn.Module.dump_patches=True
-    model = torch.load(datapath+model_name, map_location='cuda:0')
-    model.eval()
-
-    with torch.no_grad():
-
-        test_true = []
-        test_prob = []
-        snr_vals = []
-
-        for batch in tqdm(test_set):
-            _, n_true_label,snr = batch
-            true_label_copy = deepcopy(n_true_label)
-            test_true.extend(true_label_copy.cpu().data.numpy())
-            del n_true_label
-            snr_copy = deepcopy(snr)
-            snr_vals.extend(snr_copy.cpu().data.numpy())
-            del snr
-
-            batch = [Variable(record).cuda() for record in batch]
-
-            t_data, _, _ = batch
-            # x = t_data.view(-1, t_data.shape[1] * t_data.shape[2])
-            # input = ica.fit_transform(x.cpu())
-            # input = torch.Tensor(input).cuda()
-            # input = input.view(-1, 128, 2)
-            t_predicted_label = model(t_data)
-
-            test_prob.append(t_predicted_label)
-
-        test_prob = torch.cat(test_prob, 0)
-        test_prob = test_prob.cpu().data.numpy()
-        # test_true = np.array(test_true)
-        # test_pred = np.argmax(test_prob, -1)
-
-    fieldnames = ['True_label', 'Predicted_label', 'SNR']
-    with open(save_path + "output.csv", 'w',encoding='utf-8') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames, quoting=csv.QUOTE_NONNUMERIC)
-        writer.writeheader()
-        for i, j, k in zip(np.argmax(test_true, -1), np.argmax(test_prob, -1), snr_vals):
-            writer.writerow(
-                {'True_label': i, 'Predicted_label': j, 'SNR': k})
-
-    test_metrics = get_evaluation(test_true, test_prob,
-                                  list_metrics=["accuracy", "loss", "confusion_matrix"])
-    output_file.write(
-        "Test loss: {} Test accuracy: {}  \nTest confusion matrix: \n{}\n\n".format(
-            test_metrics["loss"],
-            test_metrics["accuracy"],
-            test_metrics["confusion_matrix"]))
-    output_file.close()
-
-    print("Prediction:\nLoss: {} Accuracy: {} \nConfusion matrix: \n{}".format(test_metrics["loss"],
-                                                                               test_metrics["accuracy"],
-                                                                               test_metrics["confusion_matrix"]))
+def inference(datapath, test_set, model_name, save_path, factory=None, device=None, n_classes=8,
+              formats=('csv', 'npz')):
+    """
+    Evaluates a trained model on test_set, writes output.csv (+ output.npz) and test_logs.txt to save_path
+    :param test_set: loader of (iq, one-hot label, snr) batches
+    :param factory: model the state dict at datapath+model_name is loaded into (see
+                    batch_inference.MODEL_FACTORIES); not needed for a torch.save'd model
+    :param device: default cuda:0 if available, else cpu
+    """
+    return run_inference(datapath + model_name, test_set, save_path, factory, device, n_classes, formats)
 
 
 def plot_confusion_matrix(cmap,num_samples,fig_name,snr):
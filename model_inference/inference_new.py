@@ -1,7 +1,9 @@
 # inference module for cnn
 from torch.autograd import Variable
 from data_processing.dataloader import *
+from sklearn import metrics
 from models.pytorch.train import get_evaluation
+from model_inference.batch_inference import load_model
 import csv
 import pandas as pd
 from copy import deepcopy
@@ -50,7 +52,11 @@ def compute_results(csv_path):
     return total_count,result
 
 
-def inference(save_path,x_test_gen,y_test_gen,y_test_raw,snr_gen,model_name):
+def inference(save_path,x_test_gen,y_test_gen,y_test_raw,snr_gen,model_name,factory=None):
+    """
+    x_test_gen may also be an aligned (iq, label, snr) loader, y_test_gen and snr_gen are None then
+    :param factory: batch_inference.MODEL_FACTORIES name of a model stored as a state dict
+    """
 
     _labels =[]
     for _, l in enumerate(y_test_raw):
@@ -61,9 +67,8 @@ def inference(save_path,x_test_gen,y_test_gen,y_test_raw,snr_gen,model_name):
     # print(np.asarray((unique, counts)).T)
 
     output_file = open(save_path + "test_logs.txt", "w")
-    model = torch.load(save_path + model_name, map_location='cuda:0')
+    model = load_model(save_path + model_name, factory, 'cuda:0')
     # ica = FastICA(n_components=256,tol=1e-5,max_iter=1000)
-    model.eval()
 
     with torch.no_grad():
 
@@ -71,7 +76,8 @@ def inference(save_path,x_test_gen,y_test_gen,y_test_raw,snr_gen,model_name):
         test_prob = []
         snr_vals = []
 
-        for batch in zip(x_test_gen,y_test_gen,snr_gen):
+        batches = x_test_gen if y_test_gen is None else zip(x_test_gen,y_test_gen,snr_gen)
+        for batch in batches:
             _, n_true_label,snr = batch
             true_label_copy = deepcopy(n_true_label)
             test_true.extend(true_label_copy.cpu().data.numpy())
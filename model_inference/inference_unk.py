@@ -1,6 +1,9 @@
 # inference module for cnn
+from torch.autograd import Variable
 from data_processing.dataloader import *
 from models.pytorch.train import *
+from models.pytorch.dnn import DNN
+from model_inference.batch_inference import load_model
 import csv
 from copy import deepcopy
 # torch.cuda.set_device(0)
@@ -28,8 +31,7 @@ def inference(datapath, save_path, batch_size):
     # print(np.asarray((unique, counts)).T)
 
     output_file = open(save_path + "logs.txt", "w")
-    model = torch.load(save_path + "dnn_baseline_model", map_location='cuda:0')
-    model.eval()
+    model = load_model(save_path + "dnn_baseline_model", lambda n_classes: DNN(2048, n_classes), 'cuda:0')
 
     with torch.no_grad():
 
@@ -0,0 +1,61 @@
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+
+class Runtime(object):
+    """CPU predictor for a model exported with models.pytorch.export.
+
+    'onnx' runs the .onnx file in an ONNX Runtime session with all graph optimizations,
+    'torchscript' the frozen .pt file, optimized for inference. Called with float32 numpy
+    arrays ((B, L, 2) IQ, plus (B, n_features) features for a featurized LightningCNN),
+    it returns the (B, n_classes) logits as a numpy array.
+    """
+
+    def __init__(self, path, backend=None, num_threads=None):
+        self.backend = backend or ('onnx' if path.endswith('.onnx') else 'torchscript')
+        if self.backend == 'onnx':
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        elif self.backend == 'torchscript':
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            module = torch.jit.load(path, map_location='cpu').eval()
+            self.module = torch.jit.optimize_for_inference(module)
+            # Classifier.forward(iq, features=None): the second input is only used by featurized models
+            self.input_names = ['iq', 'features']
+        else:
+            raise ValueError("unknown backend {}".format(self.backend))
+
+    def __call__(self, *arrays):
+        arrays = [np.ascontiguousarray(array, dtype=np.float32) for array in arrays]
+        if self.backend == 'onnx':
+            return self.session.run(None, dict(zip(self.input_names, arrays)))[0]
+        with torch.inference_mode():
+            return self.module(*[torch.from_numpy(array) for array in arrays]).numpy()
+
+    def predict(self, *arrays):
+        """predicted class ids"""
+        return np.argmax(self(*arrays), axis=1)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Classify random IQ batches with an exported model')
+    parser.add_argument('--path', required=True, help='.onnx or TorchScript .pt')
+    parser.add_argument('--backend', default=None, choices=['onnx', 'torchscript'])
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--length', type=int, default=1024)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    runtime = Runtime(args.path, args.backend, args.num_threads)
+    batch = np.random.RandomState(4).standard_normal((args.batch_size, args.length, 2)).astype(np.float32)
+    print(runtime.predict(batch)[:16], "startup {:.3f}s".format(time.perf_counter() - start_time))
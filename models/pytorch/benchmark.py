@@ -0,0 +1,142 @@
+import csv
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models.pytorch.cnn_model import CNN
+from models.pytorch.resnet import resnet18
+from models.pytorch.conv1d_models import CNN1d, resnet18_1d
+from models.pytorch.metrics import StreamingMetrics
+from models.pytorch.mixed_precision import autocast, grad_scaler, channels_last
+
+MODELS = {
+    'cnn': lambda n_classes: CNN(n_classes=n_classes),
+    'cnn1d': lambda n_classes: CNN1d(n_classes=n_classes),
+    'resnet18': lambda n_classes: resnet18(2, n_classes),
+    'resnet18_1d': lambda n_classes: resnet18_1d(2, n_classes),
+}
+
+
+def synthetic_data(num_rows, length=1024, snr_range=(0, 20), seed=4):
+    """(N, length, 2) float32 IQ and (N,) class ids of simulated SC/OFDM signals"""
+    from data_processing.simulation import synthesize
+    from data_processing.data_generation import MOD_SCHEMES
+    from data_processing.iq_conversion import complex_to_iq
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(len(MOD_SCHEMES), size=num_rows)
+    snrs = rng.uniform(snr_range[0], snr_range[1], size=num_rows)
+    iq = complex_to_iq(synthesize(labels, snrs, length, rng), np.complex64)
+    return torch.from_numpy(np.ascontiguousarray(iq)), torch.from_numpy(labels)
+
+
+def hdf5_data(path, num_rows, seed=4):
+    """num_rows random rows of an HDF5 dataset (iq, one-hot labels) as IQ and class ids"""
+    import h5py as h5
+    with h5.File(path, 'r') as file:
+        total = len(file['labels'])
+        rows = np.sort(np.random.RandomState(seed).choice(total, min(num_rows, total), replace=False))
+        iq = file['iq'][rows].astype(np.float32)
+        labels = np.argmax(file['labels'][rows], axis=1)
+    # rows were read in file order, which is sorted by class
+    order = np.random.RandomState(seed).permutation(len(rows))
+    return torch.from_numpy(iq[order]), torch.from_numpy(labels[order])
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(name, train, test, device, amp=False, use_channels_last=False, batch_size=256, epochs=1, warmup=5,
+        n_classes=8):
+    """
+    Trains one variant and evaluates it on test
+    :return: dict with median train step and inference batch time [ms] and test accuracy
+    """
+    torch.manual_seed(4)
+    model = MODELS[name](n_classes).to(device)
+    if use_channels_last:
+        channels_last(model)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    scaler = grad_scaler(device, amp)
+
+    x_train, y_train = train
+    step_times = []
+    model.train()
+    for _ in range(epochs):
+        order = torch.randperm(len(y_train))
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            iq, labels = x_train[rows].to(device), y_train[rows].to(device)
+            _sync(device)
+            start_time = time.perf_counter()
+            optimizer.zero_grad()
+            with autocast(device, amp):
+                loss = criterion(model(iq), labels)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            _sync(device)
+            step_times.append(time.perf_counter() - start_time)
+
+    x_test, y_test = test
+    metrics = StreamingMetrics(n_classes)
+    infer_times = []
+    model.eval()
+    with torch.no_grad():
+        for start in range(0, len(y_test), batch_size):
+            iq, labels = x_test[start:start + batch_size].to(device), y_test[start:start + batch_size].to(device)
+            _sync(device)
+            start_time = time.perf_counter()
+            with autocast(device, amp):
+                logits = model(iq)
+            _sync(device)
+            infer_times.append(time.perf_counter() - start_time)
+            metrics.update(criterion(logits.float(), labels), logits, labels)
+
+    result = metrics.compute()
+    return {'model': name, 'amp': amp, 'channels_last': use_channels_last,
+            'train_step_ms': 1000 * float(np.median(step_times[warmup:] or step_times)),
+            'infer_batch_ms': 1000 * float(np.median(infer_times[warmup:] or infer_times)),
+            'test_loss': result['loss'], 'test_accuracy': result['accuracy']}
+
+
+def benchmark(models, train, test, device, batch_size=256, epochs=1, results_path=None):
+    """every model in float32 and mixed precision, the 2-D models also channels-last"""
+    rows = []
+    for name in models:
+        for amp in (False, True):
+            for use_channels_last in ((False, True) if not name.endswith('1d') else (False,)):
+                row = run(name, train, test, device, amp, use_channels_last, batch_size, epochs)
+                print("{model:12s} amp={amp!s:5s} channels_last={channels_last!s:5s} "
+                      "train step {train_step_ms:8.2f} ms  inference {infer_batch_ms:8.2f} ms  "
+                      "accuracy {test_accuracy:.4f}".format(**row))
+                rows.append(row)
+    if results_path is not None:
+        with open(results_path, 'w', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]), quoting=csv.QUOTE_NONNUMERIC)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Step time and accuracy of the 2-D and Conv1d models, '
+                                        'float32 vs mixed precision')
+    parser.add_argument('--data_path', default=None, help='HDF5 dataset, simulated signals if not given')
+    parser.add_argument('--num_rows', type=int, default=20000)
+    parser.add_argument('--models', nargs='+', default=['cnn', 'cnn1d', 'resnet18', 'resnet18_1d'])
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--results_path', default=None)
+    args = parser.parse_args()
+
+    x, y = hdf5_data(args.data_path, args.num_rows) if args.data_path else synthetic_data(args.num_rows)
+    split = int(0.8 * len(y))
+    benchmark(args.models, (x[:split], y[:split]), (x[split:], y[split:]), args.device,
+              args.batch_size, args.epochs, args.results_path)
@@ -15,6 +15,7 @@ class CNN(nn.Module):
         self.n_classes = n_classes
         self.pool_size = pool_size
         self.padding = 2
+        self.channels_last = False   # set by mixed_precision.channels_last
 
         # pooling in layer 1,2,6 ; pool =3
         # layers 7,8 and 9 are fully connected
@@ -104,6 +105,8 @@ class CNN(nn.Module):
 
         input = input.permute(0,2,1)
         input = input.unsqueeze(dim=3)
+        if getattr(self, 'channels_last', False):
+            input = input.contiguous(memory_format=torch.channels_last)
 
         output = self.conv1(input)
         # print(output.size())
@@ -116,7 +119,7 @@ class CNN(nn.Module):
         output = self.conv6(output)
         # print("output after conv6:", output.shape)
 
-        output = output.view(output.size(0), -1)
+        output = output.reshape(output.size(0), -1)
         output = self.fc1(output)
         output = self.fc2(output)
         output = self.fc3(output)
@@ -0,0 +1,134 @@
+import copy
+import inspect
+import argparse
+from argparse import ArgumentParser
+
+import torch
+
+from models.pytorch.cnn_model import CNN
+from models.pytorch.resnet import Resnet
+from models.pytorch.resnet_simplified import ResNet
+from models.pytorch.conv1d_models import CNN1d, Resnet1d, conv1d_
+from model_inference.batch_inference import load_model
+
+
+def to_conv1d(model):
+    """
+    1-D copy of a trained 2-D model computing the same outputs: CNN -> CNN1d, Resnet -> Resnet1d.
+    Lightning and transfer modules (anything with a conv1d attribute) are copied, converted
+    with conv1d_ and flagged, so their forward skips the width axis.
+    """
+    if isinstance(model, (CNN1d, Resnet1d)) or getattr(model, 'conv1d', False):
+        return model
+    if isinstance(model, CNN):
+        return CNN1d.from_2d(model)
+    if isinstance(model, Resnet):
+        return Resnet1d.from_2d(model)
+    if isinstance(model, ResNet):
+        raise ValueError("resnet_simplified.ResNet has no 1-D equivalent, its 4x4 average pooling does not "
+                         "run on the width-1 axis; ResNet1d.from_2d ports its conv weights")
+    if hasattr(model, 'conv1d'):
+        converted = copy.deepcopy(model)
+        conv1d_(converted)
+        converted.conv1d = True
+        if getattr(converted, 'hparams', None) is not None:
+            converted.hparams.conv1d = True
+        return converted
+    raise TypeError("no 1-D version of {}".format(type(model).__name__))
+
+
+def _forward_args(model, batch_size):
+    # LightningCNN.forward(input, features)
+    if len(inspect.signature(model.forward).parameters) < 2:
+        return ()
+    hparams = model.hparams
+    return (torch.randn(batch_size, int(hparams.n_features)) if hparams.featurize else 0,)
+
+
+def verify(model_2d, model_1d, length=1024, batch_size=8, rtol=1e-4, seed=4):
+    """
+    Largest output difference of both models in eval mode on random (B, length, 2) inputs,
+    relative to the largest output; raises ValueError above rtol
+    """
+    model_2d.eval()
+    model_1d.eval()
+    torch.manual_seed(seed)
+    x = torch.randn(batch_size, length, 2)
+    args = _forward_args(model_2d, batch_size)
+    with torch.no_grad():
+        expected = model_2d(x, *args)
+        actual = model_1d(x, *args)
+    error = ((expected - actual).abs().max() / expected.abs().max().clamp_min(1e-12)).item()
+    if error > rtol:
+        raise ValueError("1-D model differs from the 2-D model by {:.2e} (relative)".format(error))
+    return error
+
+
+def convert_saved_model(path, out_path, factory=None, length=1024):
+    """
+    State dict of a 2-D model (train.py) -> state dict of the 1-D model, verified. It loads into
+    the matching 1-D factory of batch_inference.MODEL_FACTORIES, e.g. cnn -> cnn1d.
+    :param factory: MODEL_FACTORIES name of the 2-D model, not needed for a torch.save'd model
+    """
+    model = load_model(path, factory)
+    model_1d = to_conv1d(model)
+    error = verify(model, model_1d, length)
+    torch.save(model_1d.state_dict(), out_path)
+    return error
+
+
+def checkpoint_hparams(checkpoint, path=''):
+    """Namespace of the hyperparameters a Lightning checkpoint was saved with"""
+    key = 'hyper_parameters' if 'hyper_parameters' in checkpoint else 'hparams'
+    if not checkpoint.get(key):
+        raise ValueError("{} stores no hyperparameters, pass hparams".format(path))
+    stored = checkpoint[key]
+    # older Lightning versions pickle the Namespace itself
+    return copy.copy(stored) if isinstance(stored, argparse.Namespace) else argparse.Namespace(**stored)
+
+
+def _lightning_module(name):
+    if name == 'cnn':
+        from models.pytorch_lightning.py_lightning import LightningCNN
+        return LightningCNN
+    from models.pytorch_lightning.lightning_resnet import LightningResnet
+    return LightningResnet
+
+
+def convert_checkpoint(path, out_path, module='cnn', hparams=None, length=1024):
+    """
+    Lightning checkpoint -> checkpoint of the Conv1d module, verified. The result loads with
+    load_from_checkpoint and the same hparams plus conv1d=True.
+    :param module: 'cnn' (LightningCNN) or 'resnet' (LightningResnet)
+    :param hparams: Namespace the module was trained with, default: the one stored in the checkpoint
+    """
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    key = 'hyper_parameters' if 'hyper_parameters' in checkpoint else 'hparams'
+    hparams = copy.copy(hparams or checkpoint_hparams(checkpoint, path))
+    hparams.conv1d = False
+    model = _lightning_module(module)(hparams)
+    model.load_state_dict(checkpoint['state_dict'])
+    model_1d = to_conv1d(model)
+    error = verify(model, model_1d, length)
+
+    checkpoint['state_dict'] = model_1d.state_dict()
+    if checkpoint.get(key):
+        checkpoint[key] = dict(vars(checkpoint_hparams(checkpoint, path)), conv1d=True)
+    torch.save(checkpoint, out_path)
+    return error
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Port trained 2-D CNN/Resnet weights to the equivalent Conv1d models')
+    parser.add_argument('--input', required=True, help='.ckpt (Lightning), state dict or torch.save\'d model')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--module', default='cnn', choices=['cnn', 'resnet'], help='Lightning module of a .ckpt')
+    parser.add_argument('--factory', default='cnn', help='batch_inference.MODEL_FACTORIES model of a state dict')
+    parser.add_argument('--length', type=int, default=1024, help='IQ samples per input for the verification')
+    args = parser.parse_args()
+
+    if args.input.endswith('.ckpt'):
+        error = convert_checkpoint(args.input, args.output, args.module, length=args.length)
+    else:
+        error = convert_saved_model(args.input, args.output, args.factory, args.length)
+    print("wrote {}, largest relative output difference {:.2e}".format(args.output, error))
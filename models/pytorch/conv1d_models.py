@@ -0,0 +1,199 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from models.pytorch.resnet import Resnet, ResnetBasicBlock, ResnetBottleneckBlock
+
+
+class FoldedConvBlock(nn.Module):
+    """Conv2d + BatchNorm2d + ReLU + MaxPool2d block of CNN on its (B, C, L, 1) input, with a Conv1d.
+
+    Padding the width-1 axis by p gives 2p - k + 2 output columns, column w being a 1-D
+    convolution with column p - w of the k x k kernel. The columns the pooling window covers
+    are computed as extra output channels of one Conv1d, normalized together as BatchNorm2d
+    does and max-pooled along with the length axis, so the output equals the 2-D block's
+    (B, C, L', 1) output without the trailing axis, also in training mode.
+    """
+
+    def __init__(self, in_channels, out_channels, kernel_size=3, padding=2, pool_size=3):
+        super().__init__()
+        columns = 2 * padding - kernel_size + 2
+        # one pooling window over exactly all columns, so BatchNorm2d sees the same values
+        if padding >= kernel_size or columns != pool_size:
+            raise ValueError("kernel_size={}, padding={}, pool_size={} does not pool the width axis to 1"
+                             .format(kernel_size, padding, pool_size))
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.padding = padding
+        self.columns = columns
+        self.conv = nn.Conv1d(in_channels, self.columns * out_channels, kernel_size, padding=padding)
+        self.bn = nn.BatchNorm1d(out_channels)
+        self.relu = nn.ReLU()
+        self.pool = nn.MaxPool1d(pool_size)
+
+    @classmethod
+    def from_2d(cls, block):
+        """folded copy of a trained Sequential(Conv2d, BatchNorm2d, ReLU, MaxPool2d) with its weights"""
+        conv, bn, pool = block[0], block[1], block[3]
+        if conv.kernel_size[0] != conv.kernel_size[1] or conv.padding[0] != conv.padding[1]:
+            raise ValueError("{} is not a square kernel with equal padding".format(conv))
+        pool_size = pool.kernel_size if isinstance(pool.kernel_size, int) else pool.kernel_size[0]
+        folded = cls(conv.in_channels, conv.out_channels, conv.kernel_size[0], conv.padding[0], pool_size)
+        with torch.no_grad():
+            # output column w sees the input through kernel column padding - w
+            folded.conv.weight.copy_(torch.cat([conv.weight[:, :, :, folded.padding - w]
+                                                for w in range(folded.columns)]))
+            if conv.bias is not None:
+                folded.conv.bias.copy_(conv.bias.repeat(folded.columns))
+            else:
+                folded.conv.bias.zero_()
+        folded.bn.load_state_dict(bn.state_dict())
+        return folded.train(block.training)
+
+    def forward(self, x):
+        x = self.conv(x)
+        B, _, L = x.shape
+        # (B, columns * C, L) -> (B, C, columns * L): one set of batch statistics over all columns
+        x = x.view(B, self.columns, self.out_channels, L).transpose(1, 2).reshape(B, self.out_channels, -1)
+        x = self.relu(self.bn(x))
+        x = x.view(B, self.out_channels, self.columns, L).amax(dim=2)
+        return self.pool(x)
+
+
+class CNN1d(nn.Module):
+    """cnn_model.CNN with FoldedConvBlock layers; same arguments, same outputs for (B, L, 2) inputs"""
+
+    def __init__(self, n_classes, input_dim=2, max_seq_length=1024, filters=64, kernel_sizes=[3, 3, 3, 3, 3, 3],
+                 pool_size=3, n_fc_neurons=128):
+        super().__init__()
+        self.filters = filters
+        self.max_seq_length = max_seq_length
+        self.n_classes = n_classes
+        self.pool_size = pool_size
+        self.padding = 2
+
+        in_channels = [input_dim] + [filters] * 5
+        for i, (channels, kernel_size) in enumerate(zip(in_channels, kernel_sizes)):
+            setattr(self, 'conv{}'.format(i + 1),
+                    FoldedConvBlock(channels, filters, kernel_size, self.padding, pool_size))
+
+        self.fc1 = nn.Sequential(nn.Linear(n_fc_neurons, n_fc_neurons), nn.ReLU(), nn.Dropout(p=0.5))
+        self.fc2 = nn.Sequential(nn.Linear(n_fc_neurons, n_fc_neurons), nn.ReLU(), nn.Dropout(p=0.5))
+        self.fc3 = nn.Linear(n_fc_neurons, n_classes)
+
+    @classmethod
+    def from_2d(cls, model):
+        """CNN1d with the weights of a trained cnn_model.CNN"""
+        convs = [getattr(model, 'conv{}'.format(i))[0] for i in range(1, 7)]
+        cnn = cls(model.n_classes, input_dim=convs[0].in_channels, max_seq_length=model.max_seq_length,
+                  filters=model.filters, kernel_sizes=[conv.kernel_size[0] for conv in convs],
+                  pool_size=model.pool_size, n_fc_neurons=model.fc1[0].in_features)
+        for i in range(1, 7):
+            setattr(cnn, 'conv{}'.format(i), FoldedConvBlock.from_2d(getattr(model, 'conv{}'.format(i))))
+        for name in ('fc1', 'fc2', 'fc3'):
+            getattr(cnn, name).load_state_dict(getattr(model, name).state_dict())
+        return cnn.train(model.training)
+
+    def forward(self, input):
+        output = input.permute(0, 2, 1)
+        for i in range(1, 7):
+            output = getattr(self, 'conv{}'.format(i))(output)
+        output = output.reshape(output.size(0), -1)
+        output = self.fc1(output)
+        output = self.fc2(output)
+        return self.fc3(output)
+
+
+def _width_column(kernel_size, stride, padding):
+    """kernel column a 2-D conv applies to a width-1 input, None if its output is not width 1"""
+    width_out = (1 + 2 * padding - kernel_size) // stride + 1 if 1 + 2 * padding >= kernel_size else 0
+    return padding if width_out == 1 and padding < kernel_size else None
+
+
+def _is_cnn_block(module):
+    # Sequential(Conv2d, BatchNorm2d, ReLU, MaxPool2d) whose conv widens the width-1 axis, as in CNN
+    return (isinstance(module, nn.Sequential) and len(module) == 4 and isinstance(module[0], nn.Conv2d)
+            and isinstance(module[1], nn.BatchNorm2d) and isinstance(module[2], nn.ReLU)
+            and isinstance(module[3], nn.MaxPool2d)
+            and _width_column(module[0].kernel_size[1], module[0].stride[1], module[0].padding[1]) is None)
+
+
+def conv1d_(module):
+    """
+    Replaces, in place, every 2-D layer of module by its 1-D counterpart on the length axis,
+    keeping the weights, so the module computes the same function on (B, C, L) inputs as it
+    did on (B, C, L, 1). Layers that keep the width axis at 1 (Resnet: centered kernels,
+    "same" padding) become Conv1d/BatchNorm1d/... with the used kernel column; CNN blocks
+    become FoldedConvBlocks. Module names are kept.
+    """
+    for name, child in module.named_children():
+        if _is_cnn_block(child):
+            layer = FoldedConvBlock.from_2d(child)
+        elif isinstance(child, nn.Conv2d):
+            column = _width_column(child.kernel_size[1], child.stride[1], child.padding[1])
+            if column is None:
+                raise ValueError("{} does not keep the width axis at 1".format(child))
+            layer = nn.Conv1d(child.in_channels, child.out_channels, child.kernel_size[0], stride=child.stride[0],
+                              padding=child.padding[0], dilation=child.dilation[0], groups=child.groups,
+                              bias=child.bias is not None)
+            with torch.no_grad():
+                layer.weight.copy_(child.weight[:, :, :, column])
+                if child.bias is not None:
+                    layer.bias.copy_(child.bias)
+            layer.weight.requires_grad = child.weight.requires_grad
+        elif isinstance(child, nn.BatchNorm2d):
+            layer = nn.BatchNorm1d(child.num_features, eps=child.eps, momentum=child.momentum,
+                                   affine=child.affine, track_running_stats=child.track_running_stats)
+            layer.load_state_dict(child.state_dict())
+            for param, source in zip(layer.parameters(), child.parameters()):
+                param.requires_grad = source.requires_grad
+        elif isinstance(child, nn.MaxPool2d):
+            pair = lambda v: v if isinstance(v, tuple) else (v, v)
+            layer = nn.MaxPool1d(pair(child.kernel_size)[0], stride=pair(child.stride)[0],
+                                 padding=pair(child.padding)[0], ceil_mode=child.ceil_mode)
+        elif isinstance(child, nn.AdaptiveAvgPool2d):
+            size = child.output_size
+            layer = nn.AdaptiveAvgPool1d(size[0] if isinstance(size, tuple) else size)
+        else:
+            conv1d_(child)
+            continue
+        setattr(module, name, layer.train(child.training))
+    return module
+
+
+class Resnet1d(Resnet):
+    """resnet.Resnet with Conv1d/BatchNorm1d/MaxPool1d layers; same arguments, same outputs"""
+
+    def __init__(self, in_channels, n_classes, *args, **kwargs):
+        super().__init__(in_channels, n_classes, *args, **kwargs)
+        conv1d_(self)
+
+    @classmethod
+    def from_2d(cls, model):
+        """Resnet1d with the weights of a trained resnet.Resnet"""
+        resnet = cls.__new__(cls)
+        nn.Module.__init__(resnet)
+        resnet.encoder = conv1d_(copy.deepcopy(model.encoder))
+        resnet.decoder = conv1d_(copy.deepcopy(model.decoder))
+        resnet.channels_last = False
+        return resnet.train(model.training)
+
+    def forward(self, x):
+        x = x.permute(0, 2, 1)
+        x = self.encoder(x)
+        x = self.decoder(x)
+        return x
+
+
+def resnet18_1d(in_channels, n_classes):
+    return Resnet1d(in_channels, n_classes, block=ResnetBasicBlock, depths=[2, 2, 2, 2])
+
+
+def resnet50_1d(in_channels, n_classes):
+    return Resnet1d(in_channels, n_classes, block=ResnetBottleneckBlock, depths=[3, 4, 6, 3])
+
+
+if __name__ == "__main__":
+    for model in (CNN1d(n_classes=8), resnet18_1d(2, 8)):
+        print(type(model).__name__, model(torch.ones((2, 1024, 2))).shape)
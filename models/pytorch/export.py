@@ -0,0 +1,220 @@
+import os
+import csv
+import copy
+import time
+import inspect
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models.pytorch.conv1d_models import FoldedConvBlock
+from models.pytorch.conv1d_convert import checkpoint_hparams
+from model_inference.batch_inference import MODEL_FACTORIES, load_model
+from model_inference.runtime import Runtime
+
+KINDS = sorted(MODEL_FACTORIES) + ['model', 'lightning_cnn', 'lightning_resnet', 'transfer_cnn', 'transfer_resnet']
+
+
+def load_trained(kind, path, hparams=None, n_classes=8):
+    """
+    Trained classifier on the cpu in eval mode
+    :param kind: a batch_inference.MODEL_FACTORIES name (state dict), 'model' (torch.save'd model),
+                 lightning_cnn / lightning_resnet (checkpoint, hparams stored in it by default) or
+                 transfer_cnn / transfer_resnet (checkpoint, loaded with load_from_checkpoint)
+    """
+    if kind == 'model':
+        return load_model(path)
+    if kind in ('lightning_cnn', 'lightning_resnet'):
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        if kind == 'lightning_cnn':
+            from models.pytorch_lightning.py_lightning import LightningCNN as module
+        else:
+            from models.pytorch_lightning.lightning_resnet import LightningResnet as module
+        model = module(hparams or checkpoint_hparams(checkpoint, path))
+        model.load_state_dict(checkpoint['state_dict'])
+        return model.eval()
+    if kind in ('transfer_cnn', 'transfer_resnet'):
+        if kind == 'transfer_cnn':
+            from models.pytorch_lightning.lightning_transfer_learning import TransferLearningModel as module
+        else:
+            from models.pytorch_lightning.transfer_resnet import TransferLearningModel as module
+        kwargs = {'hparams': hparams} if hparams is not None else {}
+        return module.load_from_checkpoint(checkpoint_path=path, map_location='cpu', **kwargs).eval()
+    return load_model(path, kind, 'cpu', n_classes)
+
+
+def _fold_block(block):
+    # BatchNorm1d of a FoldedConvBlock normalizes every column of a channel alike
+    conv, bn = block.conv, block.bn
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    with torch.no_grad():
+        conv.weight.mul_(scale.repeat(block.columns).view(-1, 1, 1))
+        conv.bias.copy_(conv.bias * scale.repeat(block.columns) + shift.repeat(block.columns))
+    block.bn = nn.Identity()
+
+
+def fold_batchnorm(model):
+    """
+    Eval-mode copy of model with every BatchNorm merged into the conv before it: Conv + BatchNorm
+    pairs in a Sequential (CNN blocks, Resnet conv_bn, gate and shortcut) and FoldedConvBlocks.
+    The BatchNorm layers are replaced by nn.Identity, so module names stay the same.
+    """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        if isinstance(module, FoldedConvBlock):
+            _fold_block(module)
+        elif isinstance(module, nn.Sequential):
+            names = list(module._modules)
+            for name, next_name in zip(names, names[1:]):
+                conv, bn = module._modules[name], module._modules[next_name]
+                if isinstance(conv, (nn.Conv1d, nn.Conv2d)) and isinstance(bn, (nn.BatchNorm1d, nn.BatchNorm2d)) \
+                        and bn.track_running_stats and bn.num_features == conv.out_channels:
+                    setattr(module, name, fuse_conv_bn_eval(conv, bn))
+                    setattr(module, next_name, nn.Identity())
+    return model
+
+
+class Classifier(nn.Module):
+    """
+    (B, L, 2) IQ -> logits for export. LightningCNN.forward also takes the hand crafted
+    features; they are a second input if the model was trained with them, else None.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.takes_features = len(inspect.signature(model.forward).parameters) > 1
+        hparams = getattr(model, 'hparams', None)
+        self.n_features = int(hparams.n_features) if self.takes_features and hparams.featurize else 0
+
+    def example_inputs(self, batch_size=8, length=1024, seed=4):
+        generator = torch.Generator().manual_seed(seed)
+        inputs = (torch.randn(batch_size, length, 2, generator=generator),)
+        if self.n_features:
+            inputs += (torch.randn(batch_size, self.n_features, generator=generator),)
+        return inputs
+
+    def forward(self, iq, features=None):
+        if self.takes_features:
+            return self.model(iq, features)
+        return self.model(iq)
+
+
+def _relative_error(expected, actual):
+    expected, actual = np.asarray(expected, dtype=np.float64), np.asarray(actual, dtype=np.float64)
+    return float(np.abs(expected - actual).max() / max(np.abs(expected).max(), 1e-12))
+
+
+def export(model, out_dir, name='model', length=1024, batch_size=8, formats=('torchscript', 'onnx'), opset=13,
+           rtol=1e-4):
+    """
+    Folds the BatchNorm layers of a trained classifier and writes out_dir/name.pt (frozen
+    TorchScript) and/or out_dir/name.onnx, both with a dynamic batch axis. The folded model and
+    the TorchScript artifact are checked against the eager model on random inputs.
+    :return: {format: path}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    model = model.cpu().eval()
+    classifier = Classifier(fold_batchnorm(model)).eval()
+    inputs = classifier.example_inputs(batch_size, length)
+    with torch.no_grad():
+        expected = Classifier(model)(*inputs)
+        error = _relative_error(expected, classifier(*inputs))
+    if error > rtol:
+        raise ValueError("folded model differs from the trained model by {:.2e} (relative)".format(error))
+
+    paths = {}
+    if 'torchscript' in formats:
+        paths['torchscript'] = os.path.join(out_dir, name + '.pt')
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(classifier, inputs))
+            error = _relative_error(expected, traced(*inputs))
+        if error > rtol:
+            raise ValueError("traced model differs from the trained model by {:.2e} (relative)".format(error))
+        traced.save(paths['torchscript'])
+    if 'onnx' in formats:
+        paths['onnx'] = os.path.join(out_dir, name + '.onnx')
+        input_names = ['iq', 'features'][:len(inputs)]
+        torch.onnx.export(classifier, inputs, paths['onnx'], input_names=input_names, output_names=['logits'],
+                          dynamic_axes={input_name: {0: 'batch'} for input_name in input_names + ['logits']},
+                          opset_version=opset, do_constant_folding=True)
+    return paths
+
+
+def benchmark(load_eager, paths, length=1024, batch_size=256, num_batches=50, warmup=5, num_threads=None,
+              results_path=None):
+    """
+    Startup time (loading until the first batch is classified) and median per-batch latency on
+    the cpu of the eager model and every exported artifact, for models taking IQ only
+    :param load_eager: callable returning the eager model, timed as its startup
+    :param paths: {format: path} as returned by export
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    def eager():
+        classifier = Classifier(load_eager().cpu().eval())
+
+        def predict(*arrays):
+            with torch.inference_mode():
+                return classifier(*[torch.from_numpy(array) for array in arrays]).numpy()
+        return predict
+
+    loaders = {'eager': eager}
+    for backend, path in paths.items():
+        loaders[backend] = lambda backend=backend, path=path: Runtime(path, backend, num_threads)
+
+    rng = np.random.RandomState(4)
+    rows = []
+    for backend, load in loaders.items():
+        start_time = time.perf_counter()
+        predict = load()
+        batch = (rng.standard_normal((batch_size, length, 2)).astype(np.float32),)
+        predict(*batch)
+        startup = time.perf_counter() - start_time
+
+        times = []
+        for _ in range(warmup + num_batches):
+            start_time = time.perf_counter()
+            predict(*batch)
+            times.append(time.perf_counter() - start_time)
+        row = {'backend': backend, 'startup_s': startup, 'batch_ms': 1000 * float(np.median(times[warmup:])),
+               'samples_per_sec': batch_size / float(np.median(times[warmup:]))}
+        print("{backend:12s} startup {startup_s:7.3f} s  batch {batch_ms:8.2f} ms  "
+              "{samples_per_sec:10.1f} samples/sec".format(**row))
+        rows.append(row)
+
+    if results_path is not None:
+        with open(results_path, 'w', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]), quoting=csv.QUOTE_NONNUMERIC)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Export a trained classifier to TorchScript/ONNX with BatchNorm folded')
+    parser.add_argument('--input', required=True, help='state dict, torch.save\'d model or Lightning checkpoint')
+    parser.add_argument('--kind', required=True, choices=KINDS)
+    parser.add_argument('--out_dir', required=True)
+    parser.add_argument('--name', default='model')
+    parser.add_argument('--n_classes', type=int, default=8)
+    parser.add_argument('--length', type=int, default=1024, help='IQ samples per input')
+    parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--opset', type=int, default=13)
+    parser.add_argument('--benchmark', action='store_true', help='compare startup and latency with eager pytorch')
+    parser.add_argument('--batch_size', type=int, default=256, help='benchmark batch size')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    load = lambda: load_trained(args.kind, args.input, n_classes=args.n_classes)
+    paths = export(load(), args.out_dir, args.name, args.length, formats=tuple(args.formats), opset=args.opset)
+    for backend, path in paths.items():
+        print("wrote {} ({})".format(path, backend))
+    if args.benchmark:
+        benchmark(load, paths, args.length, args.batch_size, num_threads=args.num_threads,
+                  results_path=os.path.join(args.out_dir, args.name + '_benchmark.csv'))
@@ -0,0 +1,57 @@
+import torch
+
+
+class StreamingMetrics(object):
+    """Running loss, accuracy and confusion matrix of a classifier, accumulated on the device.
+
+    update() only launches tensor ops on the device of the batch; nothing is copied to the
+    host until compute() is called, e.g. every log_interval steps or at the end of an epoch.
+    Targets may be class ids (N,) or one-hot rows (N, C).
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = None
+        self.count = None
+        self.confusion = None
+
+    def _allocate(self, device):
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.count = torch.zeros((), dtype=torch.int64, device=device)
+        self.confusion = torch.zeros(self.num_classes * self.num_classes, dtype=torch.int64, device=device)
+
+    @torch.no_grad()
+    def update(self, loss, logits, targets):
+        """
+        :param loss: mean loss of the batch (scalar tensor)
+        :param logits: (N, C) scores, or (N,) predicted class ids
+        :param targets: (N,) class ids or (N, C) one-hot rows
+        """
+        if self.confusion is None:
+            self._allocate(logits.device)
+        preds = logits.argmax(dim=1) if logits.dim() > 1 else logits
+        if targets.dim() > 1:
+            targets = targets.argmax(dim=1)
+        targets = targets.to(preds.device).long()
+        n = targets.numel()
+        self.loss_sum += loss.detach().double() * n
+        self.count += n
+        self.confusion += torch.bincount(targets * self.num_classes + preds.long(),
+                                         minlength=self.num_classes * self.num_classes)
+
+    def should_log(self, step, log_interval):
+        return log_interval > 0 and (step + 1) % log_interval == 0
+
+    def compute(self):
+        """loss, accuracy (floats) and confusion matrix (C, C, rows = true class) on the host"""
+        if self.confusion is None:
+            return {'loss': float('nan'), 'accuracy': float('nan'),
+                    'confusion_matrix': torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64)}
+        confusion = self.confusion.view(self.num_classes, self.num_classes).cpu()
+        count = max(int(self.count.item()), 1)
+        return {'loss': self.loss_sum.item() / count,
+                'accuracy': confusion.diag().sum().item() / count,
+                'confusion_matrix': confusion}
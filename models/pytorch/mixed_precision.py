@@ -0,0 +1,34 @@
+import contextlib
+
+import torch
+
+
+def autocast(device, enabled=True, dtype=None):
+    """
+    Mixed precision context for the given device: float16 AMP on cuda, bfloat16 on cpu
+    :param dtype: overrides the default reduced precision type
+    """
+    device_type = torch.device(device).type
+    if not enabled:
+        return contextlib.nullcontext()
+    if dtype is None:
+        dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+
+def grad_scaler(device, enabled=True):
+    """loss scaler for float16 training; a no-op on cpu (bfloat16 needs no scaling) or when disabled"""
+    return torch.amp.GradScaler('cuda', enabled=enabled and torch.device(device).type == 'cuda')
+
+
+def channels_last(model):
+    """
+    Stores the conv weights of a 2-D model as NHWC and makes its forward feed NHWC inputs.
+    The (B, L, 2) IQ input permuted to (B, 2, L, 1) already has a channels-last layout, so
+    the conversion costs no copy.
+    """
+    model.to(memory_format=torch.channels_last)
+    for module in model.modules():
+        if hasattr(module, 'channels_last'):
+            module.channels_last = True
+    return model
@@ -166,7 +166,7 @@ class ResnetDecoder(nn.Module):
 
     def forward(self, x):
         x = self.avg(x)
-        x = x.view(x.size(0),-1)
+        x = x.reshape(x.size(0),-1)
         x = self.fc1(x)
         x = self.activation(x)
         x = self.dropout(x)
@@ -184,10 +184,13 @@ class Resnet(nn.Module):
         super().__init__()
         self.encoder = ResnetEncoder(in_channels,*args,**kwargs)
         self.decoder = ResnetDecoder(self.encoder.blocks[-1].blocks[-1].expanded_channels,n_classes)
+        self.channels_last = False   # set by mixed_precision.channels_last
 
     def forward(self, x):
         x = x.permute(0, 2, 1)
         x = x.unsqueeze(dim=3)
+        if getattr(self, 'channels_last', False):
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.encoder(x)
         x = self.decoder(x)
         return x
@@ -1,9 +1,12 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 #from torchsummary import summary
 from pytorch_model_summary import summary
 
+from models.pytorch.conv1d_models import conv1d_
+
 
 class BasicBlock(nn.Module):
     expansion = 1
@@ -93,6 +96,42 @@ class ResNet(nn.Module):
         return out
 
 
+class ResNet1d(ResNet):
+    """
+    ResNet on the length axis: the same blocks as Conv1d/BatchNorm1d layers.
+    ResNet average-pools its (B, C, L/8, 1) output with a 4x4 window, which fails on the
+    width-1 axis, so this is a working 1-D variant rather than an equivalent; its linear layer
+    is sized for max_seq_length. from_2d ports all conv and BatchNorm weights of a ResNet.
+    """
+
+    def __init__(self, block, num_blocks, num_classes=10, max_seq_length=1024):
+        super(ResNet1d, self).__init__(block, num_blocks, num_classes)
+        conv1d_(self)
+        self.linear = nn.Linear(512*block.expansion*(max_seq_length//32), num_classes)
+
+    @classmethod
+    def from_2d(cls, model, max_seq_length=1024):
+        """ResNet1d with the conv and BatchNorm weights of a ResNet, the linear layer is left untrained"""
+        layers = [model.layer1, model.layer2, model.layer3, model.layer4]
+        resnet = cls(type(model.layer1[0]), [len(layer) for layer in layers], model.linear.out_features,
+                     max_seq_length)
+        ported = conv1d_(copy.deepcopy(model)).state_dict()
+        resnet.load_state_dict({k: v for k, v in ported.items() if not k.startswith('linear.')}, strict=False)
+        return resnet
+
+    def forward(self, x):
+        out = x.permute(0, 2, 1)
+        out = F.relu(self.bn1(self.conv1(out)))
+        out = self.layer1(out)
+        out = self.layer2(out)
+        out = self.layer3(out)
+        out = self.layer4(out)
+        out = F.avg_pool1d(out, 4)
+        out = out.view(out.size(0), -1)
+        out = self.linear(out)
+        return out
+
+
 def ResNet18(n_classes):
     return ResNet(BasicBlock, [2,2,2,2],num_classes=n_classes)
 
@@ -3,12 +3,15 @@ from models import cnn_model
 import dataloader as dl
 import inference_new as inf
 
+import time
 import torch.nn as nn
 import torch
 import numpy as np
 from sklearn import metrics
-from torch.autograd import Variable
 from collections import defaultdict
+from models.pytorch.metrics import StreamingMetrics
+from models.pytorch.conv1d_models import CNN1d
+from models.pytorch.mixed_precision import autocast, grad_scaler, channels_last
 
 
 # torch.cuda.set_device(1)
@@ -27,12 +30,20 @@ def Convert(tup, di):
     return di
 
 
-def train(data_path,num_epochs):
+def train(data_path,num_epochs,log_interval=100,num_workers=4,prefetch_factor=2,amp=False,
+          conv1d=False,use_channels_last=False):
+    """
+    :param amp: float16 autocast with loss scaling for training and validation
+    :param conv1d: train the Conv1d equivalent of the CNN
+    :param use_channels_last: NHWC memory format for the 2-D CNN
+    """
 
-    # x_test,y_test,raw_lables,snr_gen
-    x_train,y_train,x_val,y_val, x_test,y_test,raw_lables,snr_gen = \
+    # one (iq, label, snr) loader per split, batches in pinned memory for non-blocking copies
+    train_gen, val_gen, test_gen, raw_lables = \
         dl.load_batch("/home/rachneet/rf_dataset_inets/dataset_deepsig_vier_new.hdf5"
-                      ,512,mode='both')  #GOLD_XYZ_OSC.0001_1024.hdf5
+                      ,512,mode='both',aligned=True,num_workers=num_workers,
+                      pin_memory=True,prefetch_factor=prefetch_factor)  #GOLD_XYZ_OSC.0001_1024.hdf5
+    train_batches = dl.LoaderTimer(train_gen)
     # y_train = torch.from_numpy(y_train).view(-1, 1)
     # y_val = torch.from_numpy(y_val).view(-1, 1)
     # path = "/media/backup/Arsenal/rf_dataset_inets/dataset_intf_free_no_cfo_vsg_snr20_1024.h5"
@@ -41,11 +52,14 @@ def train(data_path,num_epochs):
     # y_train = DataLoader(labels,batch_size=2)
 
     print("Data loaded and batched...")
-    model = cnn_model.CNN(n_classes=8)
+    model = CNN1d(n_classes=8) if conv1d else cnn_model.CNN(n_classes=8)
     # model = dnn.DNN(2048, n_classes=8)
     # model = resnet.resnet50(2,24)
     # model = resnet_simplified.ResNet50(n_classes=8)
     model.cuda()
+    if use_channels_last and not conv1d:
+        channels_last(model)
+    scaler = grad_scaler('cuda', amp)
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
 
@@ -57,8 +71,11 @@ def train(data_path,num_epochs):
     #     else:
     #         l2_reg = l2_reg+w.norm(2)
 
-    num_iter_per_epoch = len(x_train)
+    num_iter_per_epoch = len(train_batches)
     best_accuracy = 0
+    # accumulated on the gpu, read back every log_interval iterations and once per epoch
+    train_metrics = StreamingMetrics(8)
+    val_metrics = StreamingMetrics(8)
     # reg_lambda = 0.1
 
     output_file = open(data_path+"train_logs.txt", "w")
@@ -67,73 +84,69 @@ def train(data_path,num_epochs):
     # activations = visualize.SaveFeatures(list(model.children())[5])
     model.train()
     for epoch in range(num_epochs):
-        running_loss = 0
-        average_loss = 0
+        train_metrics.reset()
+        epoch_start = time.perf_counter()
 
-        for iter, batch in enumerate(zip(x_train,y_train)):
+        for iter, (t_iq, t_mod, _) in enumerate(train_batches):
 
-            _, n_mod = batch
-
-            batch = [Variable(record).cuda() for record in batch]
+            t_iq = t_iq.cuda(non_blocking=True)
+            t_mod = t_mod.cuda(non_blocking=True)
             optimizer.zero_grad()
-            t_iq, t_mod = batch
 
             # # perform blind source separation
             # x = t_iq.view(-1, t_iq.shape[1] * t_iq.shape[2])
             # input = ica.fit_transform(x.cpu())
             # input = torch.Tensor(input).cuda()
             # input = input.view(-1,128,2)
-            pred = model(t_iq)
-            n_prob_label = pred.cpu().data.numpy()
-            # print("Model Prediction: {}".format(n_prob_label))
-            loss = criterion(pred, torch.max(t_mod,1)[1])   # + l2_reg*reg_lambda
-            running_loss += loss.item()
-            # print("Running loss: {}".format(running_loss))
-            loss.backward()
-            optimizer.step()
-
-            training_metrics = get_evaluation(n_mod.cpu().data.numpy(), n_prob_label, list_metrics=["accuracy", "loss"])
-
-            print("Training: Iteration: {}/{} Epoch: {}/{} Loss: {} Accuracy: {}".format(iter + 1,
-                                                                                         num_iter_per_epoch,
-                                                                                         epoch + 1, num_epochs,
-                                                                                         training_metrics["loss"],
-                                                                                         training_metrics[
-                                                                                             "accuracy"]))
-        average_loss = running_loss/num_iter_per_epoch
+            with autocast('cuda', amp):
+                pred = model(t_iq)
+                loss = criterion(pred, torch.max(t_mod,1)[1])   # + l2_reg*reg_lambda
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            train_metrics.update(loss, pred, t_mod)
+
+            if train_metrics.should_log(iter, log_interval):
+                training_metrics = train_metrics.compute()
+                print("Training: Iteration: {}/{} Epoch: {}/{} Loss: {} Accuracy: {}".format(iter + 1,
+                                                                                             num_iter_per_epoch,
+                                                                                             epoch + 1, num_epochs,
+                                                                                             training_metrics["loss"],
+                                                                                             training_metrics[
+                                                                                                 "accuracy"]))
+        training_metrics = train_metrics.compute()
+        torch.cuda.synchronize()
+        epoch_time = time.perf_counter() - epoch_start
+        timing = "Epoch time: {:.1f}s, waiting for data: {:.1f}s ({:.0%}), compute: {:.1f}s".format(
+            epoch_time, train_batches.wait, train_batches.wait / epoch_time, epoch_time - train_batches.wait)
+        average_loss = training_metrics["loss"]
         print("Average loss: {}".format(average_loss))
+        print(timing)
 
             # print("pred during training: {}".format(np.argmax(prediction.cpu().data.numpy(), -1)))
         # evaluation of validation data
         model.eval()
         with torch.no_grad():
 
-            validation_true = []
-            validation_prob = []
+            val_metrics.reset()
 
-            for batch in zip(x_val,y_val):
-                _, n_mod = batch
-                batch = [Variable(record).cuda() for record in batch]
+            for t_iq, t_mod, _ in val_gen:
                 # get inputs
-                t_iq, _ = batch
+                t_iq = t_iq.cuda(non_blocking=True)
+                t_mod = t_mod.cuda(non_blocking=True)
                 # perform blind source separation
                 # x = t_iq.view(-1, t_iq.shape[1] * t_iq.shape[2])
                 # input = ica.fit_transform(x.cpu())
                 # input = torch.Tensor(input).cuda()
                 # input = input.view(-1, 128, 2)
                 # forward pass
-                t_predicted_label = model(t_iq)
+                with autocast('cuda', amp):
+                    t_predicted_label = model(t_iq)
                 # using sigmoid to predict the label
                 # t_predicted_label = F.sigmoid(t_predicted_label)
 
-                validation_prob.append(t_predicted_label)
-                validation_true.extend(n_mod.cpu().data.numpy())
-
-                # print(validation_true, validation_prob)
-
+                val_metrics.update(criterion(t_predicted_label.float(), torch.max(t_mod,1)[1]), t_predicted_label, t_mod)
 
-            validation_prob = torch.cat(validation_prob, 0)
-            validation_prob = validation_prob.cpu().data.numpy()
             # y_pred = np.argmax(validation_prob, -1)
             # print("val predicted:{}".format(validation_prob[0]))
             # print("val cleaned:{}".format(y_pred))
@@ -141,18 +154,19 @@ def train(data_path,num_epochs):
             # back to default:train
         model.train()
 
-        test_metrics = get_evaluation(validation_true, validation_prob,
-                                      list_metrics=["accuracy", "loss", "confusion_matrix"])
+        test_metrics = val_metrics.compute()
+        test_metrics["confusion_matrix"] = str(test_metrics["confusion_matrix"].numpy())
 
         output_file.write(
             "Epoch: {}/{} \nTraining loss: {} Training accuracy: {} \nTest loss: {} Test accuracy: {}"
-            "\nAverage Loss: {} \nTest confusion matrix: \n{}\n\n".format(
+            "\nAverage Loss: {} \n{} \nTest confusion matrix: \n{}\n\n".format(
                 epoch + 1, num_epochs,
                 training_metrics["loss"],
                 training_metrics["accuracy"],
                 test_metrics["loss"],
                 test_metrics["accuracy"],
                 average_loss,
+                timing,
                 test_metrics["confusion_matrix"]))
         print("\tTest:Epoch: {}/{} Loss: {} Accuracy: {}\r".format(epoch + 1, num_epochs, test_metrics["loss"],
                                                                     test_metrics["accuracy"]))
@@ -164,12 +178,13 @@ def train(data_path,num_epochs):
         # saving the model with best accuracy
         if test_metrics["accuracy"] > best_accuracy:
             best_accuracy = test_metrics["accuracy"]
-            torch.save(model, data_path+"model")
+            # weights only, loaded into the model class by batch_inference.load_model
+            torch.save(model.state_dict(), data_path+"model")
 
     print("Training complete")
     print("-------------------------------------------")
     print("Starting inference module")
-    inf.inference(data_path, x_test, y_test, raw_lables, snr_gen, "model")
+    inf.inference(data_path, test_gen, None, raw_lables, None, "model", factory='cnn1d' if conv1d else 'cnn')
 
 
 def get_evaluation(y_true, y_prob, list_metrics):
@@ -6,7 +6,7 @@ from sklearn import preprocessing
 from sklearn.model_selection import train_test_split
 import xgboost as xg
 from sklearn.metrics import precision_score, recall_score, accuracy_score, classification_report, confusion_matrix
-from sklearn.model_selection import GridSearchCV, KFold, cross_val_score
+from sklearn.model_selection import KFold, cross_val_score
 import glob
 import re
 import csv
@@ -18,10 +18,112 @@ from xgboost import plot_tree
 from inference.inference import compute_results
 import data_processing.dataloader as dl
 from data_processing.merge_filtered import *
+from data_processing.feature_store import FeatureStore, is_feature_store
+from models.pytorch.xgb_search import search
+
+
+def split_bounds(num_rows, train_size, test_size=0.2):
+    """
+    [start, stop) ranks of the train/val/test rows of a shuffled dataset, the same
+    rows XgbModule.classifier gets from train_test_split(shuffle=False)
+    """
+    n_test = int(np.ceil(test_size * num_rows))
+    n_tr = num_rows - n_test
+    n_train = int(np.floor(train_size / (1 - test_size) * n_tr))
+    return {'train': (0, n_train), 'val': (n_train, n_tr), 'test': (n_tr, num_rows)}
+
+
+def shuffle_rank(num_rows, seed=4):
+    """position of every row after the seeded shuffle of create_deepsig_set"""
+    np.random.seed(seed)
+    idx = np.random.permutation(num_rows)
+    rank = np.empty(num_rows, dtype=np.int64)
+    rank[idx] = np.arange(num_rows)
+    return rank
+
+
+def _with_snr(features, snrs, snr_feature):
+    # SNR is the first feature column of the featurized CSVs
+    return np.column_stack([snrs, features]).astype(np.float32) if snr_feature else features
+
+
+def load_store_splits(store, train_size, test_size=0.2, snr_feature=True):
+    """{split: (features, labels, snrs)} of a FeatureStore in memory, rows in shuffled order"""
+    features, snrs, labels, row_ids = store.load()
+    rank = shuffle_rank(store.num_rows)[row_ids]
+    order = np.argsort(rank)
+    features, snrs, labels = _with_snr(features, snrs, snr_feature)[order], snrs[order], labels[order]
+    return {split: (features[start:stop], labels[start:stop], snrs[start:stop])
+            for split, (start, stop) in split_bounds(len(order), train_size, test_size).items()}
+
+
+class StoreIter(xg.DataIter):
+    """Feeds the rows of one split of a FeatureStore to xgboost block by block (external memory)"""
+
+    def __init__(self, store, rank, bounds, snr_feature=True, block_rows=1 << 18, cache_prefix=None):
+        self.store = store
+        self.rank = rank
+        self.bounds = bounds
+        self.snr_feature = snr_feature
+        self.block_rows = block_rows
+        self._blocks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        for features, snrs, labels, row_ids in self._blocks:
+            rank = self.rank[row_ids]
+            keep = (rank >= self.bounds[0]) & (rank < self.bounds[1])
+            if np.any(keep):
+                input_data(data=_with_snr(features[keep], snrs[keep], self.snr_feature), label=labels[keep])
+                return 1
+        return 0
+
+    def reset(self):
+        self._blocks = self.store.iter_blocks(block_rows=self.block_rows)
+
+
+def store_dmatrices(store, train_size, test_size=0.2, snr_feature=True, quantile=True, external_memory=False,
+                    cache_dir=None, max_bin=256):
+    """
+    train/val/test matrices straight from a FeatureStore
+    :param quantile: QuantileDMatrix (hist only), the val/test matrices share the bins of train
+    :param external_memory: stream the store through StoreIter instead of loading it
+    :return: {split: matrix}, {split: (labels, snrs)} for the test metrics
+    """
+    if not external_memory:
+        splits = load_store_splits(store, train_size, test_size, snr_feature)
+        matrices = {}
+        for split in ('train', 'val', 'test'):
+            features, labels, _ = splits[split]
+            if quantile:
+                matrices[split] = xg.QuantileDMatrix(features, label=labels, max_bin=max_bin,
+                                                     ref=matrices.get('train'))
+            else:
+                matrices[split] = xg.DMatrix(features, label=labels)
+        return matrices, {split: values[1:] for split, values in splits.items()}
+
+    rank = shuffle_rank(store.num_rows)
+    bounds = split_bounds(store.num_rows, train_size, test_size)
+    matrices, targets = {}, {}
+    for split in ('train', 'val', 'test'):
+        cache_prefix = None if cache_dir is None else os.path.join(cache_dir, split)
+        it = StoreIter(store, rank, bounds[split], snr_feature, cache_prefix=cache_prefix)
+        if quantile:
+            matrices[split] = xg.QuantileDMatrix(it, max_bin=max_bin, ref=matrices.get('train'))
+        else:
+            matrices[split] = xg.DMatrix(it)
+    # labels and SNRs of the test rows in the order StoreIter feeds them
+    labels, snrs = [], []
+    for _, block_snrs, block_labels, row_ids in store.iter_blocks(scale=False):
+        keep = (rank[row_ids] >= bounds['test'][0]) & (rank[row_ids] < bounds['test'][1])
+        labels.append(block_labels[keep])
+        snrs.append(block_snrs[keep])
+    targets['test'] = (np.concatenate(labels), np.concatenate(snrs))
+    return matrices, targets
 
 
 class XgbModule(object):
-    def __init__(self, data_path, save_path, train_size, save_results=True):
+    def __init__(self, data_path, save_path, train_size, save_results=True, external_memory=False):
 
         # shap.initjs()
         self.data_path = data_path
@@ -34,9 +136,13 @@ class XgbModule(object):
                 "OFDM BPSK", "OFDM QPSK", "OFDM 16-QAM", "OFDM 64-QAM"]
         self.snr = [0, 5, 10, 15, 20]
         self.save_results = save_results
+        self.external_memory = external_memory   # stream a feature store instead of loading it
+        self._matrices = {}   # split -> (df_x, df_y, row bounds, DMatrix), reused by repeated classifier calls
 
 
     def create_deepsig_set(self):
+        if is_feature_store(self.data_path):
+            return self.create_store_set()
         # if self.data_path[-3:] == "csv":
         df = pd.read_csv(self.data_path)
         df_X = df.drop(['label'], axis=1)
@@ -54,6 +160,17 @@ class XgbModule(object):
         return df_X, df_y
 
 
+    def create_store_set(self):
+        """create_deepsig_set for a feature store: same scaled, shuffled frames without CSV parsing"""
+        store = FeatureStore(self.data_path)
+        features, snrs, labels, row_ids = store.load()
+        idx = np.argsort(shuffle_rank(store.num_rows)[row_ids])
+        df_X = pd.DataFrame(features[idx], columns=store.columns, index=row_ids[idx])
+        df_X.insert(0, 'SNR', snrs[idx])
+        df_y = pd.DataFrame({'SNR': snrs[idx], 'label': labels[idx]}, index=row_ids[idx])
+        print('-----------------dataset created---------------')
+        return df_X, df_y
+
     def create_dataset(self):
         x_data = []
         y_data = []
@@ -113,12 +230,24 @@ class XgbModule(object):
         df2 = df2.reindex(idx)
         return df1, df2[['label','snr_class']]
 
+    def _dmatrix(self, split, df_x, df_y, bounds, X, y):
+        """
+        DMatrix of rows [start, stop) of df_x/df_y, cached per split. The cache holds on to both
+        frames and compares them by identity, so a new frame never hits a stale matrix.
+        """
+        cached = self._matrices.get(split)
+        if cached is None or cached[0] is not df_x or cached[1] is not df_y or cached[2] != bounds:
+            self._matrices[split] = (df_x, df_y, bounds, xg.DMatrix(X, label=y['label']))
+        return self._matrices[split][3]
+
     def classifier(self, df_x, df_y, do_train=True, do_predict=True):
         test_size = 0.2
         X_tr, X_test, y_tr, y_test = train_test_split(df_x, df_y, test_size=test_size, shuffle=False)
         # X_train, X_val, y_train, y_val = train_test_split(X_tr, y_tr, test_size=0.0625, shuffle=False)
         train_size = self.train_size/(1-test_size)
         X_train, X_val, y_train, y_val = train_test_split(X_tr, y_tr, train_size=train_size, shuffle=False)
+        # the splits are not shuffled, so each is a row range of df_x/df_y
+        bounds = {'train': (0, len(X_train)), 'val': (len(X_train), len(X_tr)), 'test': (len(X_tr), len(df_x))}
         params = {
             'learning_rate': 0.2,  # learning rate, prevents overfitting
             'max_depth': 15,  # depth of decision trees
@@ -130,52 +259,79 @@ class XgbModule(object):
 
         best_preds = np.array([])
         if do_train and do_predict:
-            D_train = xg.DMatrix(X_train, label=y_train['label'])
-            D_val = xg.DMatrix(X_val, label=y_val['label'])
-            D_test = xg.DMatrix(X_test, label=y_test['label'])
+            D_train = self._dmatrix('train', df_x, df_y, bounds['train'], X_train, y_train)
+            D_val = self._dmatrix('val', df_x, df_y, bounds['val'], X_val, y_val)
+            D_test = self._dmatrix('test', df_x, df_y, bounds['test'], X_test, y_test)
             steps = 200  # The number of training iterations
             evals = [(D_val, "validation")]
             model = xg.train(params, D_train, num_boost_round=steps, evals=evals,  # early_stopping_rounds=10,
                              verbose_eval=True)
             preds = model.predict(D_test)
-            best_preds = np.asarray([np.argmax(pred) for pred in preds])
+            best_preds = np.argmax(preds, axis=1)
         elif do_train:
-            D_train = xg.DMatrix(X_train, label=y_train['label'])
-            D_val = xg.DMatrix(X_val, label=y_val['label'])
+            D_train = self._dmatrix('train', df_x, df_y, bounds['train'], X_train, y_train)
+            D_val = self._dmatrix('val', df_x, df_y, bounds['val'], X_val, y_val)
             steps = 200  # The number of training iterations
             evals = [(D_val, "validation")]
             model = xg.train(params, D_train, num_boost_round=steps, evals=evals,  # early_stopping_rounds=10,
                              verbose_eval=True)
         elif do_predict:
-            D_test = xg.DMatrix(X_test, label=y_test['label'])
+            D_test = self._dmatrix('test', df_x, df_y, bounds['test'], X_test, y_test)
             model = pickle.load(open(self.save_path + "model.dat", "rb"))
             preds = model.predict(D_test)
-            best_preds = np.asarray([np.argmax(pred) for pred in preds])
+            best_preds = np.argmax(preds, axis=1)
         else:
             print("Select whether to train or test or both")
 
+        self.report(y_test['label'], best_preds, y_test['SNR'], model if do_train else None)
+
+    def report(self, labels, best_preds, snrs, model=None):
+        """prints the test metrics and, with save_results, writes output.csv (and model.dat if given)"""
         # evaluation metrics
-        print("Precision = {}".format(precision_score(y_test['label'], best_preds, average='macro')))
-        print("Recall = {}".format(recall_score(y_test['label'], best_preds, average='macro')))
-        print("Accuracy = {}".format(accuracy_score(y_test['label'], best_preds)))
-        print("Confusion matrix = {}".format(confusion_matrix(y_test['label'], best_preds)))
+        print("Precision = {}".format(precision_score(labels, best_preds, average='macro')))
+        print("Recall = {}".format(recall_score(labels, best_preds, average='macro')))
+        print("Accuracy = {}".format(accuracy_score(labels, best_preds)))
+        print("Confusion matrix = {}".format(confusion_matrix(labels, best_preds)))
 
         # write results
         if self.save_results:
             if not os.path.exists(self.save_path):
                 os.makedirs(self.save_path)
             # save model
-            if do_train:
+            if model is not None:
                 pickle.dump(model, open(self.save_path + "model.dat", "wb"))
             # save metrics
             fieldnames = ['True_label', 'Predicted_label', 'SNR']
             with open(self.save_path + "output.csv", 'w', encoding='utf-8') as csv_file:
                 writer = csv.DictWriter(csv_file, fieldnames=fieldnames, quoting=csv.QUOTE_NONNUMERIC)
                 writer.writeheader()
-                for i, j, k in zip(y_test['label'], best_preds, y_test['SNR']):  # rem change
+                for i, j, k in zip(labels, best_preds, snrs):  # rem change
                     writer.writerow(
                         {'True_label': i, 'Predicted_label': j, 'SNR': k})
 
+    def classifier_from_store(self, quantile=True):
+        """classifier() on a feature store: matrices are built from the store without DataFrames"""
+        store = FeatureStore(self.data_path)
+        matrices, targets = store_dmatrices(store, self.train_size, quantile=quantile,
+                                            external_memory=self.external_memory,
+                                            cache_dir=os.path.join(self.save_path, "xgb_cache"))
+        params = {
+            'learning_rate': 0.2,  # learning rate, prevents overfitting
+            'max_depth': 15,  # depth of decision trees
+            'gamma': 0.4,
+            'colsample_bytree': 0.3,
+            'min_child_weight': 3,
+            'objective': 'multi:softprob',  # loss function
+            'num_class': 8,
+            'tree_method': 'hist'}  # required by QuantileDMatrix
+
+        steps = 200  # The number of training iterations
+        evals = [(matrices['val'], "validation")]
+        model = xg.train(params, matrices['train'], num_boost_round=steps, evals=evals, verbose_eval=True)
+        best_preds = np.argmax(model.predict(matrices['test']), axis=1)
+        labels, snrs = targets['test']
+        self.report(labels, best_preds, snrs, model)
+
 
     def read_feature_file(self, path):
         file = h5.File(path, 'r')
@@ -220,8 +376,6 @@ class XgbModule(object):
 
     def cross_validate_model(self, X, Y):
         X_train, X_test, y_train, y_test = train_test_split(X, Y, train_size=0.8, shuffle=False)
-        D_train = xg.DMatrix(X_train, label=y_train['label'])
-        D_test = xg.DMatrix(X_test, label=y_test['label'])
 
         params = {
             'learning_rate': 0.2,  # learning rate, prevents overfitting
@@ -241,19 +395,13 @@ class XgbModule(object):
         # print("Precision = {}".format(precision_score(y_test['label'], best_preds, average='macro')))
         # print("Recall = {}".format(recall_score(y_test['label'], best_preds, average='macro')))
         # print("Accuracy = {}".format(accuracy_score(y_test['label'], best_preds)))
-        # Run CV
-        cv_results = xg.cv(
-            params,
-            D_train,
-            num_boost_round=100,
-            seed=4,
-            nfold=5,
-            metrics=['merror'],
-            early_stopping_rounds=10
-        )
-        # Update best MAE
-        mean_merror = cv_results['test-merror-mean'].min()
-        std_merror = cv_results['test-merror-std'].min()
+        # Run CV, the 5 folds in parallel
+        _, trials = search(X_train.values, y_train['label'].values, {k: [v] for k, v in params.items()},
+                           n_folds=5, num_workers=5, min_rounds=100, max_rounds=100,
+                           early_stopping_rounds=10, metric='merror', seed=4)
+        merror = [trial['score'] for trial in trials]
+        mean_merror = np.mean(merror)
+        std_merror = np.std(merror)
         print(mean_merror, std_merror)
 
 
@@ -263,7 +411,6 @@ class XgbModule(object):
         y_train = y_train['label']
         y_test = y_test['label']
 
-        clf = xg.XGBClassifier()
         parameters = {
             "learning_rate": [0.05, 0.10, 0.15, 0.20, 0.25, 0.30],  # shrinks feature values for better boosting
             "max_depth": [3, 4, 5, 6, 8, 10, 12, 15],
@@ -272,36 +419,38 @@ class XgbModule(object):
             "colsample_bytree": [0.3, 0.4, 0.5, 0.7]  # subsample ratio of columns when tree is constructed
         }
 
-        grid = GridSearchCV(clf,
-                            parameters, n_jobs=10,
-                            scoring="neg_log_loss",
-                            cv=3)
-
-        grid.fit(X_train, y_train)
+        # 3-fold cv with successive halving, per trial results in grid_cv.csv
+        best_params, trials = search(X_train.values, y_train.values, parameters, n_folds=3, num_workers=10,
+                                     metric='mlogloss', results_path=self.save_path + "grid_cv.csv")
         print("Best parameters set found on development set:")
         print()
-        print(grid.best_params_)
+        print(best_params)
         print()
-        print("Grid scores on development set:")
+        print("Grid scores of the last rung on development set:")
         print()
-        means = grid.cv_results_['mean_test_score']
-        stds = grid.cv_results_['std_test_score']
-        for mean, std, params in zip(means, stds, grid.cv_results_['params']):
+        last_rung = max(trial['rung'] for trial in trials)
+        scores = pd.DataFrame([trial for trial in trials if trial['rung'] == last_rung])
+        scores = scores.groupby(sorted(parameters))['score'].agg(['mean', 'std']).reset_index()
+        for _, row in scores.sort_values('mean').iterrows():
             print("%0.3f (+/-%0.03f) for %r"
-                  % (mean, std * 2, params))
+                  % (row['mean'], row['std'] * 2, {name: row[name] for name in sorted(parameters)}))
         print()
 
+        params = {name: value for name, value in best_params.items() if name != 'num_boost_round'}
+        params.update(objective='multi:softprob', num_class=int(np.max(y_train)) + 1, tree_method='hist')
+        model = xg.train(params, xg.DMatrix(X_train, label=y_train), num_boost_round=best_params['num_boost_round'])
+
         print("Detailed classification report:")
         print()
         print("The model is trained on the full development set.")
         print("The scores are computed on the full evaluation set.")
         print()
-        y_true, y_pred = y_test, grid.predict(X_test)
+        y_true, y_pred = y_test, np.argmax(model.predict(xg.DMatrix(X_test)), axis=1)
         print(classification_report(y_true, y_pred))
         print()
         print("Best parameters set found on development set:")
         print()
-        print(grid.best_params_)
+        print(best_params)
 
 
     def class_labels(self, y_test):
@@ -425,6 +574,9 @@ class XgbModule(object):
 
     # main file
     def main(self):
+        if is_feature_store(self.data_path):
+            self.classifier_from_store()
+            return
         # self.train_xgb_cnn()
         x_data, y_data = self.create_deepsig_set()  # note: pre-processing done in-situ
         # x_data, y_data = self.preprocess_data(x_data, y_data)
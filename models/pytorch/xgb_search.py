@@ -0,0 +1,159 @@
+import os
+import csv
+import math
+import time
+import itertools
+import multiprocessing as mp
+from argparse import ArgumentParser
+
+import numpy as np
+import xgboost as xg
+
+# metrics xgboost maximises, everything else (mlogloss, merror, ...) is minimised
+MAXIMIZE = ('auc', 'aucpr', 'map', 'ndcg')
+
+# fold matrices and fixed params of the running search in a worker process; DMatrix objects
+# cannot be pickled, so every worker builds its own folds in _init_worker
+_SHARED = {}
+
+
+def param_configs(param_grid):
+    """all combinations of a GridSearchCV style {name: [values]} grid as a list of dicts"""
+    names = sorted(param_grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(param_grid[n] for n in names))]
+
+
+def fold_bounds(num_rows, n_folds):
+    """[start, stop) of the validation rows of every fold, as KFold(shuffle=False)"""
+    sizes = np.full(n_folds, num_rows // n_folds)
+    sizes[:num_rows % n_folds] += 1
+    stops = np.cumsum(sizes)
+    return list(zip(stops - sizes, stops))
+
+
+def build_folds(X, y, n_folds, quantile=True, max_bin=256):
+    """
+    (train, valid) matrices of every fold, built once for the whole search
+    :param quantile: QuantileDMatrix; the bins are sketched once over all rows and shared by the folds
+    """
+    X = np.asarray(X, dtype=np.float32)
+    y = np.asarray(y)
+    reference = xg.QuantileDMatrix(X, label=y, max_bin=max_bin) if quantile else None
+    folds = []
+    for start, stop in fold_bounds(len(X), n_folds):
+        train = np.r_[0:start, stop:len(X)]
+        if quantile:
+            # xgboost requires the validation matrix to reference the training matrix of its fold
+            dtrain = xg.QuantileDMatrix(X[train], label=y[train], max_bin=max_bin, ref=reference)
+            folds.append((dtrain, xg.QuantileDMatrix(X[start:stop], label=y[start:stop], max_bin=max_bin, ref=dtrain)))
+        else:
+            folds.append((xg.DMatrix(X[train], label=y[train]), xg.DMatrix(X[start:stop], label=y[start:stop])))
+    return folds
+
+
+def _init_worker(X, y, n_folds, quantile, params, early_stopping_rounds, maximize):
+    _SHARED.update(folds=build_folds(X, y, n_folds, quantile), params=params,
+                   early_stopping_rounds=early_stopping_rounds, maximize=maximize)
+
+
+def _run_trial(task):
+    trial, config, fold, num_rounds = task
+    dtrain, dvalid = _SHARED['folds'][fold]
+    params = dict(_SHARED['params'], **config)
+    evals_result = {}
+    start_time = time.time()
+    xg.train(params, dtrain, num_boost_round=num_rounds, evals=[(dvalid, 'valid')],
+             early_stopping_rounds=_SHARED['early_stopping_rounds'], evals_result=evals_result,
+             verbose_eval=False)
+    scores = evals_result['valid'][params['eval_metric']]
+    best_iteration = int(np.argmax(scores) if _SHARED['maximize'] else np.argmin(scores))
+    return {'trial': trial, 'fold': fold, 'rounds': num_rounds, 'best_iteration': best_iteration,
+            'score': float(scores[best_iteration]), 'seconds': time.time() - start_time}
+
+
+def search(X, y, param_grid, n_folds=3, num_workers=None, threads_per_worker=None, min_rounds=25, max_rounds=200,
+           eta=3, early_stopping_rounds=10, metric='mlogloss', results_path=None, seed=4, base_params=None,
+           quantile=True):
+    """
+    Cross-validated grid search with successive halving.
+
+    Every configuration is trained on all folds with min_rounds boosting rounds; the best
+    1/eta of them (by mean validation score) go on with eta times as many rounds, until
+    max_rounds is reached or one configuration is left. Trials run in a process pool of
+    num_workers processes with threads_per_worker xgboost threads each. The workers are
+    started with forkserver (spawn where that is unavailable) rather than fork, since forking
+    a parent whose OpenMP runtime is already initialized can deadlock; each worker builds
+    its own copy of the fold matrices, so memory grows with num_workers.
+
+    :param param_grid: {name: [values]} as for GridSearchCV
+    :param results_path: csv with one row per (rung, configuration, fold), wall time included
+    :return: best configuration (with 'num_boost_round'), list of all trial rows
+    """
+    num_workers = num_workers or max(1, (os.cpu_count() or 1) // 4)
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+    y = np.asarray(y)
+    params = {'objective': 'multi:softprob', 'num_class': int(np.max(y)) + 1, 'tree_method': 'hist',
+              'eval_metric': metric, 'seed': seed, 'nthread': threads_per_worker}
+    params.update(base_params or {})
+
+    maximize = metric in MAXIMIZE
+    configs = param_configs(param_grid)
+    alive = list(range(len(configs)))
+    num_rounds = min(min_rounds, max_rounds)
+    rows = []
+    rung = 0
+    start_time = time.time()
+    context = mp.get_context('forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn')
+    initargs = (np.asarray(X, dtype=np.float32), y, n_folds, quantile, params, early_stopping_rounds, maximize)
+    with context.Pool(num_workers, initializer=_init_worker, initargs=initargs) as pool:
+        while True:
+            tasks = [(trial, configs[trial], fold, num_rounds) for trial in alive for fold in range(n_folds)]
+            results = pool.map(_run_trial, tasks, chunksize=1)
+            for result in results:
+                result['rung'] = rung
+                result.update(configs[result['trial']])
+            rows.extend(results)
+
+            mean_score = {trial: np.mean([r['score'] for r in results if r['trial'] == trial]) for trial in alive}
+            alive.sort(key=lambda trial: -mean_score[trial] if maximize else mean_score[trial])
+            # the time of rung 0 includes starting the workers and building their folds
+            print("rung {}: {} configurations, {} rounds, best {} = {:.5f}, {:.1f}s".format(
+                rung, len(mean_score), num_rounds, metric, mean_score[alive[0]], time.time() - start_time))
+            if num_rounds >= max_rounds or len(alive) == 1:
+                break
+            alive = alive[:max(1, int(math.ceil(len(alive) / eta)))]
+            num_rounds = min(num_rounds * eta, max_rounds)
+            rung += 1
+
+    best_rows = [r for r in rows if r['trial'] == alive[0] and r['rung'] == rung]
+    best = dict(configs[alive[0]], num_boost_round=int(np.mean([r['best_iteration'] for r in best_rows])) + 1)
+
+    if results_path is not None:
+        if os.path.dirname(results_path):
+            os.makedirs(os.path.dirname(results_path), exist_ok=True)
+        fieldnames = ['rung', 'trial', 'fold', 'rounds', 'best_iteration', 'score', 'seconds'] + sorted(param_grid)
+        with open(results_path, 'w', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writeheader()
+            writer.writerows(rows)
+    return best, rows
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    parser = ArgumentParser(description='Cross-validated xgboost grid search on a featurized csv')
+    parser.add_argument('--data_path', type=str, required=True)
+    parser.add_argument('--results_path', type=str, default='xgb_search.csv')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--threads_per_worker', type=int, default=None)
+    parser.add_argument('--max_rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data_path)
+    grid = {"learning_rate": [0.1, 0.2, 0.3], "max_depth": [6, 10, 15], "min_child_weight": [1, 3],
+            "gamma": [0.0, 0.4], "colsample_bytree": [0.3, 0.5]}
+    best, _ = search(df.drop(['label'], axis=1).values, df['label'].values, grid,
+                     num_workers=args.num_workers, threads_per_worker=args.threads_per_worker,
+                     max_rounds=args.max_rounds, results_path=args.results_path)
+    print(best)
@@ -1,14 +1,9 @@
 import pytorch_lightning as pl
 import torch
-import numpy as np
-from torch.utils.data import DataLoader, SequentialSampler, Subset, Dataset
-from torch.utils.data.sampler import SubsetRandomSampler
-import h5py as h5
-import math
+from torch.utils.data import SequentialSampler, Subset
 from pytorch_lightning import Trainer
 from argparse import ArgumentParser
 from pytorch_lightning.loggers.neptune import NeptuneLogger
-from sklearn import metrics
 import csv
 import os
 # from scikitplot.metrics import plot_confusion_matrix
@@ -19,30 +14,10 @@ import warnings
 warnings.simplefilter('always',ConvergenceWarning)
 
 from models.pytorch.resnet import *
-
-class DatasetFromHDF5(Dataset):
-    def __init__(self, filename, iq,labels,snrs):
-        self.filename = filename
-        self.iq = iq
-        self.labels = labels
-        self.snrs = snrs
-        # self.data = preprocessing.scale(self.data, with_mean=False)
-
-    def __len__(self):
-        with h5.File(self.filename, 'r') as file:
-            lens = len(file[self.labels])
-        return lens
-
-    def __getitem__(self, item):
-        with h5.File(self.filename, 'r') as file:
-            data = file[self.iq][item]
-            label = file[self.labels][item]
-            snr = file[self.snrs][item]
-        # data = preprocessing.scale(data,with_mean=False).astype(np.float32)
-        data = data.astype(np.float32)
-        label = label.astype(np.float32)
-        snr = snr.astype(np.int8)
-        return data,label,snr
+from data_processing.hdf5_dataset import split_loaders
+from data_processing.shards import open_dataset
+from models.pytorch.metrics import StreamingMetrics
+from models.pytorch.conv1d_models import conv1d_
 
 # ===============================================MODEL==============================================================
 
@@ -56,14 +31,21 @@ class LightningResnet(pl.LightningModule):
         self.test_dataset = None
         self.all_true, self.all_pred, self.all_snr = [], [], []  # for final metrics calculation
         self.hparams = hparams
+        self.val_metrics = StreamingMetrics(int(hparams.n_classes))
+        self.test_metrics = StreamingMetrics(int(hparams.n_classes))
         # print(vars(hparams)
         # get model
         self.res_enc = ResnetEncoder(hparams.in_dims,hparams.block_sizes,hparams.depths,block=hparams.res_block)
         self.res_dec = ResnetDecoder(self.res_enc.blocks[-1].blocks[-1].expanded_channels, hparams.n_classes)
+        self.conv1d = getattr(hparams, 'conv1d', False)
+        if self.conv1d:
+            # same network on the length axis only, see conv1d_models
+            conv1d_(self)
 
     def forward(self,x):
         x = x.permute(0, 2, 1)
-        x = x.unsqueeze(dim=3)
+        if not self.conv1d:
+            x = x.unsqueeze(dim=3)
         x = self.res_enc(x)
         x = self.res_dec(x)
         return x
@@ -107,14 +89,11 @@ class LightningResnet(pl.LightningModule):
         # print(y)
         loss = self.cross_entropy_loss(y_pred,y)
 
-        # accuracy
-        y_hat = torch.max(y_pred,1)[1]
-        val_acc = torch.sum(y == y_hat).item() / len(y)
-        val_acc = torch.tensor(val_acc)
+        # loss, accuracy and confusion matrix stay on the device until validation_epoch_end
+        self.val_metrics.update(loss, y_pred, y)
 
         output = OrderedDict({
             'val_loss': loss,
-            'val_acc': val_acc,
         })
 
         return output
@@ -124,25 +103,11 @@ class LightningResnet(pl.LightningModule):
         # outputs is an array with what you returned in validation_step for each batch
         # outputs = [{'loss': batch_0_loss}, {'loss': batch_1_loss}, ..., {'loss': batch_n_loss}]
 
-        val_loss_mean = 0
-        val_acc_mean = 0
-        for output in outputs:
-            val_loss = output['val_loss']
-
-            # reduce manually when using dp
-            if self.trainer.use_dp or self.trainer.use_ddp2:  # not implemented
-                val_loss = torch.mean(val_loss)
-            val_loss_mean += val_loss
-
-            # reduce manually when using dp
-            val_acc = output['val_acc']
-            if self.trainer.use_dp or self.trainer.use_ddp2:   # not implemented
-                val_acc = torch.mean(val_acc)
-
-            val_acc_mean += val_acc
-
-        val_loss_mean /= len(outputs)
-        val_acc_mean /= len(outputs)
+        # averaged over all rows of the validation set, one host sync per epoch
+        result = self.val_metrics.compute()
+        self.val_metrics.reset()
+        val_loss_mean = torch.tensor(result['loss'])
+        val_acc_mean = torch.tensor(result['accuracy'])
         tqdm_dict = {'val_loss': val_loss_mean, 'val_acc': val_acc_mean}
         result = {'progress_bar': tqdm_dict, 'log': {'val_loss': val_loss_mean,'val_acc':val_acc_mean},
                   'val_loss': val_loss_mean}
@@ -155,15 +120,12 @@ class LightningResnet(pl.LightningModule):
         y = torch.max(y,1)[1]
         loss = self.cross_entropy_loss(y_pred,y)
 
-        # accuracy
         y_hat = torch.max(y_pred,1)[1]
-        test_acc = torch.sum(y == y_hat).item() / len(y)
-        test_acc = torch.tensor(test_acc)
+        self.test_metrics.update(loss, y_hat, y)
 
         # if batch_idx == int(len(y)/self.hparams.batch_size):
         output = OrderedDict({
             'test_loss': loss,
-            'test_acc': test_acc,
             'true_label': y,
             'pred_label': y_hat,
             'snrs': z,
@@ -176,28 +138,16 @@ class LightningResnet(pl.LightningModule):
         # outputs is an array with what you returned in test_step for each batch
         # outputs = [{'loss': batch_0_loss}, {'loss': batch_1_loss}, ..., {'loss': batch_n_loss}]
         # print(outputs)
-        test_loss_mean = 0
-        test_acc_mean = 0
-        for output in outputs:
-            test_loss = output['test_loss']
-
-            # reduce manually when using dp
-            if self.trainer.use_dp or self.trainer.use_ddp2:  # not implemented
-                test_loss = torch.mean(test_loss)
-            test_loss_mean += test_loss
-
-            # reduce manually when using dp
-            test_acc = output['test_acc']
-            if self.trainer.use_dp or self.trainer.use_ddp2:  # not implemented
-                test_acc = torch.mean(test_acc)
-
-            test_acc_mean += test_acc
-            self.all_true.extend(output['true_label'].detach().cpu().data.numpy())
-            self.all_pred.extend(output['pred_label'].detach().cpu().data.numpy())
-            self.all_snr.extend(output['snrs'].detach().cpu().data.numpy())
-
-        confusion_matrix = metrics.confusion_matrix(self.all_true,self.all_pred)
-        accuracy = metrics.accuracy_score(self.all_true,self.all_pred)
+        result = self.test_metrics.compute()
+        self.test_metrics.reset()
+        # one copy per column instead of one per batch
+        for key, values in (('true_label', self.all_true), ('pred_label', self.all_pred), ('snrs', self.all_snr)):
+            values.extend(torch.cat([output[key] for output in outputs]).cpu().numpy())
+
+        confusion_matrix = result['confusion_matrix'].numpy()
+        accuracy = result['accuracy']
+        test_loss_mean = result['loss']
+        test_acc_mean = accuracy
         # save results in csv
         fieldnames = ['True_label', 'Predicted_label', 'SNR']
 
@@ -211,8 +161,6 @@ class LightningResnet(pl.LightningModule):
                 writer.writerow(
                     {'True_label': i.item(), 'Predicted_label': j.item(), 'SNR': k})
 
-        test_loss_mean /= len(outputs)
-        test_acc_mean /= len(outputs)
         tqdm_dict = OrderedDict({'Test_loss': test_loss_mean, 'Test_acc(mean)': test_acc_mean,
                                 'True_accuracy': accuracy, 'Confusion_matrix': confusion_matrix})
 
@@ -229,33 +177,10 @@ class LightningResnet(pl.LightningModule):
 
 
     def prepare_data(self, valid_fraction=0.05, test_fraction=0.2):
-        dataset = DatasetFromHDF5(self.hparams.data_path, 'iq', 'labels', 'snrs')
-        num_train = len(dataset)
-        indices = list(range(num_train))
-        val_split = int(math.floor(valid_fraction * num_train))
-        test_split = val_split + int(math.floor(test_fraction * num_train))
-        training_params = {"batch_size": self.hparams.batch_size,
-                           "num_workers": self.hparams.num_workers}
-
-        if not ('shuffle' in training_params and not training_params['shuffle']):
-            np.random.seed(4)
-            np.random.shuffle(indices)
-        if 'num_workers' not in training_params:
-            training_params['num_workers'] = 1
-
-        train_idx, valid_idx, test_idx = indices[test_split:], indices[:val_split], indices[val_split:test_split]
-        train_sampler = SubsetRandomSampler(train_idx)
-        valid_sampler = SubsetRandomSampler(valid_idx)
-        test_sampler = SubsetRandomSampler(test_idx)
-        self.train_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                   shuffle=self.hparams.shuffle,num_workers=self.hparams.num_workers,
-                                   sampler=train_sampler)
-        self.val_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                 shuffle=self.hparams.shuffle,num_workers=self.hparams.num_workers,
-                                 sampler=valid_sampler)
-        self.test_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                  shuffle=self.hparams.shuffle, num_workers=self.hparams.num_workers,
-                                  sampler=test_sampler)
+        dataset = open_dataset(self.hparams.data_path)
+        self.train_dataset, self.val_dataset, self.test_dataset = split_loaders(
+            dataset, self.hparams.batch_size, num_workers=self.hparams.num_workers,
+            valid_fraction=valid_fraction, test_fraction=test_fraction)
 
 
     # @pl.data_loader
@@ -367,6 +292,7 @@ if __name__=="__main__":
     parser.add_argument('--block_sizes',type=list, default=[64,128,256,512])
     parser.add_argument('--depths', type=list, default=[3, 4, 23, 3])
     parser.add_argument('--res_block', default=ResnetBottleneckBlock)
+    parser.add_argument('--conv1d', default=False, help='Conv1d layers equivalent to the 2-D ones')
 
     args = parser.parse_args()
 
@@ -26,7 +26,6 @@ import argparse
 from collections import OrderedDict
 import numpy as np
 import math
-from sklearn import metrics
 import os
 from argparse import Namespace
 import csv
@@ -34,6 +33,10 @@ from torch.utils.data import DataLoader,SubsetRandomSampler
 from pytorch_lightning.loggers.neptune import NeptuneLogger
 
 from models.pytorch_lightning.py_lightning import LightningCNN, DatasetFromHDF5
+from data_processing.hdf5_dataset import split_loaders
+from data_processing.shards import open_dataset
+from models.pytorch.metrics import StreamingMetrics
+from models.pytorch.conv1d_models import conv1d_
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -134,16 +137,23 @@ class TransferLearningModel(pl.LightningModule):
         self.all_true = []
         self.all_pred = []
         self.all_snr = []
+        self.val_metrics = StreamingMetrics(int(hparams.n_classes))
+        self.test_metrics = StreamingMetrics(int(hparams.n_classes))
         self.data_path = hparams.data_path
+        self.conv1d = getattr(hparams, 'conv1d', False)
         self.__build_model()
 
     def __build_model(self):
         """Define model layers & loss."""
         # 1. Load pre-trained model
         backbone = self.hparams.backbone
+        self.conv1d = self.conv1d or getattr(backbone, 'conv1d', False)
 
         _layers = list(backbone.children())[:-3]  # all except fc layers  # maybe modify later
         self.feature_extractor = nn.Sequential(*_layers)
+        if self.conv1d:
+            # pre-trained weights moved to the equivalent Conv1d layers
+            conv1d_(self.feature_extractor)
         freeze(module=self.feature_extractor,train_bn=self.hparams.train_bn)  # freeze all layers
 
         # 2. Classifier
@@ -158,7 +168,8 @@ class TransferLearningModel(pl.LightningModule):
     def forward(self, x):
 
         x = x.permute(0, 2, 1)
-        x = x.unsqueeze(dim=3)
+        if not self.conv1d:
+            x = x.unsqueeze(dim=3)
         # 1. Feature extraction
         x = self.feature_extractor(x)
         # print(x.shape)
@@ -238,19 +249,17 @@ class TransferLearningModel(pl.LightningModule):
 
         # 2. Compute loss & accuracy:
         val_loss = self.loss(y_logits, y_true)
-        num_correct = torch.eq(torch.max(y_logits, 1)[1], y_true).sum()
+        self.val_metrics.update(val_loss, y_logits, y_true)
 
-        return {'val_loss': val_loss,
-                'num_correct': num_correct}
+        return {'val_loss': val_loss}
 
     def validation_epoch_end(self, outputs):
         """Compute and log validation loss and accuracy at the epoch level."""
 
-        val_loss_mean = torch.stack([output['val_loss']
-                                     for output in outputs]).mean()
-        val_acc_mean = torch.stack([output['num_correct']
-                                    for output in outputs]).sum().float()
-        val_acc_mean /= (len(outputs) * self.hparams.batch_size)
+        result = self.val_metrics.compute()
+        self.val_metrics.reset()
+        val_loss_mean = torch.tensor(result['loss'])
+        val_acc_mean = torch.tensor(result['accuracy'])
         return {'log': {'val_loss': val_loss_mean,
                         'val_acc': val_acc_mean,
                         'step': self.current_epoch}}
@@ -264,10 +273,9 @@ class TransferLearningModel(pl.LightningModule):
         y_hat = torch.max(y_logits, 1)[1]
         # 2. Compute loss & accuracy:
         test_loss = self.loss(y_logits, y_true)
-        num_correct = torch.eq(y_hat, y_true).sum()
+        self.test_metrics.update(test_loss, y_hat, y_true)
 
         return {'test_loss': test_loss,
-                'num_correct': num_correct,
                 'true_label': y_true,
                 'pred_label': y_hat,
                 'snrs' : z}
@@ -275,17 +283,14 @@ class TransferLearningModel(pl.LightningModule):
     def test_epoch_end(self, outputs):
         """Compute and log validation loss and accuracy at the epoch level."""
 
-        test_loss_mean = torch.stack([output['test_loss']
-                                     for output in outputs]).mean()
-        test_acc_mean = torch.stack([output['num_correct']
-                                    for output in outputs]).sum().float()
-        test_loss_mean /= (len(outputs) * self.hparams.batch_size)
-        for output in outputs:
-            self.all_true.extend(output['true_label'].detach().cpu().data.numpy())
-            self.all_pred.extend(output['pred_label'].detach().cpu().data.numpy())
-            self.all_snr.extend(output['snrs'].detach().cpu().data.numpy())
-
-        accuracy = metrics.accuracy_score(self.all_true, self.all_pred)
+        result = self.test_metrics.compute()
+        self.test_metrics.reset()
+        test_loss_mean = torch.tensor(result['loss'])
+        test_acc_mean = torch.tensor(result['accuracy'])
+        for key, values in (('true_label', self.all_true), ('pred_label', self.all_pred), ('snrs', self.all_snr)):
+            values.extend(torch.cat([output[key] for output in outputs]).cpu().numpy())
+
+        accuracy = result['accuracy']
         # save results in csv
         fieldnames = ['True_label', 'Predicted_label', 'SNR']
         if not os.path.exists(CHECKPOINTS_DIR):
@@ -314,33 +319,10 @@ class TransferLearningModel(pl.LightningModule):
         return [optimizer], [scheduler]
 
     def prepare_data(self, valid_fraction=0.05, test_fraction=0.2):
-        dataset = DatasetFromHDF5(self.data_path, 'iq', 'labels', 'snrs')
-        num_train = len(dataset)
-        indices = list(range(num_train))
-        val_split = int(math.floor(valid_fraction * num_train))
-        test_split = val_split + int(math.floor(test_fraction * num_train))
-        training_params = {"batch_size": self.hparams.batch_size,
-                           "num_workers": self.hparams.num_workers}
-
-        if not ('shuffle' in training_params and not training_params['shuffle']):
-            np.random.seed(4)
-            np.random.shuffle(indices)
-        if 'num_workers' not in training_params:
-            training_params['num_workers'] = 1
-
-        train_idx, valid_idx, test_idx = indices[test_split:], indices[:val_split], indices[val_split:test_split]
-        train_sampler = SubsetRandomSampler(train_idx)
-        valid_sampler = SubsetRandomSampler(valid_idx)
-        test_sampler = SubsetRandomSampler(test_idx)
-        self.train_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                   shuffle=self.hparams.shuffle, num_workers=self.hparams.num_workers,
-                                   sampler=train_sampler)
-        self.val_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                      shuffle=self.hparams.shuffle, num_workers=self.hparams.num_workers,
-                                      sampler=valid_sampler)
-        self.test_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                       shuffle=self.hparams.shuffle, num_workers=self.hparams.num_workers,
-                                       sampler=test_sampler)
+        dataset = open_dataset(self.data_path)
+        self.train_dataset, self.val_dataset, self.test_dataset = split_loaders(
+            dataset, self.hparams.batch_size, num_workers=self.hparams.num_workers,
+            valid_fraction=valid_fraction, test_fraction=test_fraction)
 
     def train_dataloader(self):
         return self.train_dataset
@@ -386,6 +368,7 @@ class TransferLearningModel(pl.LightningModule):
         parser.add_argument('--pool_size', default=3)
         parser.add_argument('--fc_neurons', default=128)
         parser.add_argument('--n_classes', default=8)
+        parser.add_argument('--conv1d', default=False, help='move the backbone to the equivalent Conv1d layers')
 
         return parser
 
@@ -10,14 +10,17 @@ from pytorch_lightning.loggers.neptune import NeptuneLogger
 import math
 import os
 import csv
-import h5py as h5
 from argparse import ArgumentParser
 from collections import OrderedDict
 
-from sklearn import metrics
 
 # from data_processing.intf_processing import *
 import numpy as np
+from data_processing.hdf5_dataset import DatasetFromHDF5, split_loaders
+from data_processing.shards import open_dataset
+from models.pytorch.metrics import StreamingMetrics
+from models.pytorch.conv1d_models import FoldedConvBlock
+from models.pytorch.mixed_precision import channels_last
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -62,45 +65,6 @@ class MyDataset(Dataset):
 # -----------------------------------------------------------------------------------------------------------
 
 
-class DatasetFromHDF5(Dataset):
-    def __init__(self, filename, iq,labels,snrs,feature_flag=False):
-        self.filename = filename
-        self.iq = iq
-        self.labels = labels
-        self.snrs = snrs
-        self.features = np.array([])
-        self.feature_flag = feature_flag
-
-    def __len__(self):
-        with h5.File(self.filename, 'r') as file:
-            lens = len(file[self.labels])
-        return lens
-
-    def __getitem__(self, item):
-        with h5.File(self.filename, 'r') as file:
-            data = file[self.iq][item]
-            label = file[self.labels][item]
-            snr = file[self.snrs][item]
-            features = self.features
-
-        # --------------------- Featurize data ------------------------
-        if self.feature_flag:
-            features = featurize(data)
-            features = preprocessing.scale(features, with_mean=False).astype(np.float32)
-        # -------------------------------------------------------------
-        # scaler = preprocessing.StandardScaler()
-        # data = scaler.fit_transform(data).astype(np.float32)
-        # data = preprocessing.scale(data,with_mean=False).astype(np.float32)
-        data = data.astype(np.float32)
-        label = label.astype(np.float32)
-        snr = snr.astype(np.int8)
-
-        if self.feature_flag:
-            return data, label, snr, features
-        else:
-            return data,label,snr
-
-
 # ===============================================MODEL==============================================================
 
 class LightningCNN(pl.LightningModule):
@@ -113,6 +77,8 @@ class LightningCNN(pl.LightningModule):
         self.test_dataset = None
         self.all_true, self.all_pred, self.all_snr = [], [], []  # for final metrics calculation
         self.hparams = hparams
+        self.val_metrics = StreamingMetrics(int(hparams.n_classes))
+        self.test_metrics = StreamingMetrics(int(hparams.n_classes))
 
         # layer 1
         self.conv1 = nn.Sequential(
@@ -160,6 +126,14 @@ class LightningCNN(pl.LightningModule):
             nn.MaxPool2d(hparams.pool_size)
         )
 
+        self.conv1d = getattr(hparams, 'conv1d', False)
+        if self.conv1d:
+            # same blocks without the degenerate width axis, see FoldedConvBlock
+            in_channels = [hparams.in_dims] + [hparams.filters] * 5
+            for i, (channels, kernel_size) in enumerate(zip(in_channels, hparams.kernel_size)):
+                setattr(self, 'conv{}'.format(i + 1),
+                        FoldedConvBlock(channels, hparams.filters, int(kernel_size), 2, hparams.pool_size))
+
         if hparams.featurize:
             in_dim = hparams.fc_neurons+hparams.n_features
         else:
@@ -167,7 +141,7 @@ class LightningCNN(pl.LightningModule):
 
         # layer 7
         self.fc1 = nn.Sequential(
-            nn.Linear(hparams.fc_neurons,hparams.fc_neurons),
+            nn.Linear(in_dim,hparams.fc_neurons),
             nn.ReLU(),
             nn.Dropout(p=0.5)
         )
@@ -182,17 +156,24 @@ class LightningCNN(pl.LightningModule):
         # layer 9
         self.fc3 = nn.Linear(hparams.fc_neurons, hparams.n_classes)
 
+        self.channels_last = False
+        if getattr(hparams, 'channels_last', False) and not self.conv1d:
+            channels_last(self)
+
     def forward(self, input, features):
 
         input = input.permute(0,2,1)
-        input = input.unsqueeze(dim=3)
+        if not self.conv1d:
+            input = input.unsqueeze(dim=3)
+            if self.channels_last:
+                input = input.contiguous(memory_format=torch.channels_last)
         output = self.conv1(input)
         output = self.conv2(output)
         output = self.conv3(output)
         output = self.conv4(output)
         output = self.conv5(output)
         output = self.conv6(output)
-        output = output.view(output.size(0), -1)
+        output = output.reshape(output.size(0), -1)
         if self.hparams.featurize:
             # add hand crafted features to cnn features
             output = torch.cat((output, features), 1)
@@ -253,14 +234,11 @@ class LightningCNN(pl.LightningModule):
         # print(y)
         loss = self.cross_entropy_loss(y_pred,y)
 
-        # accuracy
-        y_hat = torch.max(y_pred,1)[1]
-        val_acc = torch.sum(y == y_hat).item() / len(y)
-        val_acc = torch.tensor(val_acc)
+        # loss, accuracy and confusion matrix stay on the device until validation_epoch_end
+        self.val_metrics.update(loss, y_pred, y)
 
         output = OrderedDict({
             'val_loss': loss,
-            'val_acc': val_acc,
         })
 
         return output
@@ -270,25 +248,11 @@ class LightningCNN(pl.LightningModule):
         # outputs is an array with what you returned in validation_step for each batch
         # outputs = [{'loss': batch_0_loss}, {'loss': batch_1_loss}, ..., {'loss': batch_n_loss}]
 
-        val_loss_mean = 0
-        val_acc_mean = 0
-        for output in outputs:
-            val_loss = output['val_loss']
-
-            # reduce manually when using dp
-            if self.trainer.use_dp or self.trainer.use_ddp2:  # not implemented
-                val_loss = torch.mean(val_loss)
-            val_loss_mean += val_loss
-
-            # reduce manually when using dp
-            val_acc = output['val_acc']
-            if self.trainer.use_dp or self.trainer.use_ddp2:   # not implemented
-                val_acc = torch.mean(val_acc)
-
-            val_acc_mean += val_acc
-
-        val_loss_mean /= len(outputs)
-        val_acc_mean /= len(outputs)
+        # averaged over all rows of the validation set, one host sync per epoch
+        result = self.val_metrics.compute()
+        self.val_metrics.reset()
+        val_loss_mean = torch.tensor(result['loss'])
+        val_acc_mean = torch.tensor(result['accuracy'])
         tqdm_dict = {'val_loss': val_loss_mean, 'val_acc': val_acc_mean}
         result = {'progress_bar': tqdm_dict, 'log': {'val_loss': val_loss_mean,'val_acc':val_acc_mean},
                   'val_loss': val_loss_mean}
@@ -306,15 +270,12 @@ class LightningCNN(pl.LightningModule):
         y = torch.max(y,1)[1]
         loss = self.cross_entropy_loss(y_pred,y)
 
-        # accuracy
         y_hat = torch.max(y_pred,1)[1]
-        test_acc = torch.sum(y == y_hat).item() / len(y)
-        test_acc = torch.tensor(test_acc)
+        self.test_metrics.update(loss, y_hat, y)
 
         # if batch_idx == int(len(y)/self.hparams.batch_size):
         output = OrderedDict({
             'test_loss': loss,
-            'test_acc': test_acc,
             'true_label': y,
             'pred_label': y_hat,
             'snrs': z,
@@ -327,28 +288,16 @@ class LightningCNN(pl.LightningModule):
         # outputs is an array with what you returned in test_step for each batch
         # outputs = [{'loss': batch_0_loss}, {'loss': batch_1_loss}, ..., {'loss': batch_n_loss}]
         # print(outputs)
-        test_loss_mean = 0
-        test_acc_mean = 0
-        for output in outputs:
-            test_loss = output['test_loss']
-
-            # reduce manually when using dp
-            if self.trainer.use_dp or self.trainer.use_ddp2:  # not implemented
-                test_loss = torch.mean(test_loss)
-            test_loss_mean += test_loss
-
-            # reduce manually when using dp
-            test_acc = output['test_acc']
-            if self.trainer.use_dp or self.trainer.use_ddp2:  # not implemented
-                test_acc = torch.mean(test_acc)
-
-            test_acc_mean += test_acc
-            self.all_true.extend(output['true_label'].detach().cpu().data.numpy())
-            self.all_pred.extend(output['pred_label'].detach().cpu().data.numpy())
-            self.all_snr.extend(output['snrs'].detach().cpu().data.numpy())
-
-        confusion_matrix = metrics.confusion_matrix(self.all_true,self.all_pred)
-        accuracy = metrics.accuracy_score(self.all_true,self.all_pred)
+        result = self.test_metrics.compute()
+        self.test_metrics.reset()
+        # one copy per column instead of one per batch
+        for key, values in (('true_label', self.all_true), ('pred_label', self.all_pred), ('snrs', self.all_snr)):
+            values.extend(torch.cat([output[key] for output in outputs]).cpu().numpy())
+
+        confusion_matrix = result['confusion_matrix'].numpy()
+        accuracy = result['accuracy']
+        test_loss_mean = result['loss']
+        test_acc_mean = accuracy
         # save results in csv
         fieldnames = ['True_label', 'Predicted_label', 'SNR']
 
@@ -362,8 +311,6 @@ class LightningCNN(pl.LightningModule):
                 writer.writerow(
                     {'True_label': i.item(), 'Predicted_label': j.item(), 'SNR': k})
 
-        test_loss_mean /= len(outputs)
-        test_acc_mean /= len(outputs)
         tqdm_dict = OrderedDict({'Test_loss': test_loss_mean, 'Test_acc(mean)': test_acc_mean,
                                 'True_accuracy': accuracy, 'Confusion_matrix': confusion_matrix})
 
@@ -380,33 +327,14 @@ class LightningCNN(pl.LightningModule):
 
 
     def prepare_data(self, valid_fraction=0.05, test_fraction=0.2):
-        dataset = DatasetFromHDF5(self.hparams.data_path, 'iq', 'labels', 'snrs', self.hparams.featurize)
-        num_train = len(dataset)
-        indices = list(range(num_train))
-        val_split = int(math.floor(valid_fraction * num_train))
-        test_split = val_split + int(math.floor(test_fraction * num_train))
-        training_params = {"batch_size": self.hparams.batch_size,
-                           "num_workers": self.hparams.num_workers}
-
-        if not ('shuffle' in training_params and not training_params['shuffle']):
-            np.random.seed(4)
-            np.random.shuffle(indices)
-        if 'num_workers' not in training_params:
-            training_params['num_workers'] = 1
-
-        train_idx, valid_idx, test_idx = indices[test_split:], indices[:val_split], indices[val_split:test_split]
-        train_sampler = SubsetRandomSampler(train_idx)
-        valid_sampler = SubsetRandomSampler(valid_idx)
-        test_sampler = SubsetRandomSampler(test_idx)
-        self.train_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                   shuffle=self.hparams.shuffle,num_workers=self.hparams.num_workers,
-                                   sampler=train_sampler)
-        self.val_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                 shuffle=self.hparams.shuffle,num_workers=self.hparams.num_workers,
-                                 sampler=valid_sampler)
-        self.test_dataset = DataLoader(dataset, batch_size=self.hparams.batch_size,
-                                  shuffle=self.hparams.shuffle, num_workers=self.hparams.num_workers,
-                                  sampler=test_sampler)
+        dataset = open_dataset(self.hparams.data_path, feature_flag=self.hparams.featurize,
+                               feature_path=getattr(self.hparams, 'feature_path', None),
+                               cache_features=getattr(self.hparams, 'cache_features', False))
+        if dataset.feature_cache is not None and getattr(self.hparams, 'warm_up_features', False):
+            dataset.feature_cache.warm_up(dataset)
+        self.train_dataset, self.val_dataset, self.test_dataset = split_loaders(
+            dataset, self.hparams.batch_size, num_workers=self.hparams.num_workers,
+            valid_fraction=valid_fraction, test_fraction=test_fraction)
 
 
     # @pl.data_loader
@@ -495,6 +423,7 @@ def main(hparams):
     trainer = Trainer(logger=neptune_logger,
                       gpus=hparams.gpus,
                       max_epochs=hparams.max_epochs,
+                      precision=int(hparams.precision),
                       checkpoint_callback=True,
                       callbacks=[model_checkpoint])
                       # early_stop_callback=early_stop_callback)
@@ -540,6 +469,12 @@ if __name__=="__main__":
     parser.add_argument('--n_classes', default=8)
     parser.add_argument('--n_features', default=10)
     parser.add_argument('--featurize', default=False)
+    parser.add_argument('--feature_path', default=None, help='precomputed features (.npy) for --featurize')
+    parser.add_argument('--cache_features', default=True, help='cache --featurize features next to the dataset')
+    parser.add_argument('--warm_up_features', default=False, help='fill the feature cache before training')
+    parser.add_argument('--precision', default=32, help='16 for mixed precision (AMP) training on gpu')
+    parser.add_argument('--channels_last', default=False, help='NHWC memory format for the conv layers')
+    parser.add_argument('--conv1d', default=False, help='Conv1d blocks equivalent to the 2-D ones')
     args = parser.parse_args()
 
     main(args)
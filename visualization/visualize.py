@@ -15,7 +15,9 @@ from visualization.utils import update_axis, update_layout, save_fig, draw_grid_
 
 from data_processing.Receiver import *
 from data_processing.dataloader import *
+from data_processing.iq_conversion import iq_to_complex
 from models.pytorch.cnn_model import *
+from model_inference.batch_inference import load_model
 
 
 def visualize_signal(iq_signal):
@@ -72,8 +74,7 @@ def save_cnn_features():
     training_params = {'batch_size': 512, 'num_workers': 10}
     train_set, val_set, test_set = load_data(path_h5,0.05,0.2,**training_params)
 
-    model = torch.load("/home/rachneet/thesis_results/trained_cnn_no_intf_vsg_all",map_location='cuda:0')
-    model.eval()
+    model = load_model("/home/rachneet/thesis_results/trained_cnn_no_intf_vsg_all", 'cnn', 'cuda:0')
     # print(list(model.children())[5])
     activations = SaveFeatures(list(model.children())[7])   # using last conv layer
     # print(list(model.children())[5])
@@ -139,8 +140,7 @@ def plot_activations(iq_sample):
     input = input.unsqueeze(dim=0)  # adding batch dimension
 
     # pass to pre trained model
-    model = torch.load("trained_cnn_intf_free_vsg20")
-    model.eval()
+    model = load_model("trained_cnn_intf_free_vsg20", 'cnn', 'cuda:0')
 
     # get activations for 6th convolution layer
     activations = SaveFeatures(list(model.children())[5])
@@ -159,33 +159,11 @@ def plot_activations(iq_sample):
     # plt.imshow(features[:, :, 0])
     # plt.show()
 
-# convert iq samples to complex form
-def iq_to_complex(iq_sample):
-    complex = []
-    for sample in iq_sample:
-        re = sample[0]
-        img = sample[1]
-        signal = np.complex(re + 1j * img)
-        complex.append(signal)
-    return complex
-
-
-def complex_to_iq(complex):
-    iq = []
-    signal=[]
-    for sample in complex:
-        re = sample.real
-        img = sample.imag
-        iq.append(np.array([re,img]))
-    return np.array(iq)
-
-
 # basically grad-cam
 def visualizing_filters(iq_sample):
 
     # pass to pre trained model
-    model = torch.load("trained_cnn_intf_free_vsg20")
-    model.eval()
+    model = load_model("trained_cnn_intf_free_vsg20", 'cnn', 'cuda:0')
 
 
     # get activations for 6th convolution layer
@@ -343,7 +321,7 @@ def plot_melspectrogram(iq,fig_name):
     fmax=50e6
     fmin=10e4
     iq = iq_to_complex(iq)
-    real = [sample.real for sample in iq]
+    real = iq.real
     # iq = iq[:0+n_fft]
     # X = fft.fft(iq)
     # X_magnitude, X_phase = librosa.magphase(X)
@@ -383,8 +361,7 @@ def deep_dream(iq_sample):
     # print(signal)
 
     # pass to pre trained model
-    model = torch.load("trained_cnn_intf_free_vsg20")
-    model.eval()
+    model = load_model("trained_cnn_intf_free_vsg20", 'cnn', 'cuda:0')
 
     # get activations for 6th convolution layer
     activations = SaveFeatures(list(model.children())[5])